@@ -1,13 +1,23 @@
 from django import forms
 from django.contrib import admin
 
-from .models import Attachment, Property, Session, Upload
+from .models import Attachment, Blob, Property, Rendition, Session, Upload
 from .utils import import_class
 
 
 class AttachmentAdmin (admin.ModelAdmin):
     list_display = ('file_path', 'file_name', 'file_size', 'content_type', 'context', 'date_created')
     readonly_fields = ('data',)
+    raw_id_fields = ('blob',)
+
+
+class BlobAdmin (admin.ModelAdmin):
+    list_display = ('digest', 'file_path', 'file_size', 'ref_count', 'date_created')
+
+
+class RenditionAdmin (admin.ModelAdmin):
+    list_display = ('file_path', 'size', 'width', 'height', 'file_size', 'date_created')
+    raw_id_fields = ('attachment',)
 
 
 class PropertyForm (forms.ModelForm):
@@ -41,4 +51,6 @@ class SessionAdmin (admin.ModelAdmin):
 
 admin.site.register(Attachment, AttachmentAdmin)
 admin.site.register(Session, SessionAdmin)
+admin.site.register(Blob, BlobAdmin)
+admin.site.register(Rendition, RenditionAdmin)
 admin.site.register(Property, PropertyAdmin)
@@ -0,0 +1,132 @@
+"""
+Native async versions of the upload and download views, for projects served over ASGI. These need Django 3.1 or
+later, and are used by attachments.urls when ATTACHMENT_ASYNC_VIEWS is True.
+
+Under ASGI, Django runs sync views one at a time in a single thread, so a slow upload or download holds up every
+other sync view. Here the ORM work still runs in that thread (via sync_to_async), but file I/O happens either in the
+event loop through aiofiles, when it's installed, or in a pool of worker threads:
+
+* Chunk PUTs are written to disk with aiofiles (or in a worker thread).
+* Multipart uploads and finalizing chunked uploads run the sync view in a worker thread, since Django only parses
+  multipart bodies synchronously, and processing an upload means hashing (and possibly scanning) the whole file.
+* Downloads are streamed through an async iterator, ATTACHMENT_DOWNLOAD_BLOCK_SIZE bytes at a time. Async streaming
+  responses need Django 4.2; on earlier versions the response is streamed as the sync view would stream it.
+"""
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+
+from . import views
+from .downloads import LocalFileResponse, get_download_backend
+from .models import Session
+
+import django
+
+try:
+    import aiofiles
+except ImportError:
+    aiofiles = None
+
+
+ASYNC_STREAMING = django.VERSION >= (4, 2)
+
+
+def in_thread(func):
+    """
+    Returns an async version of func that runs in a worker thread, rather than the thread shared by sync code, and
+    closes that thread's database connection afterwards (the request cycle only cleans up the shared thread's).
+    """
+    def run(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(run, thread_sensitive=False)
+
+
+async def iter_file(path, block_size):
+    async with aiofiles.open(path, 'rb') as fp:
+        while True:
+            block = await fp.read(block_size)
+            if not block:
+                break
+            yield block
+
+
+async def iter_blocks(content):
+    """
+    Iterates over a sync streaming response's content, reading each block in a worker thread.
+    """
+    next_block = sync_to_async(next, thread_sensitive=False)
+    iterator = iter(content)
+    while True:
+        block = await next_block(iterator, None)
+        if block is None:
+            break
+        yield block
+
+
+def stream_async(response):
+    """
+    Switches a streaming response over to an async iterator, so serving it doesn't block the event loop.
+    """
+    if isinstance(response, LocalFileResponse) and response.status_code == 200 and aiofiles is not None:
+        # The response's own file is still closed along with the response.
+        response.streaming_content = iter_file(response.file_to_stream.name, response.block_size)
+    else:
+        response.streaming_content = iter_blocks(response.streaming_content)
+    return response
+
+
+async def _write_chunk(request, path, start, expected):
+    if aiofiles is None:
+        return await sync_to_async(views._write_chunk, thread_sensitive=False)(request, path, start, expected)
+    # The ASGI handler has already received the whole body (spooled to a temp file), so reading it doesn't wait on
+    # the network.
+    async with aiofiles.open(path, 'r+b') as fp:
+        await fp.seek(start)
+        received = 0
+        while received < expected:
+            block = request.read(min(64 * 1024, expected - received))
+            if not block:
+                break
+            await fp.write(block)
+            received += len(block)
+        await fp.truncate(start + received)
+    return received
+
+
+async def attach(request, session_id):
+    return await in_thread(views.attach)(request, session_id)
+
+
+async def chunked_upload(request, session_id, token):
+    if request.method != 'PUT':
+        return await in_thread(views.chunked_upload)(request, session_id, token)
+    session = await sync_to_async(get_object_or_404)(Session, uuid=session_id)
+    # Finding the file (and creating its temp directory) touches the disk, so keep it off the event loop too.
+    path, offset = await sync_to_async(views._chunked_offset, thread_sensitive=False)(session, token)
+    start, expected, error = views._parse_chunk_range(request, offset)
+    if error is not None:
+        return error
+    received = await _write_chunk(request, path, start, expected)
+    if received != expected:
+        return JsonResponse({'ok': False, 'error': 'Incomplete chunk.', 'offset': start + received}, status=400)
+    return JsonResponse({'ok': True, 'offset': start + received})
+
+
+async def download(request, attach_id, filename=None):
+    attachment = await sync_to_async(views._get_download)(request, attach_id)
+    # Serving only touches storage (which may mean a network round trip to check the size), not the database.
+    serve = sync_to_async(get_download_backend().serve, thread_sensitive=False)
+    response = await serve(request, attachment, attachment.get_storage(), attachment.get_content_type(), filename)
+    if ASYNC_STREAMING and response.streaming:
+        stream_async(response)
+    return response
+
+
+# csrf_exempt only learned to wrap coroutine functions in Django 5.0.
+attach.csrf_exempt = True
+chunked_upload.csrf_exempt = True
@@ -0,0 +1,183 @@
+"""
+Process-wide caches for attachment data that rarely changes.
+
+Property definitions are cached per content type, and thrown away whenever a Property is saved, deleted, or has its
+content types changed. To keep several processes or servers coherent, a version number is kept in the Django cache
+named by ATTACHMENT_PROPERTY_CACHE ('default' by default), bumped once each change commits, and checked (one cache get)
+before using locally cached properties. Until then, properties are read from the database without being cached, since
+the change may still be rolled back. That only works if the cache is shared between processes (i.e. not LocMemCache), so
+locally cached properties are also reloaded after ATTACHMENT_PROPERTY_CACHE_TIMEOUT seconds (60 by default, or None to
+keep them until they change). Setting ATTACHMENT_PROPERTY_CACHE to None keeps the version in each process instead.
+
+Access checks (the result of a content object's can_download) can also be cached per user and object, for
+ATTACHMENT_ACCESS_CACHE_TIMEOUT seconds (0, the default, disables this), in the Django cache named by
+ATTACHMENT_ACCESS_CACHE. Only enable this if can_download doesn't depend on the particular attachment, and call
+invalidate_access() when permissions change.
+"""
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.db import connections, transaction
+
+import threading
+import time
+
+
+PROPERTY_VERSION_KEY = 'attachments:property-version'
+ACCESS_VERSION_KEY = 'attachments:access-version:%s'
+ACCESS_KEY = 'attachments:access:%s:%s:%s'
+
+_lock = threading.Lock()
+_local_version = 0
+# content type ID -> (version, expiry time, [Property, ...])
+_properties = {}
+
+
+def _shared_cache():
+    alias = getattr(settings, 'ATTACHMENT_PROPERTY_CACHE', 'default')
+    return caches[alias] if alias else None
+
+
+def _new_version():
+    # Start from the clock rather than 1, so a version that was evicted from the cache is never handed out again.
+    return int(time.time() * 1000)
+
+
+def get_property_version():
+    """
+    Returns the current version of the property definitions. It changes every time a Property is changed.
+    """
+    cache = _shared_cache()
+    if cache is None:
+        return _local_version
+    version = cache.get(PROPERTY_VERSION_KEY)
+    if version is None:
+        cache.add(PROPERTY_VERSION_KEY, _new_version(), None)
+        version = cache.get(PROPERTY_VERSION_KEY)
+    return version
+
+
+def _invalidation_pending(conn=None):
+    """
+    Returns whether properties were changed in a transaction (in this thread, on conn or any database) that hasn't
+    committed yet.
+    """
+    conns = [conn] if conn is not None else connections.all()
+    return any(callback[1] is _publish_version for conn in conns for callback in conn.run_on_commit)
+
+
+def get_properties(content_type, editable_only=False):
+    """
+    Returns a list of the Property objects for content_type. The same objects are shared by every caller, so they
+    should be treated as read-only.
+    """
+    from .models import Property
+    version = get_property_version()
+    key = content_type.pk if content_type is not None else None
+    now = time.time()
+    entry = _properties.get(key)
+    if entry is None or entry[0] != version or (entry[1] is not None and entry[1] <= now):
+        timeout = getattr(settings, 'ATTACHMENT_PROPERTY_CACHE_TIMEOUT', 60)
+        entry = (version, now + timeout if timeout is not None else None,
+                 list(Property.objects.filter(content_type=content_type)))
+        if not _invalidation_pending():
+            with _lock:
+                _properties[key] = entry
+    if editable_only:
+        return [prop for prop in entry[2] if prop.is_editable]
+    return list(entry[2])
+
+
+def _publish_version():
+    global _local_version
+    with _lock:
+        _local_version += 1
+        _properties.clear()
+    cache = _shared_cache()
+    if cache is not None:
+        try:
+            cache.incr(PROPERTY_VERSION_KEY)
+        except ValueError:
+            cache.set(PROPERTY_VERSION_KEY, _new_version(), None)
+
+
+def invalidate_properties(using=None, **kwargs):
+    """
+    Discards cached property definitions in this process, and in every other one sharing ATTACHMENT_PROPERTY_CACHE
+    once the current transaction on the given database commits. Accepts (and ignores) other signal arguments, so it can
+    be connected to model signals directly.
+    """
+    with _lock:
+        _properties.clear()
+    if not _invalidation_pending(transaction.get_connection(using)):
+        transaction.on_commit(_publish_version, using=using)
+
+
+def _access_cache():
+    timeout = getattr(settings, 'ATTACHMENT_ACCESS_CACHE_TIMEOUT', 0)
+    if not timeout:
+        return None, 0
+    return caches[getattr(settings, 'ATTACHMENT_ACCESS_CACHE', 'default')], timeout
+
+
+def _access_version_keys(user_id, content_type_id, object_id):
+    return (
+        ACCESS_VERSION_KEY % 'all',
+        ACCESS_VERSION_KEY % 'user:%s' % user_id,
+        ACCESS_VERSION_KEY % 'object:%s:%s' % (content_type_id, object_id),
+    )
+
+
+def _access_key(cache, user_id, content_type_id, object_id):
+    # The key includes the current version of everything it depends on, so bumping any of them orphans it.
+    version_keys = _access_version_keys(user_id, content_type_id, object_id)
+    versions = cache.get_many(version_keys)
+    for key in version_keys:
+        if key not in versions:
+            cache.add(key, _new_version(), None)
+            versions[key] = cache.get(key)
+    version = '.'.join(str(versions[key]) for key in version_keys)
+    return ACCESS_KEY % (version, user_id, '%s:%s' % (content_type_id, object_id))
+
+
+def get_cached_access(user, content_type_id, object_id):
+    """
+    Returns the cached result of an access check for user on an object, or None if there isn't one (or caching is
+    disabled).
+    """
+    cache, timeout = _access_cache()
+    if cache is None or not user.is_authenticated:
+        return None
+    return cache.get(_access_key(cache, user.pk, content_type_id, object_id))
+
+
+def set_cached_access(user, content_type_id, object_id, auth):
+    cache, timeout = _access_cache()
+    if cache is None or not user.is_authenticated:
+        return
+    cache.set(_access_key(cache, user.pk, content_type_id, object_id), bool(auth), timeout)
+
+
+def invalidate_access(obj=None, user=None, **kwargs):
+    """
+    Discards cached access checks for an object, for a user, or (with neither) for everything. Accepts (and ignores)
+    other signal arguments, so it can be connected to model signals, e.g.
+    post_save.connect(invalidate_access, sender=Document) using the "instance" argument.
+    """
+    cache, timeout = _access_cache()
+    if cache is None:
+        return
+    obj = obj if obj is not None else kwargs.get('instance')
+    keys = []
+    if obj is not None:
+        keys.append(ACCESS_VERSION_KEY % 'object:%s:%s' % (ContentType.objects.get_for_model(obj).pk, obj.pk))
+    if user is not None:
+        keys.append(ACCESS_VERSION_KEY % 'user:%s' % user.pk)
+    if not keys:
+        keys.append(ACCESS_VERSION_KEY % 'all')
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version(), None)
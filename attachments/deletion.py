@@ -0,0 +1,108 @@
+"""
+Removal of stored files once the rows referencing them are gone.
+
+Deleting an attachment queues its file for deletion when the surrounding transaction commits (or immediately, outside
+of a transaction), so a rollback never leaves rows pointing at missing files. Files are then deleted from storage
+concurrently (ATTACHMENT_DELETE_WORKERS at once), retrying failures up to ATTACHMENT_DELETE_RETRIES times.
+"""
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+import six
+
+from .utils import get_storage
+
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def _delete_file(storage, name, retries, delay):
+    for attempt in range(retries + 1):
+        try:
+            storage.delete(name)
+            return True
+        except Exception:
+            if attempt == retries:
+                logger.exception('Error deleting %s from storage', name)
+                return False
+            time.sleep(delay * (2 ** attempt))
+
+
+def delete_files(names, storage=None):
+    """
+    Deletes files from storage right away, returning the number that were deleted successfully.
+    """
+    names = list(names)
+    if not names:
+        return 0
+    if storage is None:
+        storage = get_storage()
+    retries = getattr(settings, 'ATTACHMENT_DELETE_RETRIES', 3)
+    delay = getattr(settings, 'ATTACHMENT_DELETE_RETRY_DELAY', 0.5)
+    workers = min(getattr(settings, 'ATTACHMENT_DELETE_WORKERS', 4), len(names))
+    if workers <= 1:
+        return sum(_delete_file(storage, name, retries, delay) for name in names)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(lambda name: _delete_file(storage, name, retries, delay), names))
+
+
+def schedule_deletion(names, storage=None, using=None):
+    """
+    Deletes files from storage once the current transaction commits.
+    """
+    names = list(names)
+    if names:
+        transaction.on_commit(lambda: delete_files(names, storage), using=using)
+
+
+def remove_temp_files(paths, using=None):
+    """
+    Removes local (temporary upload) files once the current transaction commits.
+    """
+    paths = list(paths)
+
+    def remove():
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    if paths:
+        transaction.on_commit(remove, using=using)
+
+
+def delete_attachments(obj):
+    """
+    Deletes every attachment on obj, along with their files.
+    """
+    from .models import Attachment
+    return Attachment.objects.filter(content_type=ContentType.objects.get_for_model(obj), object_id=obj.pk).delete()
+
+
+def delete_rendition_file(sender, instance, using=None, **kwargs):
+    """
+    A post_delete receiver (connected for Rendition) that removes a deleted rendition's file once the transaction
+    commits. Renditions are deleted by cascading from their attachment, so this catches every way of deleting one.
+    """
+    schedule_deletion([instance.file_path], instance.get_storage(), using=using)
+
+
+def delete_orphaned_attachments(sender, instance, **kwargs):
+    """
+    A post_delete receiver that deletes the attachments of any deleted object. Attachments only have a generic
+    relation to their objects, so they would otherwise be left behind. It is connected to every model when
+    ATTACHMENT_DELETE_WITH_OBJECT is set, or can be connected for specific senders.
+    """
+    if sender._meta.app_label in ('attachments', 'contenttypes', 'sessions', 'migrations'):
+        return
+    if not isinstance(instance.pk, six.integer_types):
+        return
+    delete_attachments(instance)
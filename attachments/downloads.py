@@ -0,0 +1,455 @@
+"""
+Serving attachment downloads. The download view authorizes the request, then hands it to the backend configured by
+ATTACHMENT_DOWNLOAD_BACKEND, a (class path, kwargs) tuple like ATTACHMENT_STORAGE:
+
+    StreamingBackend        streams the file from the app server, with support for ETags, conditional requests,
+                            and byte ranges (RFC 7232/7233). This is the default.
+    XSendfileBackend        has Apache (mod_xsendfile) or lighttpd send the file, using the X-Sendfile header.
+    XAccelRedirectBackend   has nginx send the file from an internal location, using X-Accel-Redirect.
+    RedirectBackend         redirects to the storage's URL for the file, e.g. a presigned S3 URL.
+
+It also builds the streamed ZIP archives served by the download_zip view.
+"""
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from six.moves.urllib.parse import quote
+
+from .utils import import_class, url_filename
+
+from wsgiref.util import FileWrapper
+import calendar
+import hashlib
+import mmap
+import os
+import re
+import uuid
+import zipfile
+
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+# Requests asking for more ranges than this are served the whole file instead.
+MAX_RANGES = 20
+
+
+def attachment_etag(attachment, size):
+    """
+    Returns a strong ETag for an attachment: its digest when there is one, otherwise a hash of its path, size, and
+    creation date, which identify its contents since attachments are never modified in place.
+    """
+    if getattr(attachment, 'digest', ''):
+        return '"%s"' % attachment.digest
+    key = '%s:%s:%s' % (attachment.file_path, size, attachment.date_created.isoformat())
+    return '"%s"' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def parse_range_header(header, size):
+    """
+    Parses an HTTP Range header into a list of inclusive (start, end) byte offsets into a file of the given size.
+    Returns None if the header is missing or malformed (meaning it should be ignored), or an empty list if none of the
+    ranges can be satisfied.
+    """
+    if not header or size is None:
+        return None
+    units, _sep, specs = header.partition('=')
+    if units.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        match = RANGE_RE.match(spec)
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if not first:
+            # A suffix range: the last N bytes.
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(size - length, 0), size - 1))
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+            if start < size:
+                ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def if_range_passes(request, etag, last_modified):
+    """
+    Returns whether the ranges in a request should be honored, according to its If-Range header (if any).
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.strip().startswith(('"', 'W/')):
+        # Only strong comparison is allowed for If-Range.
+        return etag is not None and not if_range.strip().startswith('W/') and etag in parse_etags(if_range)
+    date = parse_http_date_safe(if_range)
+    return date is not None and last_modified is not None and date == last_modified
+
+
+def iter_range(fp, start, end, block_size):
+    fp.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        data = fp.read(min(block_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def _iter_multipart(fp, ranges, headers, block_size, boundary):
+    try:
+        for (start, end), header in zip(ranges, headers):
+            yield header
+            for data in iter_range(fp, start, end, block_size):
+                yield data
+        yield ('\r\n--%s--\r\n' % boundary).encode('ascii')
+    finally:
+        fp.close()
+
+
+def _iter_single(fp, start, end, block_size):
+    try:
+        for data in iter_range(fp, start, end, block_size):
+            yield data
+    finally:
+        fp.close()
+
+
+def ranged_response(fp, ranges, size, content_type, block_size=64 * 1024):
+    """
+    Returns a 206 response for one or more satisfiable byte ranges of an open file.
+    """
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(_iter_single(fp, start, end, block_size), status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Content-Length'] = end - start + 1
+        return response
+    boundary = uuid.uuid4().hex
+    headers = []
+    length = len('\r\n--%s--\r\n' % boundary)
+    for start, end in ranges:
+        header = '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+            boundary, content_type or 'application/octet-stream', start, end, size)
+        headers.append(header.encode('ascii'))
+        length += len(header) + end - start + 1
+    response = StreamingHttpResponse(_iter_multipart(fp, ranges, headers, block_size, boundary), status=206,
+                                     content_type='multipart/byteranges; boundary=%s' % boundary)
+    response['Content-Length'] = length
+    return response
+
+
+def range_not_satisfiable(size):
+    response = HttpResponse(status=416)
+    response['Content-Range'] = 'bytes */%d' % size
+    return response
+
+
+def conditional_response(request, attachment, size):
+    """
+    Returns the ETag and Last-Modified values for an attachment, along with a 304 or 412 response if the request's
+    conditional headers call for one (otherwise None).
+    """
+    etag = attachment_etag(attachment, size) if size is not None else None
+    last_modified = calendar.timegm(attachment.date_created.utctimetuple())
+    headers = HttpResponse()
+    if etag:
+        headers['ETag'] = etag
+    headers['Last-Modified'] = http_date(last_modified)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified, response=headers)
+    return etag, last_modified, (None if response is headers else response)
+
+
+def set_content_disposition(response, attachment, filename):
+    # Browsers must not second-guess the Content-Type, which is only guessed from the file name.
+    response['X-Content-Type-Options'] = 'nosniff'
+    if getattr(settings, 'ATTACHMENT_ALWAYS_DOWNLOAD', False) or not filename:
+        filename = url_filename(filename or attachment.file_name)
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+def set_download_headers(response, attachment, filename, etag, last_modified, size):
+    if etag:
+        response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if size is not None:
+        response['Accept-Ranges'] = 'bytes'
+    return set_content_disposition(response, attachment, filename)
+
+
+class DownloadBackend (object):
+
+    def __init__(self, **kwargs):
+        pass
+
+    def serve(self, request, attachment, storage, content_type, filename=None):
+        """
+        Returns the response for an (already authorized) download of attachment from storage.
+        """
+        raise NotImplementedError()
+
+
+class _StreamedFile (object):
+    """
+    Wraps the file handed to wsgi.file_wrapper, so that closing it also closes the response (which sends the
+    request_finished signal). Everything else, notably fileno(), goes to the real file.
+    """
+
+    def __init__(self, fp, on_close):
+        self._fp = fp
+        self._on_close = on_close
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+    def close(self):
+        self._on_close()
+
+
+def iter_mmap(fp, block_size):
+    mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        view = memoryview(mapped)
+        try:
+            for pos in range(0, len(mapped), block_size):
+                yield bytes(view[pos:pos + block_size])
+        finally:
+            view.release()
+    finally:
+        mapped.close()
+
+
+class LocalFileResponse (StreamingHttpResponse):
+    """
+    Streams an open file from local disk. The file is also exposed as file_to_stream, so WSGI servers that provide
+    wsgi.file_wrapper (gunicorn, uWSGI, mod_wsgi) are handed the file itself, which lets them send it with sendfile(2).
+    Otherwise it is read block_size bytes at a time, or through mmap when use_mmap is True.
+    """
+
+    def __init__(self, fp, block_size=64 * 1024, use_mmap=False, *args, **kwargs):
+        if use_mmap and os.fstat(fp.fileno()).st_size > 0:
+            content = iter_mmap(fp, block_size)
+        else:
+            content = FileWrapper(fp, block_size)
+        super(LocalFileResponse, self).__init__(content, *args, **kwargs)
+        if hasattr(self, '_resource_closers'):
+            # Django 3.0+
+            self._resource_closers.append(fp.close)
+        else:
+            self._closable_objects.append(fp)
+        self.block_size = block_size
+        self.file_to_stream = _StreamedFile(fp, self.close)
+
+
+def open_local(storage, name):
+    """
+    Opens a stored file directly from disk if the storage keeps files locally, returning None otherwise.
+    """
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        return None
+    return open(path, 'rb')
+
+
+class StreamingBackend (DownloadBackend):
+    """
+    Accepts block_size, the number of bytes read at a time (ATTACHMENT_DOWNLOAD_BLOCK_SIZE, 256 KB by default), and
+    use_mmap, to read local files through mmap when the server doesn't provide wsgi.file_wrapper
+    (ATTACHMENT_DOWNLOAD_MMAP, False by default).
+    """
+
+    def __init__(self, block_size=None, use_mmap=None, **kwargs):
+        super(StreamingBackend, self).__init__(**kwargs)
+        if block_size is None:
+            block_size = getattr(settings, 'ATTACHMENT_DOWNLOAD_BLOCK_SIZE', 256 * 1024)
+        if use_mmap is None:
+            use_mmap = getattr(settings, 'ATTACHMENT_DOWNLOAD_MMAP', False)
+        self.block_size = block_size
+        self.use_mmap = use_mmap
+
+    def serve(self, request, attachment, storage, content_type, filename=None):
+        try:
+            # Not all storage backends support getting filesize.
+            size = storage.size(attachment.file_path)
+        except NotImplementedError:
+            size = None
+        etag, last_modified, response = conditional_response(request, attachment, size)
+        if response is not None:
+            return response
+        ranges = None
+        if request.method in ('GET', 'HEAD') and if_range_passes(request, etag, last_modified):
+            ranges = parse_range_header(request.META.get('HTTP_RANGE'), size)
+        if ranges == []:
+            return range_not_satisfiable(size)
+        fp = open_local(storage, attachment.file_path)
+        if ranges:
+            fp = fp or storage.open(attachment.file_path)
+            response = ranged_response(fp, ranges, size, content_type, block_size=self.block_size)
+        elif fp is not None:
+            response = LocalFileResponse(fp, block_size=self.block_size, use_mmap=self.use_mmap,
+                                         content_type=content_type)
+        else:
+            response = StreamingHttpResponse(FileWrapper(storage.open(attachment.file_path), self.block_size),
+                                             content_type=content_type)
+        if size is not None and not ranges:
+            response['Content-Length'] = size
+        return set_download_headers(response, attachment, filename, etag, last_modified, size)
+
+
+class XSendfileBackend (DownloadBackend):
+    """
+    Requires a storage with local paths (e.g. FileSystemStorage). The web server takes care of ranges and caching.
+    """
+
+    header = 'X-Sendfile'
+
+    def get_location(self, attachment, storage):
+        return storage.path(attachment.file_path)
+
+    def serve(self, request, attachment, storage, content_type, filename=None):
+        response = HttpResponse(content_type=content_type)
+        response[self.header] = self.get_location(attachment, storage)
+        return set_content_disposition(response, attachment, filename)
+
+
+class XAccelRedirectBackend (XSendfileBackend):
+    """
+    prefix is the internal nginx location that maps to the storage root, for example:
+
+        location /protected/ {
+            internal;
+            alias /path/to/MEDIA_ROOT/;
+        }
+
+    When attachments are stored in more than one storage (see ATTACHMENT_STORAGES), prefix is a dict of storage name to
+    the location for that storage's root. A single prefix only applies to the default storage.
+    """
+
+    header = 'X-Accel-Redirect'
+
+    def __init__(self, prefix='/protected/', **kwargs):
+        super(XAccelRedirectBackend, self).__init__(**kwargs)
+        prefixes = prefix if isinstance(prefix, dict) else {'default': prefix}
+        self.prefixes = dict((name, p if p.endswith('/') else p + '/') for name, p in prefixes.items())
+
+    def get_location(self, attachment, storage):
+        try:
+            prefix = self.prefixes[attachment.storage]
+        except KeyError:
+            raise ImproperlyConfigured('XAccelRedirectBackend has no prefix for the "%s" storage.' % attachment.storage)
+        return prefix + quote(attachment.file_path.encode('utf-8'))
+
+
+class RedirectBackend (DownloadBackend):
+    """
+    Sends the client to storage.url() for the file. For object stores this is usually a short-lived presigned URL.
+    """
+
+    def serve(self, request, attachment, storage, content_type, filename=None):
+        return HttpResponseRedirect(storage.url(attachment.file_path))
+
+
+def get_download_backend():
+    cls, kwargs = getattr(settings, 'ATTACHMENT_DOWNLOAD_BACKEND', ('attachments.downloads.StreamingBackend', {}))
+    return import_class(cls)(**kwargs)
+
+
+# MIME types (or prefixes) of formats that are already compressed, which are stored in ZIP archives as-is.
+COMPRESSED_TYPES = (
+    'image/', 'video/', 'audio/', 'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+    'application/x-xz', 'application/x-7z-compressed', 'application/x-rar-compressed', 'application/vnd.rar',
+    'application/pdf', 'application/vnd.openxmlformats-officedocument.', 'application/vnd.oasis.opendocument.',
+    'application/java-archive', 'application/epub+zip',
+)
+
+# Types in the prefixes above that do compress well.
+UNCOMPRESSED_TYPES = ('image/bmp', 'image/svg+xml', 'image/tiff', 'image/x-ms-bmp', 'audio/wav', 'audio/x-wav')
+
+
+def zip_compression(content_type):
+    if content_type and content_type.startswith(COMPRESSED_TYPES) and content_type not in UNCOMPRESSED_TYPES:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+class _ZipBuffer (object):
+    """
+    A write-only, unseekable file for ZipFile to write to. What is written is collected until the ZIP stream takes it.
+    ZipFile writes data descriptors after each member when it can't seek back, so nothing is ever rewritten.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def unique_names(names):
+    """
+    Yields names, renaming any repeats as "name (2).ext", "name (3).ext", and so on.
+    """
+    seen = set()
+    for name in names:
+        candidate, n = name, 1
+        while candidate.lower() in seen:
+            n += 1
+            base, ext = os.path.splitext(name)
+            candidate = '%s (%d)%s' % (base, n, ext)
+        seen.add(candidate.lower())
+        yield candidate
+
+
+def iter_zip(attachments, storage=None, block_size=256 * 1024):
+    """
+    Streams a ZIP archive of the given attachments, in constant memory and without temporary files. Files of types
+    that are already compressed are stored rather than deflated. Files are read from each attachment's own storage,
+    unless a storage is given.
+    """
+    buf = _ZipBuffer()
+    with zipfile.ZipFile(buf, 'w', allowZip64=True) as zf:
+        for attachment, name in zip(attachments, unique_names(a.file_name for a in attachments)):
+            date_time = attachment.date_created.timetuple()[:6]
+            info = zipfile.ZipInfo(name, date_time=date_time if date_time[0] >= 1980 else (1980, 1, 1, 0, 0, 0))
+            info.compress_type = zip_compression(attachment.get_content_type())
+            info.external_attr = 0o644 << 16
+            fp = (storage or attachment.get_storage()).open(attachment.file_path)
+            try:
+                with zf.open(info, 'w', force_zip64=attachment.file_size >= zipfile.ZIP64_LIMIT) as dest:
+                    for data in iter(lambda: fp.read(block_size), b''):
+                        dest.write(data)
+                        if buf.chunks:
+                            yield buf.take()
+            finally:
+                fp.close()
+            if buf.chunks:
+                yield buf.take()
+    # The central directory is written when the archive is closed.
+    yield buf.take()
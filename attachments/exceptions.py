@@ -1,3 +1,8 @@
 class VirusFoundException(Exception):
     """Exception raised for detecting a virus in a file upload"""
     pass
+
+
+class ScanError(Exception):
+    """Exception raised when clamd could not scan a file upload"""
+    pass
@@ -1,6 +1,8 @@
 from django import forms
+from django.utils.encoding import force_str
 
-from .models import Attachment, Property, Upload
+from .cache import get_properties
+from .models import Attachment, Upload
 
 
 PROPERTY_FIELD_CLASSES = {
@@ -35,11 +37,56 @@ except ImportError:
     pass
 
 
+class SharedModelChoiceIterator (forms.models.ModelChoiceIterator):
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ('', self.field.empty_label)
+        for obj in self.field.choice_objects:
+            yield self.choice(obj)
+
+    def __len__(self):
+        return len(self.field.choice_objects) + (1 if self.field.empty_label is not None else 0)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(self.field.choice_objects)
+    __nonzero__ = __bool__
+
+
+class SharedModelChoiceField (forms.ModelChoiceField):
+    """
+    A ModelChoiceField that renders and validates against a list of objects fetched once and shared between forms,
+    instead of querying its queryset every time.
+    """
+
+    iterator = SharedModelChoiceIterator
+
+    def __init__(self, *args, **kwargs):
+        self.choice_objects = kwargs.pop('choice_objects')
+        super(SharedModelChoiceField, self).__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        key = self.to_field_name or 'pk'
+        if isinstance(value, self.queryset.model):
+            value = getattr(value, key)
+        for obj in self.choice_objects:
+            if force_str(getattr(obj, key)) == force_str(value):
+                return obj
+        raise forms.ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+
+
 class PropertyForm (forms.Form):
 
     def __init__(self, *args, **kwargs):
         instance = kwargs.pop('instance')
         editable_only = kwargs.pop('editable_only', True)
+        # When building a form per upload, callers can pass in the properties for the content type, the decoded
+        # session data, and a dict to share lookup model choices in, so none of them are fetched once per form.
+        properties = kwargs.pop('properties', None)
+        form_data = kwargs.pop('form_data', None)
+        self.model_choices = kwargs.pop('model_choices', None)
 
         content_type = None
         if isinstance(instance, Attachment):
@@ -49,14 +96,16 @@ class PropertyForm (forms.Form):
 
         super(PropertyForm, self).__init__(*args, **kwargs)
 
-        qs = Property.objects.filter(content_type=content_type)
-        if editable_only:
-            qs = qs.filter(is_editable=True)
+        if properties is None:
+            properties = get_properties(content_type, editable_only=editable_only)
+        elif editable_only:
+            properties = [prop for prop in properties if prop.is_editable]
 
         is_upload = isinstance(instance, Upload)
         is_attachment = isinstance(instance, Attachment)
-        form_data = self.get_form_data_from_session_data(instance.session.data) if is_upload else {}
-        for prop in qs:
+        if is_upload and form_data is None:
+            form_data = self.get_form_data_from_session_data(instance.session.data)
+        for prop in properties:
             if is_upload:
                 field_key = 'upload-%d-%s' % (instance.pk, prop.slug)
                 self.fields[field_key] = self.formfield(prop, 
@@ -81,7 +130,14 @@ class PropertyForm (forms.Form):
             choices = [(ch, ch) for ch in prop.choice_list]
             defaults['choices'] = choices
         elif prop.data_type == 'model':
-            defaults['queryset'] = prop.model_queryset
+            if self.model_choices is not None and field_class is forms.ModelChoiceField:
+                if prop.pk not in self.model_choices:
+                    queryset = prop.model_queryset
+                    self.model_choices[prop.pk] = (queryset, list(queryset))
+                defaults['queryset'], defaults['choice_objects'] = self.model_choices[prop.pk]
+                field_class = SharedModelChoiceField
+            else:
+                defaults['queryset'] = prop.model_queryset
             if defaults.get('required', False):
                 defaults['empty_label'] = None
         elif prop.data_type == 'boolean':
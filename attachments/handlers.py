@@ -0,0 +1,93 @@
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from .processing import is_async
+from .utils import detect_file_type, get_hasher, make_temp_file
+
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+class ScannedUploadedFile (UploadedFile):
+    """
+    A file written to ATTACHMENT_TEMP_DIR by AttachmentUploadHandler. Unlike TemporaryUploadedFile, the file is not
+    removed when closed, so it can be used as an Upload's file_path directly.
+    """
+
+    def __init__(self, path, name, content_type, size, charset, content_type_extra=None, scanned=False, virus=None,
+                 mime_type=None, file_type=None, digest=None):
+        super(ScannedUploadedFile, self).__init__(open(path, 'rb'), name, content_type, size, charset, content_type_extra)
+        self.path = path
+        # Whether the file has been checked by clamd, and the name of the virus found, if any.
+        self.scanned = scanned
+        self.virus = virus
+        # The MIME type and libmagic description sniffed from the file contents (as opposed to the content_type sent
+        # by the browser).
+        self.mime_type = mime_type
+        self.file_type = file_type
+        # The hex digest of the file contents (see utils.get_hasher).
+        self.digest = digest
+
+    def temporary_file_path(self):
+        return self.path
+
+
+class AttachmentUploadHandler (FileUploadHandler):
+    """
+    Writes uploaded files straight to ATTACHMENT_TEMP_DIR as they are received. When ATTACHMENTS_CLAMD is set, each
+    chunk is also streamed to clamd, so the verdict is ready as soon as the upload finishes. The file's digest is computed
+    along the way, and its MIME type is sniffed from the completed file (libmagic may look past the first chunk, e.g.
+    into the directory of an Office document).
+    """
+
+    def new_file(self, *args, **kwargs):
+        super(AttachmentUploadHandler, self).new_file(*args, **kwargs)
+        fd, self.path = make_temp_file()
+        self.file = os.fdopen(fd, 'wb')
+        self.mime_type = None
+        self.file_type = None
+        self.scan = None
+        self.hasher = get_hasher()
+        # With asynchronous processing, scanning is left to the processing workers rather than waited on here.
+        if getattr(settings, 'ATTACHMENTS_CLAMD', False) and not is_async():
+            from .scanning import StreamScan
+            self.scan = StreamScan()
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+        self.hasher.update(raw_data)
+        if self.scan is not None:
+            self.scan.update(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.close()
+        try:
+            self.mime_type, self.file_type = detect_file_type(self.path)
+        except Exception:
+            logger.exception('Error detecting the type of %s', self.file_name)
+        virus = None
+        if self.scan is not None:
+            try:
+                virus = self.scan.result(self.path)
+            except Exception:
+                os.remove(self.path)
+                raise
+        return ScannedUploadedFile(self.path, self.file_name, self.content_type, file_size, self.charset,
+                                   self.content_type_extra, scanned=self.scan is not None, virus=virus,
+                                   mime_type=self.mime_type, file_type=self.file_type,
+                                   digest=self.hasher.hexdigest())
+
+    def upload_interrupted(self):
+        if hasattr(self, 'file'):
+            self.file.close()
+            if self.scan is not None:
+                self.scan.abort()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from attachments.models import Attachment
+from attachments.utils import detect_file_type, get_hasher
+
+from concurrent.futures import ThreadPoolExecutor
+
+import time
+
+
+def read_file(storage, file_path, digest=None, block_size=1024 * 1024):
+    """
+    Returns the (digest, mime_type) of a stored file, reading it once. When the digest is already known, only the
+    start of the file is read.
+    """
+    hasher = get_hasher()
+    mime_type = ''
+    with storage.open(file_path) as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            if not mime_type:
+                mime_type = detect_file_type(buffer=block)[0]
+            if digest:
+                break
+            hasher.update(block)
+    return digest or hasher.hexdigest(), mime_type
+
+
+class Command (BaseCommand):
+    help = 'Computes the digest and MIME type of attachments that were stored before they were recorded.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='Number of files to read at once.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of attachments to read, then update in one transaction.')
+        parser.add_argument('--all', action='store_true', default=False, help='Recompute every attachment, not only blank ones.')
+
+    def handle(self, *args, **options):
+        queryset = Attachment.objects.all()
+        if not options['all']:
+            queryset = queryset.filter(Q(digest='') | Q(mime_type=''))
+        queryset = queryset.select_related('blob').order_by('pk')
+        updated = failed = 0
+        started = time.time()
+        last_pk = 0
+
+        def process(attachment):
+            # Deduplicated attachments already know their digest, so only the type needs sniffing.
+            try:
+                known = attachment.blob.digest if attachment.blob_id else None
+                digest, mime_type = read_file(attachment.get_storage(), attachment.file_path, digest=known)
+            except Exception as ex:
+                return attachment, None, None, ex
+            return attachment, digest, mime_type, None
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                batch = list(queryset.filter(pk__gt=last_pk)[:options['batch_size']])
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+                # Read the files before opening the transaction, which then only holds its locks for the updates.
+                read = []
+                for attachment, digest, mime_type, error in executor.map(process, batch):
+                    if error is not None:
+                        failed += 1
+                        self.stderr.write('Could not read %s (pk=%s): %s' % (attachment.file_path, attachment.pk, error))
+                        continue
+                    attachment.digest, attachment.mime_type = digest, mime_type
+                    read.append(attachment)
+                with transaction.atomic():
+                    Attachment.objects.bulk_update(read, ['digest', 'mime_type'])
+                updated += len(read)
+                if options['verbosity'] > 1:
+                    self.stdout.write('%d attachments updated' % updated)
+        self.stdout.write('Updated %d attachments (%d failed) in %.1fs' % (updated, failed, time.time() - started))
@@ -0,0 +1,109 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from attachments.models import Session, Upload
+from attachments.utils import CHUNKED_FILE_PREFIX, TEMP_FILE_PREFIX, get_temp_dir
+
+from concurrent.futures import ThreadPoolExecutor
+
+import datetime
+import errno
+import os
+import time
+
+
+def unlink(path):
+    """
+    Removes a file, returning whether it existed.
+    """
+    try:
+        os.remove(path)
+        return True
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+        return False
+
+
+class Command (BaseCommand):
+    help = 'Deletes abandoned upload sessions, and temporary files that no longer belong to an upload.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=24, help='Delete sessions (and temp files) older than this.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of sessions to delete per transaction.')
+        parser.add_argument('--workers', type=int, default=8, help='Number of files to remove at once.')
+        parser.add_argument('--no-sweep', action='store_false', dest='sweep', default=True,
+                            help='Do not look for orphaned files in ATTACHMENT_TEMP_DIR.')
+
+    def handle(self, *args, **options):
+        started = time.time()
+        self.verbosity = options['verbosity']
+        cutoff = timezone.now() - datetime.timedelta(hours=options['hours'])
+        self.sessions = self.uploads = self.removed = self.orphans = self.errors = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            self.delete_sessions(executor, cutoff, options['batch_size'])
+            if options['sweep'] and not getattr(settings, 'ATTACHMENT_TEMP_DIR', None):
+                # Without a dedicated directory, temp files go in the system temp dir, which isn't ours to sweep.
+                self.stderr.write('Not looking for orphaned temp files, since ATTACHMENT_TEMP_DIR is not set.')
+            elif options['sweep']:
+                self.sweep(executor, time.time() - options['hours'] * 3600, options['batch_size'])
+        self.stdout.write('Deleted %d sessions and %d uploads, removed %d temp files (%d orphaned, %d errors) in %.1fs' % (
+            self.sessions, self.uploads, self.removed, self.orphans, self.errors, time.time() - started))
+
+    def remove(self, executor, paths):
+        # Temp files are only removed once their rows are gone, so an error here never leaves a dangling Upload.
+        futures = [executor.submit(unlink, path) for path in paths]
+        removed = 0
+        for path, future in zip(paths, futures):
+            try:
+                removed += future.result()
+            except OSError as ex:
+                self.errors += 1
+                self.stderr.write('Could not remove %s: %s' % (path, ex))
+        return removed
+
+    def delete_sessions(self, executor, cutoff, batch_size):
+        while True:
+            with transaction.atomic():
+                pks = list(Session.objects.filter(date_created__lt=cutoff).values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    return
+                uploads = Upload.objects.filter(session__in=pks)
+                paths = list(uploads.values_list('file_path', flat=True))
+                uploads.delete()
+                Session.objects.filter(pk__in=pks).delete()
+            self.sessions += len(pks)
+            self.uploads += len(paths)
+            self.removed += self.remove(executor, paths)
+            if self.verbosity > 1:
+                self.stdout.write('%d sessions deleted' % self.sessions)
+
+    def sweep(self, executor, cutoff, batch_size):
+        # Files younger than the cutoff may belong to uploads that are still in progress (the temp file is written
+        # before its Upload row, and chunked uploads are only recorded once complete).
+        candidates = []
+        for root, _dirs, files in os.walk(get_temp_dir()):
+            for name in files:
+                if not name.startswith((TEMP_FILE_PREFIX, CHUNKED_FILE_PREFIX)):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) >= cutoff:
+                        continue
+                except OSError:
+                    continue
+                candidates.append(path)
+                if len(candidates) >= batch_size:
+                    self.remove_orphans(executor, candidates)
+                    candidates = []
+        if candidates:
+            self.remove_orphans(executor, candidates)
+
+    def remove_orphans(self, executor, paths):
+        used = set(Upload.objects.filter(file_path__in=paths).values_list('file_path', flat=True))
+        orphans = [path for path in paths if path not in used]
+        removed = self.remove(executor, orphans)
+        self.orphans += removed
+        self.removed += removed
@@ -0,0 +1,89 @@
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+
+from attachments.deletion import delete_files
+from attachments.models import Attachment
+from attachments.routers import route
+from attachments.utils import get_storage
+
+from concurrent.futures import ThreadPoolExecutor
+
+import time
+
+
+def copy_file(attachment, target):
+    """
+    Copies an attachment's file to the named target storage, returning the name it was saved under there.
+    """
+    with attachment.get_storage().open(attachment.file_path) as fp:
+        return get_storage(target).save(attachment.file_path, File(fp, name=attachment.file_name))
+
+
+class Command (BaseCommand):
+    help = 'Moves attachment files between storages, either to a given storage or wherever the storage router says.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', dest='target', help='The storage to move files to.')
+        parser.add_argument('--route', action='store_true', default=False,
+                            help='Move files to the storage the router picks for them.')
+        parser.add_argument('--from', dest='source', help='Only move files that are currently in this storage.')
+        parser.add_argument('--context', help='Only move attachments with this context.')
+        parser.add_argument('--workers', type=int, default=4, help='Number of files to copy at once.')
+        parser.add_argument('--batch-size', type=int, default=200, help='Number of attachments to load at once.')
+        parser.add_argument('--keep', action='store_true', default=False,
+                            help='Leave the original files in place.')
+
+    def handle(self, *args, **options):
+        if bool(options['target']) == bool(options['route']):
+            raise CommandError('Specify exactly one of --to or --route.')
+        if options['target']:
+            get_storage(options['target'])
+        started = time.time()
+        # Shared (deduplicated) files are referenced by more than one attachment, so they can't be moved one at a time.
+        queryset = Attachment.objects.filter(blob__isnull=True).order_by('pk')
+        if options['source']:
+            queryset = queryset.filter(storage=options['source'])
+        if options['context'] is not None:
+            queryset = queryset.filter(context=options['context'])
+        if options['route']:
+            queryset = queryset.prefetch_related('content_object')
+        moved = failed = 0
+        last_pk = 0
+
+        def move(attachment):
+            target = options['target'] or route(attachment.content_object, attachment.context, attachment.file_name,
+                                                attachment.file_size, attachment.mime_type)
+            if target == attachment.storage:
+                return attachment, target, None, None
+            try:
+                return attachment, target, copy_file(attachment, target), None
+            except Exception as ex:
+                return attachment, target, None, ex
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                batch = list(queryset.filter(pk__gt=last_pk)[:options['batch_size']])
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+                for attachment, target, new_path, error in executor.map(move, batch):
+                    if error is not None:
+                        failed += 1
+                        self.stderr.write('Could not move %s (pk=%s) to %s: %s' % (
+                            attachment.file_path, attachment.pk, target, error))
+                        continue
+                    if new_path is None:
+                        continue
+                    # Only switch the row over if nothing else changed it while the file was being copied.
+                    updated = Attachment.objects.filter(pk=attachment.pk, storage=attachment.storage,
+                                                        file_path=attachment.file_path).update(storage=target,
+                                                                                              file_path=new_path)
+                    if updated:
+                        moved += 1
+                        if not options['keep']:
+                            delete_files([attachment.file_path], attachment.get_storage())
+                    else:
+                        delete_files([new_path], get_storage(target))
+                if options['verbosity'] > 1:
+                    self.stdout.write('%d attachments moved' % moved)
+        self.stdout.write('Moved %d attachments (%d failed) in %.1fs' % (moved, failed, time.time() - started))
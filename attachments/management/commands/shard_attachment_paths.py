@@ -0,0 +1,117 @@
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.files import File
+from django.core.management.base import BaseCommand
+
+from attachments.deletion import delete_files
+from attachments.models import Attachment
+from attachments.utils import get_object_dir, make_storage_directory
+
+from concurrent.futures import ThreadPoolExecutor
+
+import errno
+import os
+import time
+
+
+def sharded_path(attachment, shards):
+    """
+    Returns where an attachment's file belongs in the sharded layout, or None if it isn't stored under the unsharded
+    default layout (custom paths are left alone). The file name, including any suffix added to avoid a collision, is
+    kept as is.
+    """
+    ct = ContentType.objects.get_for_id(attachment.content_type_id)
+    # Not posixpath.split, which would strip the trailing slash left by an empty context.
+    directory, _sep, name = attachment.file_path.rpartition('/')
+    if directory != get_object_dir(ct, attachment.object_id, attachment.context, shards=0):
+        return None
+    return '%s/%s' % (get_object_dir(ct, attachment.object_id, attachment.context, shards=shards), name)
+
+
+def _link(storage, old_path, new_path):
+    # On local storage, hard link the file into place rather than copying it. Linking fails instead of overwriting
+    # when the name is taken, which makes picking an available name race-free.
+    make_storage_directory(storage, os.path.dirname(storage.path(new_path)))
+    for _i in range(5):
+        available = storage.get_available_name(new_path)
+        try:
+            os.link(storage.path(old_path), storage.path(available))
+            if storage.file_permissions_mode is not None:
+                # The link shares the original's mode, which may predate the storage's file_permissions_mode.
+                os.chmod(storage.path(available), storage.file_permissions_mode)
+            return available
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+    raise OSError(errno.EEXIST, 'Could not find an available name for %s' % new_path)
+
+
+def move_file(storage, old_path, new_path):
+    """
+    Puts a copy of the file at old_path in storage at new_path (or the next available name), returning the name used.
+    The original is left in place.
+    """
+    try:
+        storage.path(old_path)
+    except NotImplementedError:
+        with storage.open(old_path) as fp:
+            return storage.save(new_path, File(fp))
+    return _link(storage, old_path, new_path)
+
+
+class Command (BaseCommand):
+    help = 'Moves attachment files stored under the default layout into the sharded layout (ATTACHMENT_PATH_SHARDS).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', type=int, default=None,
+                            help='Number of directory levels to shard into (defaults to ATTACHMENT_PATH_SHARDS).')
+        parser.add_argument('--workers', type=int, default=8, help='Number of files to move at once.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of attachments to load at once.')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report how many files would be moved.')
+
+    def handle(self, *args, **options):
+        shards = options['shards'] if options['shards'] is not None else getattr(settings, 'ATTACHMENT_PATH_SHARDS', 0)
+        if not shards:
+            self.stdout.write('Nothing to do: ATTACHMENT_PATH_SHARDS is not set.')
+            return
+        started = time.time()
+        # Deduplicated files are already stored by digest, in their own sharded directories.
+        queryset = Attachment.objects.filter(blob__isnull=True).order_by('pk')
+        moved = failed = skipped = 0
+        last_pk = 0
+
+        def move(attachment):
+            new_path = sharded_path(attachment, shards)
+            if new_path is None or options['dry_run']:
+                return attachment, new_path, None
+            try:
+                return attachment, move_file(attachment.get_storage(), attachment.file_path, new_path), None
+            except Exception as ex:
+                return attachment, new_path, ex
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                batch = list(queryset.filter(pk__gt=last_pk)[:options['batch_size']])
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+                for attachment, new_path, error in executor.map(move, batch):
+                    if new_path is None:
+                        skipped += 1
+                    elif error is not None:
+                        failed += 1
+                        self.stderr.write('Could not move %s (pk=%s): %s' % (attachment.file_path, attachment.pk, error))
+                    elif options['dry_run']:
+                        moved += 1
+                    elif Attachment.objects.filter(pk=attachment.pk, file_path=attachment.file_path).update(
+                            file_path=new_path):
+                        moved += 1
+                        delete_files([attachment.file_path], attachment.get_storage())
+                    else:
+                        # The attachment changed while its file was being moved; leave it be.
+                        delete_files([new_path], attachment.get_storage())
+                if options['verbosity'] > 1:
+                    self.stdout.write('%d attachments moved' % moved)
+        self.stdout.write('%s %d attachments (%d skipped, %d failed) in %.1fs' % (
+            'Would move' if options['dry_run'] else 'Moved', moved, skipped, failed, time.time() - started))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attachments', '0012_auto_20180906_1449'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='mime_type',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='file_type',
+            field=models.TextField(blank=True),
+        ),
+    ]
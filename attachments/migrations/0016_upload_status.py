@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attachments', '0015_attachment_digest'),
+    ]
+
+    operations = [
+        # Existing uploads were processed when they were made.
+        migrations.AddField(
+            model_name='upload',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('scanning', 'Scanning'), ('clean', 'Clean'), ('rejected', 'Rejected')], db_index=True, default='clean', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='upload',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('scanning', 'Scanning'), ('clean', 'Clean'), ('rejected', 'Rejected')], db_index=True, default='pending', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='status_message',
+            field=models.TextField(blank=True),
+        ),
+    ]
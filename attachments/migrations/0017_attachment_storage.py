@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attachments', '0016_upload_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='storage',
+            field=models.CharField(db_index=True, default='default', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='blob',
+            name='storage',
+            field=models.CharField(default='default', max_length=100),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attachments', '0017_attachment_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Rendition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.CharField(max_length=50)),
+                ('file_path', models.TextField()),
+                ('file_size', models.IntegerField()),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('mime_type', models.CharField(max_length=200)),
+                ('storage', models.CharField(default='default', max_length=100)),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('attachment', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='renditions', to='attachments.Attachment')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='rendition',
+            unique_together=set([('attachment', 'size')]),
+        ),
+    ]
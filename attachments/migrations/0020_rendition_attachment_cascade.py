@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def delete_orphaned_renditions(apps, schema_editor):
+    # Renditions of attachments that were deleted without them would violate the new foreign key constraint. Their
+    # files, if any are left, are only thumbnails and can be removed from storage by hand.
+    Attachment = apps.get_model('attachments', 'Attachment')
+    Rendition = apps.get_model('attachments', 'Rendition')
+    db_alias = schema_editor.connection.alias
+    Rendition.objects.using(db_alias).exclude(
+        attachment__in=Attachment.objects.using(db_alias).values('pk')).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attachments', '0019_upload_date_claimed'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_orphaned_renditions, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='rendition',
+            name='attachment',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='renditions', to='attachments.Attachment'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attachments', '0020_rendition_attachment_cascade'),
+    ]
+
+    operations = [
+        # Restores the uniqueness dropped in 0014, except for attachments sharing a Blob's file.
+        migrations.AddConstraint(
+            model_name='attachment',
+            constraint=models.UniqueConstraint(condition=models.Q(blob__isnull=True), fields=('file_path',), name='attachments_unshared_file_path'),
+        ),
+    ]
@@ -1,26 +1,36 @@
 from __future__ import unicode_literals
 
-from django.utils.encoding import python_2_unicode_compatible
+from six import python_2_unicode_compatible
 from .signals import attachments_attached
 from .utils import get_context_key, get_storage, get_default_path, JSONField, import_class
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.core.files import File
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.urls import reverse
 from django.utils import timezone
-from django.utils.encoding import python_2_unicode_compatible
+from django.utils.encoding import force_str
 from django.utils.safestring import mark_safe
+import six
 
+from .cache import get_properties, invalidate_properties
+from .deletion import delete_orphaned_attachments, delete_rendition_file, remove_temp_files, schedule_deletion
+from .renditions import can_render, precompute_renditions
+from .routers import resolve_storage
 from .signals import attachments_attached
-from .utils import JSONField, get_context_key, get_default_path, get_storage, import_class
+from .utils import (
+    JSONField, UploadPolicy, detect_file_type, get_blob_path, get_context_key, get_default_path, get_hasher,
+    get_object_dir, get_storage, import_class, promote_file)
 
-import os
-import magic
+import collections
+import logging
 import mimetypes
 
 
+logger = logging.getLogger(__name__)
+
+
 FIELD_TYPE_CHOICES = (
     ('string', 'Text'),
     ('text', 'Large Text'),
@@ -33,32 +43,167 @@ FIELD_TYPE_CHOICES = (
     ('model', 'Model')
 )
 
+UPLOAD_STATUS_CHOICES = (
+    ('pending', 'Pending'),
+    ('scanning', 'Scanning'),
+    ('clean', 'Clean'),
+    ('rejected', 'Rejected'),
+)
+
+
+def deduplicate():
+    return getattr(settings, 'ATTACHMENT_DEDUPLICATE', False)
+
+
+def _group_paths(files):
+    # Groups (storage name, path) pairs into a dict of storage name -> [path, ...].
+    grouped = collections.OrderedDict()
+    for name, path in files:
+        grouped.setdefault(name, []).append(path)
+    return grouped
+
+
+class BlobManager (models.Manager):
+
+    def acquire(self, storage, digest, size, content, storage_name='default'):
+        """
+        Returns a (Blob, promotion) tuple for a file with the given digest, adding a reference to the Blob if it
+        already exists (promotion is then 'dedup'), wherever it is stored. Otherwise content, either a path on disk or
+        a File, is stored in storage (named storage_name) under the blob path for digest (see utils.promote_file for
+        the promotion).
+        """
+        if self.filter(digest=digest).update(ref_count=models.F('ref_count') + 1):
+            return self.get(digest=digest), 'dedup'
+        if isinstance(content, six.string_types):
+            name, promotion = promote_file(storage, get_blob_path(digest), content)
+        else:
+            name, promotion = storage.save(get_blob_path(digest), content), 'copy'
+        try:
+            with transaction.atomic():
+                return self.create(digest=digest, file_path=name, file_size=size, ref_count=1,
+                                   storage=storage_name), promotion
+        except IntegrityError:
+            # The same contents were stored concurrently, so use that copy instead.
+            storage.delete(name)
+            if self.filter(digest=digest).update(ref_count=models.F('ref_count') + 1):
+                return self.get(digest=digest), 'dedup'
+            raise
+
+    def release(self, blob_id):
+        """
+        Removes a reference to a Blob, deleting it (and its file) when there are none left.
+        """
+        self.release_many({blob_id: 1})
+
+    def release_many(self, counts):
+        """
+        Removes references to Blobs, given a dict of Blob ID to the number of references to remove. Blobs with no
+        references left are deleted, and their files are removed from storage when the transaction commits.
+        """
+        if not counts:
+            return
+        with transaction.atomic(using=self.db):
+            unused = []
+            for blob in self.select_for_update().filter(pk__in=list(counts)):
+                if blob.ref_count > counts[blob.pk]:
+                    self.filter(pk=blob.pk).update(ref_count=models.F('ref_count') - counts[blob.pk])
+                else:
+                    unused.append(blob)
+            if unused:
+                self.filter(pk__in=[blob.pk for blob in unused]).delete()
+                for name, paths in _group_paths((blob.storage, blob.file_path) for blob in unused).items():
+                    schedule_deletion(paths, get_storage(name), using=self.db)
+
+
+@python_2_unicode_compatible
+class Blob (models.Model):
+    """
+    A file stored once, by digest, and shared by every Attachment with the same contents (when ATTACHMENT_DEDUPLICATE
+    is set). The file is deleted along with the last Attachment referencing it.
+    """
+    digest = models.CharField(max_length=128, unique=True)
+    file_path = models.TextField()
+    file_size = models.IntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    # The name of the storage (see utils.get_storage) the file is in.
+    storage = models.CharField(max_length=100, default='default')
+    date_created = models.DateTimeField(default=timezone.now, editable=False)
 
-class AttachmentManager (models.Manager):
+    objects = BlobManager()
+
+    def __str__(self):
+        return self.digest
+
+
+class AttachmentQuerySet (models.QuerySet):
+
+    def delete(self):
+        """
+        Deletes the attachments (and their renditions) and removes their files from storage once the transaction
+        commits.
+        """
+        with transaction.atomic(using=self.db):
+            files = list(self.values_list('file_path', 'blob', 'storage'))
+            result = super(AttachmentQuerySet, self).delete()
+            blob_ids = collections.Counter(blob_id for path, blob_id, name in files if blob_id is not None)
+            Blob.objects.db_manager(self.db).release_many(blob_ids)
+            unshared = _group_paths([(name, path) for path, blob_id, name in files if blob_id is None])
+            for name, paths in unshared.items():
+                schedule_deletion(paths, get_storage(name), using=self.db)
+        return result
+
+    delete.queryset_only = True
+
+
+class AttachmentManager (models.Manager.from_queryset(AttachmentQuerySet)):
 
     def attach_raw(self, f, obj, user=None, context='', storage=None, path=None, data=None):
-        if storage is None:
-            storage = get_storage()
-        if path is None:
-            ct = ContentType.objects.get_for_model(obj)
-            path = '%s/%s/%s/%s/%s' % (ct.app_label, ct.model, obj.pk, context, f.name)
-        new_path = storage.save(path, f)
+        # Hash the file and sniff its type before storing it, since the storage may not be able to read it back cheaply.
+        hasher = get_hasher()
+        mime_type = ''
+        for chunk in f.chunks():
+            if not mime_type:
+                mime_type = detect_file_type(buffer=chunk)[0]
+            hasher.update(chunk)
+        f.seek(0)
+        storage_name, storage = resolve_storage(storage, obj, context, f.name, f.size, mime_type)
+        blob = None
+        if deduplicate():
+            blob, _promotion = Blob.objects.acquire(storage, hasher.hexdigest(), f.size, f, storage_name)
+            new_path = blob.file_path
+            storage_name = blob.storage
+        else:
+            if path is None:
+                path = '%s/%s' % (get_object_dir(ContentType.objects.get_for_model(obj), obj.pk, context), f.name)
+            new_path = storage.save(path, f)
         return self.create(
             file_path=new_path,
             file_name=f.name,
             file_size=f.size,
+            digest=hasher.hexdigest(),
+            mime_type=mime_type,
+            storage=storage_name,
             user=user,
             context=context,
             data=data,
-            content_object=obj
+            content_object=obj,
+            blob=blob
         )
 
 
 @python_2_unicode_compatible
 class Attachment (models.Model):
-    file_path = models.TextField(unique=True)
+    file_path = models.TextField()
     file_name = models.CharField(max_length=200)
     file_size = models.IntegerField()
+    # Set when the file is shared with other attachments (see Blob), in which case file_path is the blob's.
+    blob = models.ForeignKey(Blob, related_name='attachments', null=True, blank=True, on_delete=models.PROTECT)
+    # Carried over from the Upload, so finding duplicates, checking integrity, and serving the file don't need to read
+    # it. Blank for attachments made before these were recorded (see the backfill_attachment_digests command).
+    digest = models.CharField(max_length=128, blank=True, db_index=True)
+    mime_type = models.CharField(max_length=200, blank=True, db_index=True)
+    # The name of the storage (see utils.get_storage) the file is in, as chosen by the storage router.
+    storage = models.CharField(max_length=100, default='default', db_index=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='attachments', null=True, blank=True, on_delete=models.SET_NULL)
     context = models.CharField(max_length=200, blank=True, db_index=True)
     date_created = models.DateTimeField(default=timezone.now, editable=False)
@@ -72,15 +217,46 @@ class Attachment (models.Model):
 
     objects = AttachmentManager()
 
+    class Meta:
+        constraints = [
+            # Attachments sharing a Blob share its file, but no two others may point at the same one.
+            models.UniqueConstraint(fields=['file_path'], condition=models.Q(blob__isnull=True),
+                                    name='attachments_unshared_file_path'),
+        ]
+
     def __str__(self):
         return self.file_name
 
     def delete(self, **kwargs):
-        try:
-            get_storage().delete(self.file_path)
-        except Exception:
-            pass
-        super(Attachment, self).delete(**kwargs)
+        with transaction.atomic(using=kwargs.get('using')):
+            result = super(Attachment, self).delete(**kwargs)
+            if self.blob_id is not None:
+                Blob.objects.db_manager(kwargs.get('using') or self._state.db).release(self.blob_id)
+            else:
+                schedule_deletion([self.file_path], self.get_storage(), using=kwargs.get('using'))
+        return result
+
+    def get_storage(self):
+        return get_storage(self.storage)
+
+    def get_content_type(self):
+        """
+        Returns the MIME type files are served as, guessed from the file name. The type detected from the contents
+        (mime_type) isn't used for this, since serving, say, a .txt file containing HTML as text/html would let anyone
+        who can upload run scripts in the site's origin. Names that don't imply a type are served as binary data.
+        """
+        return mimetypes.guess_type(self.file_name, strict=False)[0] or 'application/octet-stream'
+
+    def get_thumbnail_url(self, size='thumbnail'):
+        """
+        Returns the URL of a rendition (see attachments.renditions) of this attachment, or None if it can't have one.
+        """
+        if not can_render(self.mime_type or self.get_content_type()):
+            return None
+        return reverse('attachment-thumbnail', kwargs={
+            'attach_id': self.pk,
+            'size': size,
+        })
 
     def get_absolute_url(self):
         show_filenames = getattr(settings, 'ATTACHMENT_URL_FILENAMES', True)
@@ -114,18 +290,80 @@ class Attachment (models.Model):
         return data
 
     def get_properties(self):
-        return Property.objects.filter(content_type=self.content_type)
+        # ContentTypeManager caches by ID, so this avoids a query for the content_type foreign key.
+        return get_properties(ContentType.objects.get_for_id(self.content_type_id))
 
     def get_field(self, prop):
         """
             Added for use in bootstrap's template tag render_value. Returns tuple of property label and value
         """
         if prop.data_type == 'model' and prop.slug in self.data:
+            values = getattr(self, '_property_values', None)
+            if values is not None and prop.slug in values:
+                return prop.label, values[prop.slug]
             return prop.label, prop.model_queryset.get(pk=self.data.get(prop.slug, [])[0])
         else:
             return prop.label, self.data.get(prop.slug, [])
 
 
+@python_2_unicode_compatible
+class Rendition (models.Model):
+    """
+    A thumbnail or preview of an Attachment at one of the ATTACHMENT_RENDITION_SIZES (see attachments.renditions),
+    stored alongside the original.
+    """
+    # Renditions are deleted along with their attachment, however it's deleted, and their files are then removed by
+    # deletion.delete_rendition_file.
+    attachment = models.ForeignKey(Attachment, related_name='renditions', on_delete=models.CASCADE)
+    size = models.CharField(max_length=50)
+    file_path = models.TextField()
+    file_size = models.IntegerField()
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    mime_type = models.CharField(max_length=200)
+    # The name of the storage (see utils.get_storage) the file is in, which is always the attachment's.
+    storage = models.CharField(max_length=100, default='default')
+    date_created = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        unique_together = ('attachment', 'size')
+
+    def __str__(self):
+        return '%s (%s)' % (self.file_path, self.size)
+
+    def get_storage(self):
+        return get_storage(self.storage)
+
+
+def prefetch_property_values(attachments):
+    """
+    Loads the lookup model instances referenced by the model-typed properties of the given attachments, using one
+    in_bulk query per lookup model, so Attachment.get_field doesn't need a query per property per attachment. Returns
+    the attachments as a list.
+    """
+    attachments = list(attachments)
+    # Lookup model path -> (queryset, set of primary keys, [(attachment, slug, pk), ...])
+    lookups = {}
+    for attachment in attachments:
+        attachment._property_values = {}
+        if not attachment.data:
+            continue
+        for prop in attachment.get_properties():
+            if prop.data_type != 'model' or not attachment.data.get(prop.slug):
+                continue
+            if prop.model not in lookups:
+                lookups[prop.model] = (prop.model_queryset, set(), [])
+            pk = attachment.data[prop.slug][0]
+            lookups[prop.model][1].add(pk)
+            lookups[prop.model][2].append((attachment, prop.slug, pk))
+    for queryset, pks, values in lookups.values():
+        objects = dict((force_str(pk), obj) for pk, obj in queryset.in_bulk(list(pks)).items())
+        for attachment, slug, pk in values:
+            if force_str(pk) in objects:
+                attachment._property_values[slug] = objects[force_str(pk)]
+    return attachments
+
+
 @python_2_unicode_compatible
 class Property (models.Model):
     label = models.CharField(max_length=200)
@@ -179,9 +417,11 @@ class Session (models.Model):
         return self.uuid
 
     def delete(self, **kwargs):
-        for upload in self.uploads.all():
-            upload.delete()
+        # Delete the uploads with a single query, then remove their temp files.
+        paths = list(self.uploads.values_list('file_path', flat=True))
+        self.uploads.all().delete()
         super(Session, self).delete(**kwargs)
+        remove_temp_files(paths, using=kwargs.get('using'))
 
     def get_absolute_url(self):
         return reverse('attach', kwargs={
@@ -203,40 +443,131 @@ class Session (models.Model):
         if save:
             self.save()
 
+    def update_data(self, values):
+        """
+        Merges values into the stored session data. The session row is locked while doing so, so that concurrent
+        uploads to the same session don't lose each other's keys.
+        """
+        with transaction.atomic():
+            locked = Session.objects.select_for_update().only('data').get(pk=self.pk)
+            data = locked.data or {}
+            data.update(values)
+            Session.objects.filter(pk=self.pk).update(data=data)
+        self.data = data
+
     def hidden_input(self):
         return mark_safe('<input type="hidden" name="%s" value="%s" />' % (get_context_key(self.context), self.uuid))
 
-    def attach(self, obj, storage=None, path=None, data=None, send_signal=True):
+    def attach(self, obj, storage=None, path=None, data=None, send_signal=True, bulk=False):
+        """
+        Stores each upload in this session and attaches it to obj. With bulk=True, the Attachment rows are inserted
+        using a single bulk_create inside one transaction, which keeps the number of queries constant however many
+        files were uploaded. Note that bulk_create does not send pre_save/post_save signals for the new rows.
+
+        When ATTACHMENT_DEDUPLICATE is set, files are stored by digest instead of under path, and files that are
+        already stored are shared rather than copied again (see Blob).
+
+        Unless a storage is given, each file goes to the storage picked by the storage router (see routers.py).
+        """
         attached = []
-        if storage is None:
-            storage = get_storage()
         if path is None:
             path = get_default_path
-        for upload in self.uploads.all():
-            with open(upload.file_path, 'rb') as fp:
-                new_path = storage.save(path(upload, obj), File(fp))
+        uploads = list(self.uploads.all())
+        if any(upload.status in (Upload.STATUS_PENDING, Upload.STATUS_SCANNING) for upload in uploads):
+            # Don't wait for the processing queue to get to these.
+            from .processing import wait_for_uploads
+            wait_for_uploads(self)
+            uploads = list(self.uploads.all())
+        try:
+            for upload in uploads:
+                if upload.status == Upload.STATUS_REJECTED:
+                    continue
                 att_data = data(upload) if data else upload.extract_data(self._request)
-                attached.append(Attachment.objects.create(
-                    file_path=new_path,
-                    file_name=upload.file_name,
-                    file_size=upload.file_size,
-                    user=self.user,
-                    context=self.context,
-                    data=att_data,
-                    content_object=obj
-                ))
+                if bulk:
+                    attachment = self._store_upload(upload, obj, storage, path, att_data)
+                else:
+                    # Take the blob reference (if any) in the same transaction as saving the Attachment recording it,
+                    # so a failed save doesn't leave the blob referenced forever.
+                    with transaction.atomic():
+                        attachment = self._store_upload(upload, obj, storage, path, att_data)
+                        attachment.save()
+                attached.append(attachment)
+            if bulk and attached:
+                with transaction.atomic():
+                    Attachment.objects.bulk_create(attached)
+        except Exception:
+            if bulk:
+                # Nothing was recorded, so don't leave the stored files behind.
+                for attachment in attached:
+                    if attachment.blob_id is not None:
+                        Blob.objects.release(attachment.blob_id)
+                        continue
+                    try:
+                        attachment.get_storage().delete(attachment.file_path)
+                    except Exception:
+                        pass
+            raise
+        if bulk and attached and attached[0].pk is None:
+            # Not every database returns primary keys from a bulk insert, so look them up in one query. Blobs may be
+            # shared, so match rows up in insertion order, taking the newest ones for each path.
+            pks = collections.defaultdict(list)
+            for pk, file_path in Attachment.objects.filter(
+                content_type=attached[0].content_type,
+                object_id=obj.pk,
+                file_path__in=[a.file_path for a in attached]
+            ).order_by('pk').values_list('pk', 'file_path'):
+                pks[file_path].append(pk)
+            counts = collections.Counter(a.file_path for a in attached)
+            for file_path in pks:
+                pks[file_path] = pks[file_path][-counts[file_path]:]
+            for attachment in attached:
+                attachment.pk = pks[attachment.file_path].pop(0)
         if send_signal:
             # Send a signal that attachments were attached. Pass what attachments were attached and to what object.
             attachments_attached.send(sender=self, obj=obj, attachments=attached)
         return attached
 
+    def _store_upload(self, upload, obj, storage, path, data):
+        """
+        Stores an upload's file (or takes a reference to the Blob already holding it) and returns the unsaved
+        Attachment for it.
+        """
+        storage_name, upload_storage = resolve_storage(storage, obj, self.context, upload.file_name, upload.file_size,
+                                                       upload.mime_type)
+        blob = None
+        if deduplicate() and upload.digest:
+            blob, promotion = Blob.objects.acquire(upload_storage, upload.digest, upload.file_size, upload.file_path,
+                                                   storage_name)
+            new_path = blob.file_path
+            storage_name = blob.storage
+        else:
+            new_path, promotion = promote_file(upload_storage, path(upload, obj), upload.file_path)
+        attachment = Attachment(
+            file_path=new_path,
+            file_name=upload.file_name,
+            file_size=upload.file_size,
+            digest=upload.digest,
+            mime_type=upload.mime_type,
+            storage=storage_name,
+            user=self.user,
+            context=self.context,
+            data=data,
+            content_object=obj,
+            blob=blob
+        )
+        # How the file was stored: 'link', 'reflink' or 'copy' (see utils.promote_file), or 'dedup'.
+        attachment.promotion = promotion
+        logger.debug('Attached %s to %r by %s', upload.file_name, obj, promotion)
+        return attachment
+
     def is_valid(self):
         if not self.content_type:
             return True
         from .forms import PropertyForm
         valids = []
+        shared = self.property_form_kwargs()
         for upload in self.uploads.all():
-            property_form = PropertyForm(self._request.POST, instance=upload, editable_only=False)
+            property_form = PropertyForm(self._request.POST, instance=upload, editable_only=False, **shared)
             valids.append(property_form.is_valid())
         # Commit the property data to the database
         self.set_data()
@@ -244,18 +575,31 @@ class Session (models.Model):
         self.bind_form_on_refresh = not is_valid
         return is_valid
 
+    def property_form_kwargs(self):
+        """
+        Returns the PropertyForm arguments that are the same for every upload in this session: the properties for the
+        session's content type, the decoded session data, and a dict for sharing lookup model choices between forms.
+        """
+        from .forms import PropertyForm
+        return {
+            'properties': get_properties(self.content_type),
+            'form_data': PropertyForm.get_form_data_from_session_data(self.data),
+            'model_choices': {},
+        }
+
     @property
     def upload_forms(self):
         from .forms import PropertyForm
         invalid_uploads = []
+        shared = self.property_form_kwargs()
+        is_bound = (self._request is not None and (self._request.method == 'POST' or self._request.GET.get('bind-form-data', False)))
         for upload in self.uploads.all():
             error_msg = self.validate_attachment(upload)
             if not error_msg:
-                kwargs = {'instance': upload, 'editable_only': False, }
-                is_bound = (self._request is not None and (self._request.method == 'POST' or self._request.GET.get('bind-form-data', False)))
+                kwargs = dict(shared, instance=upload, editable_only=False)
                 if is_bound:
-                    kwargs['data'] = PropertyForm.get_form_data_from_session_data(self.data)
-                property_form = PropertyForm(**kwargs)   
+                    kwargs['data'] = shared['form_data']
+                property_form = PropertyForm(**kwargs)
                 if self.data:
                     property_key_prefix = 'upload-{}-'.format(upload.pk)
                     for key in self.data:
@@ -269,35 +613,36 @@ class Session (models.Model):
         for invalid_upload in invalid_uploads:
             invalid_upload.delete()
 
+    @property
+    def upload_policy(self):
+        return UploadPolicy.get(self.allowed_file_extensions, self.allowed_file_types)
+
     def validate_attachment(self, upload):
-        if not self.allowed_file_extensions:
+        if upload.status == Upload.STATUS_REJECTED:
+            return upload.status_message
+        policy = self.upload_policy
+        if not policy:
             return ''
         # Checking if file extension is within allowed extension list
-        allowed_exts = self.allowed_file_extensions.split()
-        allowed_exts = [x if x.startswith('.') else '.{}'.format(x) for x in allowed_exts]
-        filename, ext = os.path.splitext(upload.file_name)
-        if ext not in allowed_exts:
+        if not policy.allows_extension(upload.file_name):
             error_msg = "{} - Error: Unsupported file format. Supported file formats are: {}".format(
-                upload.file_name, ', '.join(allowed_exts))
+                upload.file_name, ', '.join(policy.extensions))
             return error_msg
 
         # Checking whether file contents comply with the allowed file extensions (if the file has data).
         # This ensures that file types not allowed are rejected even if they are renamed.
         if upload.file_size != 0:
-            file_mime = magic.from_file(upload.file_path, mime=True)
-            if set(mimetypes.guess_all_extensions(file_mime)).isdisjoint(set(allowed_exts)):
+            file_mime, file_type = upload.get_file_type()
+            if not policy.allows_mime_type(file_mime):
                 # In case our check for extensions didn't pass we check if the file type (not mimetype)
                 # is white-listed. If so, we can allow the file to be uploaded.
-                allowed_types = self.allowed_file_types.split('\n')
-                file_type = magic.from_file(upload.file_path, mime=False)
-                if file_type not in allowed_types:
+                if not policy.allows_file_type(file_type):
                     error_msg = "{} - Error: The extension for this file is valid, but the content is not. Please verify the file content has been updated and save it again before attempting upload.".format(
                         upload.file_name)
                     return error_msg
         return ''
 
 
-
 @python_2_unicode_compatible
 class Upload (models.Model):
     session = models.ForeignKey(Session, related_name='uploads', on_delete=models.CASCADE)
@@ -305,16 +650,39 @@ class Upload (models.Model):
     file_name = models.CharField(max_length=200)
     file_size = models.IntegerField()
     date_created = models.DateTimeField(default=timezone.now)
+    # Detected from the file contents when it is uploaded, so validation doesn't need to read the file again.
+    mime_type = models.CharField(max_length=200, blank=True)
+    file_type = models.TextField(blank=True)
+    # The hex digest of the file contents, computed while it was received (see utils.get_hasher).
+    digest = models.CharField(max_length=128, blank=True)
+    # Where the upload is in post-upload processing (see attachments.processing), and why it was rejected, if it was.
+    status = models.CharField(max_length=20, choices=UPLOAD_STATUS_CHOICES, default='pending', db_index=True)
+    status_message = models.TextField(blank=True)
+    # When a worker last claimed the upload for processing, so uploads abandoned by a dead worker can be reclaimed.
+    date_claimed = models.DateTimeField(null=True, blank=True)
+
+    STATUS_PENDING = 'pending'
+    STATUS_SCANNING = 'scanning'
+    STATUS_CLEAN = 'clean'
+    STATUS_REJECTED = 'rejected'
 
     def __str__(self):
         return self.file_name
 
+    def get_file_type(self):
+        """
+        Returns the (mime_type, file_type) detected for this upload, detecting and saving them first for uploads that
+        were made before they were recorded.
+        """
+        if not self.mime_type:
+            self.mime_type, self.file_type = detect_file_type(self.file_path)
+            if self.pk:
+                Upload.objects.filter(pk=self.pk).update(mime_type=self.mime_type, file_type=self.file_type)
+        return self.mime_type, self.file_type
+
     def delete(self, **kwargs):
-        try:
-            os.remove(self.file_path)
-        except Exception:
-            pass
         super(Upload, self).delete(**kwargs)
+        remove_temp_files([self.file_path], using=kwargs.get('using'))
 
     def extract_data(self, request):
         data = {}
@@ -324,3 +692,18 @@ class Upload (models.Model):
                 if key.startswith(prefix):
                     data[key[len(prefix):]] = request.POST.getlist(key)
         return data
+
+
+# Generate the renditions in ATTACHMENT_RENDITION_PRECOMPUTE for new attachments.
+attachments_attached.connect(precompute_renditions, dispatch_uid='attachments.precompute_renditions')
+post_delete.connect(delete_rendition_file, sender=Rendition, dispatch_uid='attachments.delete_rendition_file')
+
+# Keep the cached property definitions (see cache.get_properties) up to date.
+post_save.connect(invalidate_properties, sender=Property)
+post_delete.connect(invalidate_properties, sender=Property)
+m2m_changed.connect(invalidate_properties, sender=Property.content_type.through)
+
+# Optionally delete attachments along with the object they are attached to. This is only connected when asked for,
+# since a receiver for every model stops Django from deleting any rows without fetching them first.
+if getattr(settings, 'ATTACHMENT_DELETE_WITH_OBJECT', False):
+    post_delete.connect(delete_orphaned_attachments, dispatch_uid='attachments.delete_orphaned_attachments')
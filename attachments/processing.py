@@ -0,0 +1,175 @@
+"""
+Post-upload processing: virus scanning, type detection and hashing.
+
+By default (ATTACHMENT_PROCESSING = 'sync') uploads are processed during the upload request, and the response reports
+any problem. Otherwise uploads are recorded as pending and processed in the background, so the upload request only
+waits on the network; clients poll the upload-status URL until the upload is clean or rejected. ATTACHMENT_PROCESSING
+can be:
+
+* 'thread' or 'process', to use a pool of ATTACHMENT_PROCESSING_WORKERS threads or processes;
+* the dotted path to a function taking an Upload ID, for handing uploads to an external queue (the function, or the
+  task it queues, should call process_upload with the ID).
+
+Session.attach processes any uploads that are still pending itself, and waits for any being processed elsewhere, so
+attaching never has to wait on the queue. An upload that has been claimed for ATTACHMENT_PROCESSING_STALE_TIMEOUT
+seconds (300 by default) without being processed, say because its worker died, may be claimed and processed again.
+"""
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .exceptions import VirusFoundException
+from .scanning import scan_file
+from .signals import upload_processed
+from .utils import detect_file_type, file_digest, import_class
+from .workers import init_process
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import datetime
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def check_file(path, file_name, scanned=False, virus=None):
+    """
+    Makes sure a file was scanned for viruses when ATTACHMENTS_CLAMD is active. Infected files are moved to
+    ATTACHMENTS_QUARANTINE_PATH (or deleted), and VirusFoundException is raised.
+    """
+    if getattr(settings, 'ATTACHMENTS_CLAMD', False):
+        if not scanned:
+            virus = scan_file(path)
+        if virus is not None:
+            # if ATTACHMENTS_QUARANTINE_PATH is set, move the offending file to the quaranine, otherwise delete
+            if getattr(settings, 'ATTACHMENTS_QUARANTINE_PATH', False):
+                quarantine_path = os.path.join(getattr(settings, 'ATTACHMENTS_QUARANTINE_PATH'), os.path.basename(path))
+                os.rename(path, quarantine_path)
+            else:
+                os.remove(path)
+            raise VirusFoundException('**WARNING** virus %s found in the file %s, could not upload!' % (virus, file_name))
+
+
+def get_mode():
+    return getattr(settings, 'ATTACHMENT_PROCESSING', 'sync')
+
+
+def is_async():
+    return get_mode() != 'sync'
+
+
+def _claimable():
+    """
+    Returns a filter for the uploads waiting to be processed: pending ones, and ones whose processing was abandoned.
+    """
+    from .models import Upload
+    stale = timezone.now() - datetime.timedelta(seconds=getattr(settings, 'ATTACHMENT_PROCESSING_STALE_TIMEOUT', 300))
+    return Q(status=Upload.STATUS_PENDING) | (
+        Q(status=Upload.STATUS_SCANNING) & (Q(date_claimed__lt=stale) | Q(date_claimed__isnull=True))
+    )
+
+
+def process_upload(upload_id):
+    """
+    Processes a pending upload, marking it clean or rejected. Returns the Upload, or None if it was already claimed by
+    another worker (or no longer exists).
+    """
+    from .models import Upload
+    claimed = timezone.now()
+    claim = Upload.objects.filter(_claimable(), pk=upload_id)
+    if not claim.update(status=Upload.STATUS_SCANNING, date_claimed=claimed):
+        return None
+    upload = Upload.objects.get(pk=upload_id)
+    try:
+        check_file(upload.file_path, upload.file_name)
+        if not upload.mime_type:
+            upload.mime_type, upload.file_type = detect_file_type(upload.file_path)
+        if not upload.digest:
+            upload.digest = file_digest(upload.file_path)
+        upload.status = Upload.STATUS_CLEAN
+    except VirusFoundException as ex:
+        logger.warning(str(ex))
+        upload.status = Upload.STATUS_REJECTED
+        upload.status_message = str(ex)
+    except Exception as ex:
+        logger.exception('Error processing upload %s', upload_id)
+        upload.status = Upload.STATUS_REJECTED
+        upload.status_message = 'Error processing %s: %s' % (upload.file_name, ex)
+    # If this took so long that another worker reclaimed the upload, leave it to that one.
+    if not Upload.objects.filter(pk=upload_id, date_claimed=claimed).update(
+            status=upload.status, status_message=upload.status_message, mime_type=upload.mime_type,
+            file_type=upload.file_type or '', digest=upload.digest):
+        return None
+    upload_processed.send(sender=upload)
+    return upload
+
+
+def _run(upload_id):
+    try:
+        process_upload(upload_id)
+    except Exception:
+        logger.exception('Error processing upload %s', upload_id)
+    finally:
+        # Worker threads each hold their own connection, which Django's request cycle won't ever clean up.
+        close_old_connections()
+
+
+_executor = None
+_executor_mode = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor, _executor_mode
+    mode = get_mode()
+    with _executor_lock:
+        if _executor is None or _executor_mode != mode:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            workers = getattr(settings, 'ATTACHMENT_PROCESSING_WORKERS', 4)
+            if mode == 'process':
+                _executor = ProcessPoolExecutor(max_workers=workers, initializer=init_process)
+            else:
+                _executor = ThreadPoolExecutor(max_workers=workers)
+            _executor_mode = mode
+        return _executor
+
+
+def _dispatch(upload_id):
+    mode = get_mode()
+    if mode in ('thread', 'process'):
+        get_executor().submit(_run, upload_id)
+    else:
+        import_class(mode)(upload_id)
+
+
+def submit(upload):
+    """
+    Queues a pending upload for processing, once the transaction that created it commits.
+    """
+    transaction.on_commit(lambda: _dispatch(upload.pk))
+
+
+def wait_for_uploads(session, timeout=None):
+    """
+    Makes sure every upload in session has been processed: pending (or abandoned) uploads are processed right away, and
+    uploads being processed by a worker are waited on, for up to ATTACHMENT_PROCESSING_TIMEOUT seconds.
+    """
+    from .models import Upload
+    if timeout is None:
+        timeout = getattr(settings, 'ATTACHMENT_PROCESSING_TIMEOUT', 60)
+    deadline = time.time() + timeout
+    while True:
+        for upload_id in session.uploads.filter(_claimable()).values_list('pk', flat=True):
+            process_upload(upload_id)
+        if not session.uploads.filter(status__in=(Upload.STATUS_PENDING, Upload.STATUS_SCANNING)).exists():
+            return
+        if time.time() >= deadline:
+            raise Exception('Timed out waiting for uploads to be processed')
+        time.sleep(0.1)
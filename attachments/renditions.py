@@ -0,0 +1,269 @@
+"""
+Renditions: thumbnails and previews of attachments, so pages listing attachments can show them without downloading
+the originals. Sizes are named in ATTACHMENT_RENDITION_SIZES, a dict of name to (width, height) bounding box:
+
+    ATTACHMENT_RENDITION_SIZES = {
+        'thumbnail': (200, 200),
+        'preview': (1024, 1024),
+    }
+
+Images can be rendered when Pillow is installed. PDFs (their first page) also need pdftoppm, from poppler-utils, on
+the PATH or at ATTACHMENT_PDFTOPPM. Nothing else has renditions, and the attachment-thumbnail view returns a 404 for it.
+
+A rendition is generated the first time it's asked for, in a pool of ATTACHMENT_RENDITION_WORKERS processes (2 by
+default, or 0 to render in the calling thread), since decoding and resizing images is CPU bound. It is stored in the
+attachment's storage next to the original and recorded as a Rendition, so each size of each attachment is only ever
+generated once. Renditions are deleted along with their attachment.
+
+To generate renditions ahead of time, list size names in ATTACHMENT_RENDITION_PRECOMPUTE. They are then generated in
+the background once attachments are attached.
+"""
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, close_old_connections, transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+import six
+
+from .workers import init_process
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import calendar
+import hashlib
+import io
+import logging
+import posixpath
+import shutil
+import subprocess
+import tempfile
+import threading
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_sizes():
+    return getattr(settings, 'ATTACHMENT_RENDITION_SIZES', {'thumbnail': (200, 200)})
+
+
+def get_pdftoppm():
+    return getattr(settings, 'ATTACHMENT_PDFTOPPM', None) or shutil.which('pdftoppm')
+
+
+def can_render(mime_type):
+    """
+    Returns whether files of the given MIME type can have renditions.
+    """
+    if Image is None or not mime_type:
+        return False
+    if mime_type == 'application/pdf':
+        return bool(get_pdftoppm())
+    Image.init()
+    return mime_type in set(Image.MIME.values())
+
+
+def _open_pdf(source, size, pdftoppm):
+    # Render only the first page, scaled so its longest side is size pixels.
+    tmp = tempfile.mkdtemp()
+    try:
+        root = posixpath.join(tmp, 'page')
+        args = [pdftoppm, '-f', '1', '-l', '1', '-singlefile', '-png', '-scale-to', str(size)]
+        if isinstance(source, six.string_types):
+            subprocess.run(args + [source, root], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           timeout=60)
+        else:
+            subprocess.run(args + ['-', root], input=source, check=True, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, timeout=60)
+        image = Image.open(root + '.png')
+        image.load()
+        return image
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def render(source, mime_type, width, height, quality=85, pdftoppm=None):
+    """
+    Renders a file, given as a path on local disk or its contents, to an image fitting in width x height. Returns a
+    (data, width, height, mime type) tuple. This runs in the worker processes, so it shouldn't touch settings or the
+    database.
+    """
+    if mime_type == 'application/pdf':
+        image = _open_pdf(source, max(width, height), pdftoppm)
+    else:
+        image = Image.open(source if isinstance(source, six.string_types) else io.BytesIO(source))
+        # Let JPEGs be decoded at a reduced scale, which is much faster than decoding them whole.
+        image.draft('RGB', (width, height))
+        image = ImageOps.exif_transpose(image)
+    image.thumbnail((width, height), Image.LANCZOS)
+    out = io.BytesIO()
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image.convert('RGBA').save(out, 'PNG', optimize=True)
+        mime_type = 'image/png'
+    else:
+        image.convert('RGB').save(out, 'JPEG', quality=quality, optimize=True)
+        mime_type = 'image/jpeg'
+    return out.getvalue(), image.width, image.height, mime_type
+
+
+_executor = None
+_background = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=getattr(settings, 'ATTACHMENT_RENDITION_WORKERS', 2),
+                                            initializer=init_process)
+        return _executor
+
+
+def get_background_executor():
+    """
+    Returns the thread that precomputes renditions, handing the rendering itself to the process pool.
+    """
+    global _background
+    with _executor_lock:
+        if _background is None:
+            _background = ThreadPoolExecutor(max_workers=1)
+        return _background
+
+
+def rendition_path(attachment, size, mime_type):
+    extension = '.png' if mime_type == 'image/png' else '.jpg'
+    return posixpath.join(posixpath.dirname(attachment.file_path), 'renditions', size,
+                          '%s%s' % (attachment.pk, extension))
+
+
+def _store(attachment, size, result):
+    from .models import Rendition
+    data, width, height, mime_type = result
+    storage = attachment.get_storage()
+    name = storage.save(rendition_path(attachment, size, mime_type), ContentFile(data))
+    try:
+        with transaction.atomic():
+            return Rendition.objects.create(attachment=attachment, size=size, file_path=name, file_size=len(data),
+                                            width=width, height=height, mime_type=mime_type,
+                                            storage=attachment.storage)
+    except IntegrityError:
+        # The same rendition was generated concurrently, so use that one instead (if the attachment wasn't deleted in
+        # the meantime).
+        storage.delete(name)
+        return Rendition.objects.filter(attachment=attachment, size=size).first()
+
+
+def generate_renditions(attachments, sizes):
+    """
+    Generates any of the named sizes of attachments that don't exist yet, rendering them all at once in the process
+    pool. Returns a dict of (attachment ID, size) to Rendition for the renditions that were generated.
+    """
+    from .models import Rendition
+    attachments = [a for a in attachments if can_render(a.mime_type or a.get_content_type())]
+    existing = set(Rendition.objects.filter(attachment__in=[a.pk for a in attachments], size__in=list(sizes))
+                   .values_list('attachment_id', 'size'))
+    workers = getattr(settings, 'ATTACHMENT_RENDITION_WORKERS', 2)
+    options = {
+        'quality': getattr(settings, 'ATTACHMENT_RENDITION_QUALITY', 85),
+        'pdftoppm': get_pdftoppm(),
+    }
+    pending = []
+    for attachment in attachments:
+        missing = [size for size in sizes if (attachment.pk, size) not in existing]
+        if not missing:
+            continue
+        storage = attachment.get_storage()
+        try:
+            source = storage.path(attachment.file_path)
+        except NotImplementedError:
+            # The file isn't on local disk, so read it once for every size.
+            with storage.open(attachment.file_path) as fp:
+                source = fp.read()
+        for size in missing:
+            width, height = get_sizes()[size]
+            args = (source, attachment.mime_type or attachment.get_content_type(), width, height)
+            if workers:
+                result = get_executor().submit(render, *args, **options)
+            else:
+                result = None
+                try:
+                    result = render(*args, **options)
+                except Exception:
+                    logger.warning('Could not render %s (pk=%s) at size %s', attachment.file_name, attachment.pk, size,
+                                   exc_info=True)
+            pending.append((attachment, size, result))
+    generated = {}
+    for attachment, size, result in pending:
+        if workers:
+            try:
+                result = result.result()
+            except Exception:
+                logger.warning('Could not render %s (pk=%s) at size %s', attachment.file_name, attachment.pk, size,
+                               exc_info=True)
+                result = None
+        if result is not None:
+            generated[(attachment.pk, size)] = _store(attachment, size, result)
+    return generated
+
+
+def get_rendition(attachment, size):
+    """
+    Returns the Rendition of an attachment at the named size, generating it if needed, or None if the attachment
+    can't be rendered.
+    """
+    from .models import Rendition
+    try:
+        return Rendition.objects.get(attachment=attachment, size=size)
+    except Rendition.DoesNotExist:
+        return generate_renditions([attachment], [size]).get((attachment.pk, size))
+
+
+def serve_rendition(request, rendition):
+    """
+    Returns the response for an (already authorized) request for a rendition. Renditions never change, so browsers
+    may cache them for ATTACHMENT_RENDITION_MAX_AGE seconds (a day by default).
+    """
+    key = '%s:%s:%s' % (rendition.storage, rendition.file_path, rendition.date_created.isoformat())
+    etag = '"%s"' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+    last_modified = calendar.timegm(rendition.date_created.utctimetuple())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        with rendition.get_storage().open(rendition.file_path) as fp:
+            response = HttpResponse(fp.read(), content_type=rendition.mime_type)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['X-Content-Type-Options'] = 'nosniff'
+    # Renditions are only served to users with access to the attachment, so shared caches mustn't keep them.
+    patch_cache_control(response, private=True, max_age=getattr(settings, 'ATTACHMENT_RENDITION_MAX_AGE', 86400))
+    return response
+
+
+def _precompute(attachment_ids, sizes):
+    from .models import Attachment
+    try:
+        generate_renditions(Attachment.objects.filter(pk__in=attachment_ids), sizes)
+    except Exception:
+        logger.exception('Error generating renditions for attachments %s', attachment_ids)
+    finally:
+        # Like processing._run, the background thread's connection is never cleaned up by a request.
+        close_old_connections()
+
+
+def precompute_renditions(sender, attachments=None, **kwargs):
+    """
+    Connected to attachments_attached: queues the sizes in ATTACHMENT_RENDITION_PRECOMPUTE to be generated for newly
+    attached files, once the transaction attaching them commits.
+    """
+    sizes = list(getattr(settings, 'ATTACHMENT_RENDITION_PRECOMPUTE', ()))
+    if not sizes or not attachments:
+        return
+    attachment_ids = [a.pk for a in attachments if can_render(a.mime_type or a.get_content_type())]
+    if attachment_ids:
+        transaction.on_commit(lambda: get_background_executor().submit(_precompute, attachment_ids, sizes))
@@ -0,0 +1,105 @@
+"""
+Storage routing: picking which of the named storages (see utils.get_storage) a new attachment is stored in.
+
+The router is ATTACHMENT_STORAGE_ROUTER, the dotted path of a class with a storage_for method, or by default a
+RuleRouter using the rules in ATTACHMENT_STORAGE_ROUTES. For example, to keep small files on local disk and send large
+ones and anything attached to reports to object storage::
+
+    ATTACHMENT_STORAGES = {
+        'local': ('django.core.files.storage.FileSystemStorage', {'location': '/srv/attachments'}),
+        's3': ('storages.backends.s3boto3.S3Boto3Storage', {'bucket_name': 'attachments'}),
+    }
+    ATTACHMENT_STORAGE_ROUTES = [
+        {'content_type': 'reports.report', 'storage': 's3'},
+        {'max_size': 10 * 1024 * 1024, 'storage': 'local'},
+        {'storage': 's3'},
+    ]
+
+The storage chosen is recorded on each Attachment, so downloads and deletes use the right one even after the rules
+change.
+"""
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.signals import setting_changed
+
+from .utils import get_storage, get_storage_name, import_class
+
+import fnmatch
+import threading
+
+
+class RuleRouter (object):
+    """
+    Routes attachments using a list of rules, each a dict with a 'storage' name and any of the following conditions,
+    all of which must match. The first matching rule wins, and attachments matching none go to the 'default' storage.
+
+    * context: the attachment context, which may contain shell-style wildcards
+    * content_type: the "app_label.model" of the object being attached to
+    * mime_type: the detected MIME type, which may contain wildcards (e.g. "image/*")
+    * min_size, max_size: bounds on the file size in bytes (inclusive)
+    """
+
+    def __init__(self, rules=None):
+        self.rules = getattr(settings, 'ATTACHMENT_STORAGE_ROUTES', []) if rules is None else rules
+
+    def matches(self, rule, obj, context, file_name, file_size, mime_type):
+        if 'context' in rule and not fnmatch.fnmatchcase(context or '', rule['context']):
+            return False
+        if 'mime_type' in rule and not fnmatch.fnmatchcase(mime_type or '', rule['mime_type']):
+            return False
+        if 'min_size' in rule and file_size < rule['min_size']:
+            return False
+        if 'max_size' in rule and file_size > rule['max_size']:
+            return False
+        if 'content_type' in rule:
+            ct = ContentType.objects.get_for_model(obj)
+            if '%s.%s' % (ct.app_label, ct.model) != rule['content_type'].lower():
+                return False
+        return True
+
+    def storage_for(self, obj, context, file_name, file_size, mime_type):
+        for rule in self.rules:
+            if self.matches(rule, obj, context, file_name, file_size, mime_type):
+                return rule['storage']
+        return 'default'
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    global _router
+    with _router_lock:
+        if _router is None:
+            path = getattr(settings, 'ATTACHMENT_STORAGE_ROUTER', None)
+            _router = import_class(path)() if path else RuleRouter()
+        return _router
+
+
+def reset_router(setting=None, **kwargs):
+    global _router
+    if setting is None or setting in ('ATTACHMENT_STORAGE_ROUTER', 'ATTACHMENT_STORAGE_ROUTES'):
+        with _router_lock:
+            _router = None
+
+
+def route(obj, context, file_name, file_size, mime_type):
+    """
+    Returns the name of the storage a new attachment should be stored in.
+    """
+    return get_router().storage_for(obj, context, file_name, file_size, mime_type) or 'default'
+
+
+def resolve_storage(storage, obj, context, file_name, file_size, mime_type):
+    """
+    Returns a (name, storage) tuple for a new attachment, routing it if no storage was given.
+    """
+    if storage is None:
+        name = route(obj, context, file_name, file_size, mime_type)
+        return name, get_storage(name)
+    return get_storage_name(storage), storage
+
+
+setting_changed.connect(reset_router)
@@ -0,0 +1,211 @@
+"""
+A minimal clamd client, used to scan uploads for viruses while they are being received.
+
+Files are sent to clamd using the INSTREAM command over connections that are kept open in IDSESSION mode and pooled
+per process, so scanning an upload costs neither a second pass over the file nor a new socket per request. Files that
+can't be streamed (clamd refused the stream, or the connection dropped part way through) are scanned from disk with
+the SCAN command instead.
+"""
+
+from django.conf import settings
+
+from .exceptions import ScanError
+
+import os
+import socket
+import struct
+import threading
+import time
+
+
+CLAMD_CONF_PATHS = ('/etc/clamav/clamd.conf', '/etc/clamd.conf')
+DEFAULT_SOCKET = '/var/run/clamav/clamd.ctl'
+
+# clamd closes sessions that have been idle for IdleTimeout seconds (30 by default).
+DEFAULT_IDLE_TIMEOUT = 20
+
+
+def get_socket_path():
+    path = getattr(settings, 'ATTACHMENTS_CLAMD_SOCKET', None)
+    if path:
+        return path
+    # Fall back to the LocalSocket from clamd's own configuration, like pyclamd does.
+    for conf in CLAMD_CONF_PATHS:
+        try:
+            with open(conf) as fp:
+                for line in fp:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[0] == 'LocalSocket':
+                        return parts[1]
+        except IOError:
+            pass
+    return DEFAULT_SOCKET
+
+
+class ClamdConnection (object):
+
+    def __init__(self, path, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.sock.sendall(b'zIDSESSION\0')
+        self.buffer = b''
+        self.last_used = time.time()
+
+    def command(self, cmd):
+        self.sock.sendall(b'z' + cmd + b'\0')
+
+    def send_chunk(self, data):
+        self.sock.sendall(struct.pack('!L', len(data)) + data)
+
+    def reply(self):
+        while b'\0' not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ScanError('clamd closed the connection')
+            self.buffer += data
+        reply, self.buffer = self.buffer.split(b'\0', 1)
+        self.last_used = time.time()
+        # Replies within a session are prefixed with the request number, e.g. "1: stream: OK".
+        number, sep, rest = reply.partition(b': ')
+        if sep and number.isdigit():
+            reply = rest
+        return reply.decode('utf-8', 'replace')
+
+    def close(self):
+        try:
+            self.command(b'END')
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class ClamdPool (object):
+
+    def __init__(self, path, size=4, idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=None):
+        self.path = path
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire(self):
+        stale = []
+        conn = None
+        with self.lock:
+            while self.idle:
+                candidate = self.idle.pop()
+                if time.time() - candidate.last_used < self.idle_timeout:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+        for candidate in stale:
+            candidate.close()
+        return conn or ClamdConnection(self.path, timeout=self.timeout)
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    path = get_socket_path()
+    with _pool_lock:
+        if _pool is None or _pool.path != path:
+            if _pool is not None:
+                _pool.clear()
+            _pool = ClamdPool(path, size=getattr(settings, 'ATTACHMENTS_CLAMD_POOL_SIZE', 4),
+                              timeout=getattr(settings, 'ATTACHMENTS_CLAMD_TIMEOUT', None))
+        return _pool
+
+
+def parse_result(reply):
+    """
+    Returns the name of the virus found from a clamd scan reply, or None if the file is clean.
+    """
+    result = reply.rsplit(': ', 1)[-1]
+    if result == 'OK':
+        return None
+    if result.endswith(' FOUND'):
+        return result[:-len(' FOUND')]
+    raise ScanError(reply)
+
+
+def scan_file(path):
+    """
+    Asks clamd to scan a file on disk, returning the name of the virus found (or None).
+    """
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        conn.command(b'SCAN ' + os.path.abspath(path).encode('utf-8'))
+        virus = parse_result(conn.reply())
+    except Exception:
+        conn.close()
+        raise
+    pool.release(conn)
+    return virus
+
+
+class StreamScan (object):
+    """
+    Scans a file as it is received, one chunk at a time. Any problem talking to clamd is held back until result() is
+    called, at which point the file is scanned from disk instead.
+    """
+
+    # clamd rejects INSTREAM chunks larger than its StreamMaxLength, so keep them reasonably small.
+    max_chunk = 1024 * 1024
+
+    def __init__(self):
+        self.pool = get_pool()
+        self.conn = None
+        try:
+            self.conn = self.pool.acquire()
+            self.conn.command(b'INSTREAM')
+        except (socket.error, ScanError):
+            self.abort()
+
+    def update(self, data):
+        if self.conn is None:
+            return
+        try:
+            for pos in range(0, len(data), self.max_chunk):
+                self.conn.send_chunk(data[pos:pos + self.max_chunk])
+        except socket.error:
+            self.abort()
+
+    def result(self, path):
+        if self.conn is not None:
+            try:
+                self.conn.send_chunk(b'')
+                virus = parse_result(self.conn.reply())
+                self.pool.release(self.conn)
+                self.conn = None
+                return virus
+            except (socket.error, ScanError):
+                # Most likely the file was larger than clamd's StreamMaxLength.
+                self.abort()
+        return scan_file(path)
+
+    def abort(self):
+        if self.conn is not None:
+            try:
+                self.conn.sock.close()
+            except socket.error:
+                pass
+            self.conn = None
@@ -1,11 +1,14 @@
 from django.dispatch import Signal
 
 
-# Sent when a file is uploaded.
-file_uploaded = Signal(providing_args=('request', 'session'))
+# Sent when a file is uploaded, with the request and session.
+file_uploaded = Signal()
 
-# Sent when an attachment is downloaded.
-file_download = Signal(providing_args=('request',))
+# Sent when an upload has been processed (see attachments.processing), whether it was found clean or rejected.
+upload_processed = Signal()
 
-# Sent when attachments are attached to an object (i.e. saved)
-attachments_attached = Signal(providing_args=('obj', 'attachments'))
+# Sent when an attachment is downloaded (or a rendition of it served), with the request.
+file_download = Signal()
+
+# Sent when attachments are attached to an object (i.e. saved), with the obj and attachments.
+attachments_attached = Signal()
@@ -7,22 +7,51 @@
             container: null,
             dropTarget: null,
             progress: null,
-            success: null
+            success: null,
+            // Files are sent in resumable chunks of this many bytes where the browser supports it (0 to disable).
+            chunkSize: 5 * 1024 * 1024,
+            // Only files larger than this are chunked (4 chunks by default). Smaller files are sent in one request, so
+            // the server can scan, sniff and hash them as they arrive rather than reading them back afterwards.
+            chunkThreshold: null,
+            chunkRetries: 5,
+            chunkURL: null,
+            // The number of files uploaded at the same time.
+            concurrency: 4,
+            // How often (in milliseconds) to check on uploads that are being processed on the server.
+            pollInterval: 1000,
+            // How many times in a row checking on an upload may fail (waiting twice as long each time) before giving up.
+            pollRetries: 5
         }, options);
         
+        var refreshing = null;
+        var refreshQueued = false;
+
         var refresh = function() {
+            // With several uploads finishing at once, let one listing request stand in for the others.
+            if(refreshing) {
+                refreshQueued = true;
+                return refreshing;
+            }
         	var data = {};
         	if (settings.container.hasClass('bind-form-on-refresh')) {
         		data['bind-form-data'] = true;
         		settings.container.removeClass('bind-form-on-refresh');
         	}
-            return $.ajax({
+            refreshing = $.ajax({
                 url: settings.url,
                 data: data,
                 success: function(html) {
                     $(settings.container).empty().append(html).trigger('table-changed');
+                },
+                complete: function() {
+                    refreshing = null;
+                    if(refreshQueued) {
+                        refreshQueued = false;
+                        refresh();
+                    }
                 }
             });
+            return refreshing;
         };
 
         var resetInput = function(input) {
@@ -31,8 +60,38 @@
             inp.unwrap();
         };
 
+        // Wait for uploads that are processed in the background to be found clean (or rejected).
+        var awaitProcessing = function(data, signal, failures) {
+            failures = failures || 0;
+            setTimeout(function() {
+                $.ajax(data.status_url, {
+                    success: function(status) {
+                        if(status.status === 'pending' || status.status === 'scanning') {
+                            awaitProcessing(data, signal);
+                            return;
+                        }
+                        refresh();
+                        handleResponse($.extend({}, data, status), signal);
+                    },
+                    error: function(xhr) {
+                        // The upload is gone (or was never ours), so asking again won't help.
+                        if((xhr.status >= 400 && xhr.status < 500) || failures + 1 >= settings.pollRetries) {
+                            refresh();
+                            handleResponse($.extend({}, data, {ok: false, error: 'Upload failed.'}, xhr.responseJSON),
+                                           signal);
+                            return;
+                        }
+                        awaitProcessing(data, signal, failures + 1);
+                    }
+                });
+            }, settings.pollInterval * Math.pow(2, failures));
+        };
+
         var handleResponse = function(data, signal) {
-            if(data.ok) {
+            if(data.ok && data.status_url && (data.status === 'pending' || data.status === 'scanning')) {
+                awaitProcessing(data, signal);
+            }
+            else if(data.ok) {
                 if(settings.success) {
                     settings.success(data);
                 }
@@ -46,6 +105,17 @@
             }
         };
 
+        // Returns the JSON an upload request responded with, or an error response if it wasn't JSON (e.g. the HTML
+        // error page for a 413 or 502 from a proxy in front of the server).
+        var parseResponse = function(xhr) {
+            try {
+                return JSON.parse(xhr.responseText);
+            }
+            catch(e) {
+                return {ok: false, error: xhr.statusText || 'Upload failed.'};
+            }
+        };
+
         var iframeUpload = function(input) {
             var signal = $.Deferred();
             $.ajax(settings.url, {
@@ -63,11 +133,8 @@
             return signal;
         };
 
-        var upload = function(file) {
-            var signal = $.Deferred();
-            var formData = new FormData();
-            formData.append('attachment', file);
-	        //include properties data if it exists
+        var appendProperties = function(formData) {
+            //include properties data if it exists
             $(".properties >* :input").each( function() {
             	if(this.type !== "checkbox"){
             		formData.append($(this).attr('id').slice(3), $(this).val());
@@ -75,12 +142,128 @@
             		formData.append($(this).attr('id').slice(3), $(this).is(':checked') ? 'true' : 'false');
             	}
             })
+        };
+
+        var canChunk = function(file) {
+            var threshold = settings.chunkThreshold === null ? 4 * settings.chunkSize : settings.chunkThreshold;
+            return settings.chunkSize > 0 && file.size > threshold &&
+                typeof Blob !== 'undefined' && typeof Blob.prototype.slice === 'function';
+        };
+
+        var chunkedUpload = function(file, opts) {
+            var signal = $.Deferred();
+            var chunkURL = null;
+            var retries = 0;
+
+            var fail = function(data) {
+                refresh();
+                handleResponse($.extend({ok: false, error: 'Upload failed.'}, data), signal);
+            };
+
+            var finish = function() {
+                var formData = new FormData();
+                formData.append('file_name', file.name);
+                formData.append('file_size', file.size);
+                appendProperties(formData);
+                $.ajax(chunkURL, {
+                    type: 'POST',
+                    data: formData,
+                    processData: false,
+                    contentType: false,
+                    success: function(data) {
+                        refresh();
+                        handleResponse(data, signal);
+                    },
+                    error: function(xhr) {
+                        fail(xhr.responseJSON);
+                    }
+                });
+            };
+
+            // Ask the server how much it has, then carry on from there.
+            var resume = function() {
+                if(retries++ >= settings.chunkRetries) {
+                    fail();
+                    return;
+                }
+                setTimeout(function() {
+                    $.ajax(chunkURL, {
+                        success: function(data) {
+                            send(data.offset);
+                        },
+                        error: resume
+                    });
+                }, 1000 * retries);
+            };
+
+            var send = function(offset) {
+                if(offset >= file.size) {
+                    finish();
+                    return;
+                }
+                var end = Math.min(offset + settings.chunkSize, file.size);
+                var xhr = new XMLHttpRequest();
+                if(opts.progress) {
+                    xhr.upload.addEventListener('progress', function(evt) {
+                        if(evt.lengthComputable) {
+                            opts.progress(100.0 * (offset + evt.loaded) / file.size);
+                        }
+                    }, false);
+                }
+                xhr.onload = function(evt) {
+                    var data = parseResponse(xhr);
+                    if(xhr.status === 200 && data.ok) {
+                        retries = 0;
+                        send(data.offset);
+                    }
+                    else if(xhr.status === 409 && typeof data.offset === 'number') {
+                        send(data.offset);
+                    }
+                    else if(xhr.status >= 500) {
+                        resume();
+                    }
+                    else {
+                        fail(data);
+                    }
+                };
+                xhr.onerror = resume;
+                xhr.onabort = function() {
+                    fail({error: 'Upload cancelled.'});
+                };
+                xhr.open('PUT', chunkURL, true);
+                xhr.setRequestHeader('Content-Range', 'bytes ' + offset + '-' + (end - 1) + '/' + file.size);
+                xhr.send(file.slice(offset, end));
+            };
+
+            $.ajax(settings.chunkURL || settings.url + 'chunked/', {
+                type: 'POST',
+                success: function(data) {
+                    chunkURL = data.url;
+                    send(data.offset);
+                },
+                error: function(xhr) {
+                    fail(xhr.responseJSON);
+                }
+            });
+
+            return signal;
+        };
+
+        var upload = function(file, opts) {
+            opts = opts || settings;
+            if(canChunk(file)) {
+                return chunkedUpload(file, opts);
+            }
+            var signal = $.Deferred();
+            var formData = new FormData();
+            formData.append('attachment', file);
+            appendProperties(formData);
             var xhr = new XMLHttpRequest();
-            if(settings.progress) {
+            if(opts.progress) {
                 xhr.upload.addEventListener('progress', function(evt) {
                     if(evt.lengthComputable) {
                         var percentComplete = 100.0 * evt.loaded / evt.total;
-                        settings.progress(percentComplete);
+                        opts.progress(percentComplete);
                     }
                 }, false);
             }
@@ -90,8 +273,17 @@
                 refresh();
 
                 // Fire the success/error handlers with the returned JSON
-                var data = JSON.parse(xhr.responseText);
-                handleResponse(data, signal);
+                handleResponse(parseResponse(xhr), signal);
+            };
+
+            // Settle the upload however it ends, so it doesn't hold up the rest of the queue.
+            xhr.onerror = function() {
+                refresh();
+                handleResponse({ok: false, error: 'Upload failed.'}, signal);
+            };
+            xhr.onabort = function() {
+                refresh();
+                handleResponse({ok: false, error: 'Upload cancelled.'}, signal);
             };
 
             xhr.open('POST', settings.url, true);
@@ -101,15 +293,53 @@
         };
 
         var uploadFiles = function(files, input) {
-            var chain = null;
-            // Call all the upload methods sequentially.
-            for(var i = 0; i < files.length; i++) {
-                chain = chain ? chain.then(upload(files[i])) : upload(files[i]);
+            var queue = Array.prototype.slice.call(files);
+            var total = 0, loaded = [], active = 0, next = 0;
+            var done = $.Deferred();
+            var progress = settings.progress;
+            for(var i = 0; i < queue.length; i++) {
+                total += queue[i].size;
+                loaded.push(0);
+            }
+
+            // Run up to settings.concurrency uploads at once, reporting progress across all of them.
+            var start = function() {
+                while(active < Math.max(settings.concurrency, 1) && next < queue.length) {
+                    (function(idx) {
+                        var file = queue[idx];
+                        active++;
+                        var fileSettings = $.extend({}, settings, {
+                            progress: progress ? function(pct) {
+                                loaded[idx] = file.size * pct / 100.0;
+                                var sum = 0;
+                                for(var j = 0; j < loaded.length; j++) {
+                                    sum += loaded[j];
+                                }
+                                progress(total > 0 ? 100.0 * sum / total : 100.0);
+                            } : null
+                        });
+                        upload(file, fileSettings).always(function() {
+                            loaded[idx] = file.size;
+                            active--;
+                            if(next < queue.length) {
+                                start();
+                            }
+                            else if(active === 0) {
+                                done.resolve();
+                            }
+                        });
+                    })(next++);
+                }
+            };
+            start();
+            if(queue.length === 0) {
+                done.resolve();
             }
             // Clear the file input, if it was used to trigger the upload.
             if(input) {
                 resetInput(input);
             }
+            return done;
         };
 
         if(settings.dropTarget) {
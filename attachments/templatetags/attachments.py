@@ -1,8 +1,11 @@
 from django import template
 from django.contrib.contenttypes.models import ContentType
+from django.urls import reverse
+from django.utils.http import urlencode
 
+from ..cache import get_properties
 from ..forms import PropertyForm
-from ..models import Property
+from ..models import prefetch_property_values
 
 
 register = template.Library()
@@ -12,12 +15,32 @@ register = template.Library()
 def has_attachment_properties(content_type, editable_only=False):
     if not isinstance(content_type, ContentType):
         content_type = ContentType.objects.get_for_model(content_type)
-    qs = Property.objects.filter(content_type=content_type)
-    if editable_only:
-        qs = qs.filter(is_editable=True)
-    return qs.exists()
+    return bool(get_properties(content_type, editable_only=editable_only))
 
 
 @register.filter
 def attachment_properties_form(obj, editable_only=True):
     return PropertyForm(instance=obj, editable_only=editable_only)
+
+
+@register.filter
+def with_property_values(attachments):
+    """
+    Use when looping over attachments to render their property values, e.g.
+    {% for att in attachments|with_property_values %}, so model-typed values are loaded in bulk.
+    """
+    return prefetch_property_values(attachments)
+
+
+@register.simple_tag
+def attachments_zip_url(obj, context=None):
+    """
+    Returns the URL for downloading all of an object's attachments (optionally only those for a context) as a ZIP.
+    """
+    url = reverse('attachment-zip', kwargs={
+        'content_type_id': ContentType.objects.get_for_model(obj).pk,
+        'object_id': obj.pk,
+    })
+    if context is not None:
+        url += '?' + urlencode({'context': context})
+    return url
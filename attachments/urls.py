@@ -1,13 +1,30 @@
-from django.conf.urls import url
+from django.conf import settings
+from django.urls import re_path
+from django.core.exceptions import ImproperlyConfigured
 
 from . import views
 
+import django
+
+
+if getattr(settings, 'ATTACHMENT_ASYNC_VIEWS', False):
+    if django.VERSION < (3, 1):
+        raise ImproperlyConfigured('ATTACHMENT_ASYNC_VIEWS requires Django 3.1 or later.')
+    from . import async_views as transfer_views
+else:
+    transfer_views = views
+
 
 urlpatterns = [
-    url(r'^download/(?P<attach_id>[^/]+)/(?P<filename>.*)$', views.download, name='attachment-download'),
-    url(r'^(?P<session_id>[^/]+)/$', views.attach, name='attach'),
-    url(r'^delete/upload/(?P<session_id>[^/]+)/(?P<upload_id>[^/]+)/$', views.delete_upload, name='delete-upload'),
-    url(r'^update/(?P<attach_id>[^/]+)/$', views.update_attachment, name='update-attachment'),
-    url(r'^properties/edit/(?P<attach_id>[^/]+)/$', views.edit_attachment_properties, name='edit-attachment-properties'),
-    url(r'^properties/view/(?P<attach_id>[^/]+)/$', views.view_attachment_properties, name='view-attachment-properties')
+    re_path(r'^download/zip/(?P<content_type_id>\d+)/(?P<object_id>\d+)/$', views.download_zip, name='attachment-zip'),
+    re_path(r'^download/(?P<attach_id>[^/]+)/(?P<filename>.*)$', transfer_views.download, name='attachment-download'),
+    re_path(r'^thumbnail/(?P<attach_id>\d+)/(?P<size>[\w-]+)/$', views.thumbnail, name='attachment-thumbnail'),
+    re_path(r'^(?P<session_id>[^/]+)/$', transfer_views.attach, name='attach'),
+    re_path(r'^(?P<session_id>[^/]+)/chunked/$', views.start_chunked_upload, name='attach-chunked'),
+    re_path(r'^(?P<session_id>[^/]+)/chunked/(?P<token>[0-9a-f]{32})/$', transfer_views.chunked_upload, name='attach-chunk'),
+    re_path(r'^(?P<session_id>[^/]+)/status/(?P<upload_id>\d+)/$', views.upload_status, name='upload-status'),
+    re_path(r'^delete/upload/(?P<session_id>[^/]+)/(?P<upload_id>[^/]+)/$', views.delete_upload, name='delete-upload'),
+    re_path(r'^update/(?P<attach_id>[^/]+)/$', views.update_attachment, name='update-attachment'),
+    re_path(r'^properties/edit/(?P<attach_id>[^/]+)/$', views.edit_attachment_properties, name='edit-attachment-properties'),
+    re_path(r'^properties/view/(?P<attach_id>[^/]+)/$', views.view_attachment_properties, name='view-attachment-properties')
 ]
@@ -1,17 +1,46 @@
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.core.files.storage import get_storage_class
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, get_storage_class
 from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
 from django.db import IntegrityError, models
 from django.http import HttpResponse
+from django.utils.encoding import force_bytes
 from six.moves.urllib.parse import quote
 import six
 
+from .cache import get_cached_access, set_cached_access
+
+import errno
+import hashlib
 import importlib
 import json
+import logging
+import magic
+import mimetypes
+import os
+import tempfile
+import threading
 import uuid
 
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where reflinks aren't attempted.
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Loading libmagic's database is expensive, so each thread keeps its own pair of magic.Magic instances.
+_magic = threading.local()
+
+# ioctl request number for cloning a file's extents (Linux btrfs/XFS reflinks).
+FICLONE = 0x40049409
+
+
 def get_context_key(context):
     if context:
         return 'attachments-%s' % context
@@ -47,14 +76,251 @@ def session(request, template='attachments/list.html', context='', user=None, co
         raise Exception('Could not create a unique attachment session')
 
 
-def get_storage():
-    cls, kwargs = getattr(settings, 'ATTACHMENT_STORAGE', (settings.DEFAULT_FILE_STORAGE, {}))
-    return get_storage_class(cls)(**kwargs)
+# Storage name -> storage instance, built on first use.
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage_config(name='default'):
+    """
+    Returns the (class path, kwargs) for a named storage. Storages are named in ATTACHMENT_STORAGES; 'default' falls
+    back to ATTACHMENT_STORAGE, and then to DEFAULT_FILE_STORAGE.
+    """
+    storages = getattr(settings, 'ATTACHMENT_STORAGES', {})
+    if name in storages:
+        return storages[name]
+    if name == 'default':
+        return getattr(settings, 'ATTACHMENT_STORAGE', (settings.DEFAULT_FILE_STORAGE, {}))
+    raise KeyError('No attachment storage named %r' % name)
+
+
+def get_storage(name='default'):
+    """
+    Returns the storage instance for name. Instances are built once per process and shared between threads, so
+    backends that keep clients or connection pools (e.g. S3) reuse them across requests.
+    """
+    storage = _storages.get(name)
+    if storage is None:
+        with _storages_lock:
+            storage = _storages.get(name)
+            if storage is None:
+                cls, kwargs = get_storage_config(name)
+                storage = _storages[name] = get_storage_class(cls)(**kwargs)
+    return storage
+
+
+def get_storage_name(storage):
+    """
+    Returns the name of a storage instance returned by get_storage, raising ImproperlyConfigured for any other storage
+    (attachments record only the name, so they could never be read back from a storage without one).
+    """
+    for name, instance in list(_storages.items()):
+        if instance is storage:
+            return name
+    raise ImproperlyConfigured('%r is not an attachment storage; use attachments.utils.get_storage(name) to get one '
+                               'of ATTACHMENT_STORAGES.' % storage)
+
+
+def reset_storages(**kwargs):
+    """
+    Discards the storage instances built so far, so the next get_storage builds them from the current settings. This
+    happens automatically when the storage settings are changed (e.g. by override_settings in tests).
+    """
+    with _storages_lock:
+        _storages.clear()
+
+
+def _storage_setting_changed(setting, **kwargs):
+    if setting in ('ATTACHMENT_STORAGE', 'ATTACHMENT_STORAGES', 'DEFAULT_FILE_STORAGE', 'MEDIA_ROOT', 'MEDIA_URL'):
+        reset_storages()
+
+
+setting_changed.connect(_storage_setting_changed)
+
+
+def shard_path(key, depth):
+    """
+    Returns depth levels of directories (e.g. "3f/a2") derived from a hash of key, for spreading files out so that no
+    single directory gets too large.
+    """
+    digest = hashlib.sha1(force_bytes(key)).hexdigest()
+    return '/'.join(digest[level * 2:level * 2 + 2] for level in range(depth))
+
+
+# Names of the temp files this app creates in ATTACHMENT_TEMP_DIR, so cleaning up never touches anything else there.
+TEMP_FILE_PREFIX = 'attachment-'
+CHUNKED_FILE_PREFIX = 'chunked-'
+
+
+def get_temp_dir(key=None):
+    """
+    Returns ATTACHMENT_TEMP_DIR, creating it if needed. When ATTACHMENT_TEMP_SHARDS is set and a key is given, returns
+    (and creates) the subdirectory of it that the key is sharded into instead.
+    """
+    temp_dir = getattr(settings, 'ATTACHMENT_TEMP_DIR', None) or tempfile.gettempdir()
+    shards = getattr(settings, 'ATTACHMENT_TEMP_SHARDS', 0)
+    if key is not None and shards:
+        temp_dir = os.path.join(temp_dir, *shard_path(key, shards).split('/'))
+    if not os.path.isdir(temp_dir):
+        try:
+            os.makedirs(temp_dir)
+        except OSError:
+            # Another request may have created it in the meantime.
+            if not os.path.isdir(temp_dir):
+                raise
+    return temp_dir
+
+
+def make_temp_file():
+    """
+    Creates a new, empty temp file for an upload (in a random shard of ATTACHMENT_TEMP_DIR, when sharding), returning
+    an open file descriptor and its path, like tempfile.mkstemp.
+    """
+    return tempfile.mkstemp(prefix=TEMP_FILE_PREFIX, dir=get_temp_dir(uuid.uuid4().hex))
+
+
+def get_magic(mime=True):
+    attr = 'mime' if mime else 'description'
+    instance = getattr(_magic, attr, None)
+    if instance is None:
+        instance = magic.Magic(mime=mime)
+        setattr(_magic, attr, instance)
+    return instance
+
+
+def detect_file_type(path=None, buffer=None):
+    """
+    Returns a (mime_type, file_type) tuple for the file at path, or for a buffer holding the start of one, where
+    file_type is libmagic's textual description (e.g. "PDF document, version 1.4").
+    """
+    if buffer is not None:
+        return get_magic(mime=True).from_buffer(buffer), get_magic(mime=False).from_buffer(buffer)
+    return get_magic(mime=True).from_file(path), get_magic(mime=False).from_file(path)
+
+
+def _clone_file(source_path, dest_path):
+    src = os.open(source_path, os.O_RDONLY)
+    try:
+        dst = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            fcntl.ioctl(dst, FICLONE, src)
+        except (IOError, OSError):
+            os.close(dst)
+            os.remove(dest_path)
+            raise
+        os.close(dst)
+    finally:
+        os.close(src)
+
+
+def make_storage_directory(storage, directory):
+    """
+    Creates a directory in a local storage (and any missing parents) the same way FileSystemStorage._save would, with
+    the storage's directory_permissions_mode.
+    """
+    if os.path.isdir(directory):
+        return
+    try:
+        if storage.directory_permissions_mode is not None:
+            old_umask = os.umask(0)
+            try:
+                os.makedirs(directory, storage.directory_permissions_mode)
+            finally:
+                os.umask(old_umask)
+        else:
+            os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+
+def _promote_local(storage, name, source_path):
+    directory = os.path.dirname(storage.path(name))
+    make_storage_directory(storage, directory)
+    if os.stat(source_path).st_dev != os.stat(directory).st_dev:
+        return None
+    methods = [('link', os.link)]
+    if fcntl is not None:
+        methods.append(('reflink', _clone_file))
+    for method, promote in methods:
+        for _i in range(5):
+            available = storage.get_available_name(name)
+            full_path = storage.path(available)
+            try:
+                promote(source_path, full_path)
+            except (IOError, OSError) as ex:
+                if ex.errno == errno.EEXIST:
+                    # Lost a race for the name, pick another one.
+                    continue
+                break
+            mode = storage.file_permissions_mode
+            if mode is None:
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0o666 & ~umask
+            os.chmod(full_path, mode)
+            return available.replace('\\', '/'), method
+    return None
+
+
+def promote_file(storage, name, source_path):
+    """
+    Saves the file at source_path to storage under name (or the next available name), returning the saved name and
+    how the file got there. When the storage is a FileSystemStorage on the same device as the source, the file is
+    hard linked ('link') or cloned ('reflink') instead of copied, which takes constant time regardless of its size.
+    Otherwise, or if ATTACHMENT_ZERO_COPY is False, the file is streamed through the storage ('copy'). The source
+    file is left in place either way.
+    """
+    if getattr(settings, 'ATTACHMENT_ZERO_COPY', True) and isinstance(storage, FileSystemStorage):
+        try:
+            promoted = _promote_local(storage, name, source_path)
+        except (IOError, OSError):
+            logger.exception('Error promoting %s to %s, falling back to a copy', source_path, name)
+            promoted = None
+        if promoted:
+            return promoted
+    with open(source_path, 'rb') as fp:
+        return storage.save(name, File(fp)), 'copy'
+
+
+def get_hasher():
+    """
+    Returns a new hash object for computing file digests, using ATTACHMENT_DIGEST_ALGORITHM (sha256 by default).
+    """
+    return hashlib.new(getattr(settings, 'ATTACHMENT_DIGEST_ALGORITHM', 'sha256'))
+
+
+def file_digest(path, block_size=1024 * 1024):
+    hasher = get_hasher()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def get_blob_path(digest):
+    # Spread blobs over two levels of directories, so no single directory gets too large.
+    prefix = getattr(settings, 'ATTACHMENT_BLOB_PATH', 'blobs')
+    return '%s/%s/%s/%s' % (prefix, digest[:2], digest[2:4], digest)
+
+
+def get_object_dir(content_type, object_id, context, shards=None):
+    """
+    Returns the storage directory for an object's attachments with the given context. With ATTACHMENT_PATH_SHARDS set,
+    objects are spread over that many levels of hashed directories under their model's directory, so that neither
+    the model directory nor any other holds too many entries.
+    """
+    if shards is None:
+        shards = getattr(settings, 'ATTACHMENT_PATH_SHARDS', 0)
+    prefix = '%s/%s' % (content_type.app_label, content_type.model)
+    if shards:
+        prefix = '%s/%s' % (prefix, shard_path('%s:%s' % (prefix, object_id), shards))
+    return '%s/%s/%s' % (prefix, object_id, context)
 
 
 def get_default_path(upload, obj):
     ct = ContentType.objects.get_for_model(obj)
-    return '%s/%s/%s/%s/%s' % (ct.app_label, ct.model, obj.pk, upload.session.context, upload.file_name)
+    return '%s/%s' % (get_object_dir(ct, obj.pk, upload.session.context), upload.file_name)
 
 
 def url_filename(filename):
@@ -65,12 +331,17 @@ def url_filename(filename):
 def user_has_access(request, attachment):
     # Check to see if this attachments model instance has a can_download, otherwise fall back
     # to checking request.user.is_authenticated by default.
+    # A cached answer saves loading the content object at all.
+    auth = get_cached_access(request.user, attachment.content_type_id, attachment.object_id)
+    if auth is not None:
+        return auth
     obj = attachment.content_object
     auth = request.user.is_authenticated
     if hasattr(obj, 'can_download'):
         auth = obj.can_download(request, attachment)
         if isinstance(auth, HttpResponse):
             return auth
+    set_cached_access(request.user, attachment.content_type_id, attachment.object_id, auth)
     return auth
 
 
@@ -83,7 +354,7 @@ class JSONField (models.TextField):
             return json.loads(value)
         return value
 
-    def from_db_value(self, value, expression, connection, context):
+    def from_db_value(self, value, expression, connection, *args):
         return None if value is None else self.to_python(value)
 
     def get_prep_value(self, value):
@@ -101,7 +372,72 @@ class JSONField (models.TextField):
 #        return name, 'attachments.utils.JSONField', args, kwargs
 
 
+# Maps a MIME type to the frozenset of file extensions registered for it.
+_mime_extensions = {}
+
+
+def mime_extensions(mime_type):
+    exts = _mime_extensions.get(mime_type)
+    if exts is None:
+        exts = _mime_extensions[mime_type] = frozenset(mimetypes.guess_all_extensions(mime_type))
+    return exts
+
+
+class UploadPolicy (object):
+    """
+    The file extensions and file types a Session allows, parsed once and shared by every session with the same
+    whitelist text. Use UploadPolicy.get() rather than creating these directly.
+    """
+
+    # Sessions usually share a handful of whitelists (typically the ones from settings), but don't grow without bound.
+    max_cached = 256
+    _cache = {}
+    _lock = threading.Lock()
+
+    def __init__(self, allowed_file_extensions, allowed_file_types):
+        exts = allowed_file_extensions.split()
+        # Kept in order for error messages.
+        self.extensions = tuple(x if x.startswith('.') else '.{}'.format(x) for x in exts)
+        self.extension_set = frozenset(self.extensions)
+        self.file_types = frozenset(allowed_file_types.split('\n'))
+        self._mime_allowed = {}
+
+    @classmethod
+    def get(cls, allowed_file_extensions, allowed_file_types):
+        key = (allowed_file_extensions or '', allowed_file_types or '')
+        policy = cls._cache.get(key)
+        if policy is None:
+            policy = cls(*key)
+            with cls._lock:
+                if len(cls._cache) >= cls.max_cached:
+                    cls._cache.clear()
+                policy = cls._cache.setdefault(key, policy)
+        return policy
+
+    def __bool__(self):
+        return bool(self.extensions)
+    __nonzero__ = __bool__
+
+    def allows_extension(self, file_name):
+        return os.path.splitext(file_name)[1] in self.extension_set
+
+    def allows_mime_type(self, mime_type):
+        allowed = self._mime_allowed.get(mime_type)
+        if allowed is None:
+            allowed = self._mime_allowed[mime_type] = not mime_extensions(mime_type).isdisjoint(self.extension_set)
+        return allowed
+
+    def allows_file_type(self, file_type):
+        return file_type in self.file_types
+
+
+_imported_classes = {}
+
+
 def import_class(fq_name):
-    module_name, class_name = fq_name.rsplit('.', 1)
-    mod = importlib.import_module(module_name)
-    return getattr(mod, class_name)
+    cls = _imported_classes.get(fq_name)
+    if cls is None:
+        module_name, class_name = fq_name.rsplit('.', 1)
+        mod = importlib.import_module(module_name)
+        cls = _imported_classes[fq_name] = getattr(mod, class_name)
+    return cls
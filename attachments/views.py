@@ -1,78 +1,309 @@
 from django.conf import settings
-from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.contrib.contenttypes.models import ContentType
+from django.core.files import File
+from django.http import Http404, HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render
 from django.template import loader
-from django.utils.encoding import force_text
+from django.urls import reverse
+from django.utils.encoding import force_str
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
 from attachments.exceptions import VirusFoundException
 
+from . import processing, renditions
+from .downloads import get_download_backend, iter_zip
 from .forms import PropertyForm
-from .models import Attachment, Session
+from .handlers import AttachmentUploadHandler, ScannedUploadedFile
+from .models import Attachment, Session, Upload, prefetch_property_values
 from .signals import file_download, file_uploaded
-from .utils import get_storage, url_filename, user_has_access
+from .utils import (
+    CHUNKED_FILE_PREFIX, detect_file_type, file_digest, get_hasher, get_temp_dir, make_temp_file, url_filename, user_has_access)
 
-from wsgiref.util import FileWrapper
+import errno
 import logging
-import mimetypes
 import os
-import tempfile
+import re
+import uuid
 
 
 logger = logging.getLogger(__name__)
 
 
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+def _response_content_type(request):
+    # Old versions of IE doing iframe uploads would present a Save dialog on JSON responses.
+    return 'text/plain' if request.POST.get('X-Requested-With', '') == 'IFrame' else 'application/json'
+
+
+def _create_upload(session, path, file_name, file_size, data, scanned=False, virus=None, mime_type=None,
+                   file_type=None, digest=None):
+    """
+    Checks a fully received temp file for viruses (unless it was scanned while being received), records it as an
+    Upload on the session along with its detected type and digest, and merges any posted form data into the session
+    data. When processing is asynchronous, the Upload is recorded as pending and queued for processing instead.
+    """
+    if processing.is_async():
+        upload = session.uploads.create(file_path=path, file_name=file_name, file_size=file_size,
+                                        mime_type=mime_type or '', file_type=file_type or '', digest=digest or '',
+                                        status=Upload.STATUS_PENDING)
+        session.update_data(data.items())
+        processing.submit(upload)
+        return upload
+    processing.check_file(path, file_name, scanned=scanned, virus=virus)
+    if not mime_type:
+        mime_type, file_type = detect_file_type(path)
+    if not digest:
+        digest = file_digest(path)
+    upload = session.uploads.create(file_path=path, file_name=file_name, file_size=file_size, mime_type=mime_type,
+                                    file_type=file_type or '', digest=digest, status=Upload.STATUS_CLEAN)
+    session.update_data(data.items())
+    return upload
+
+
+def _read_received(path):
+    """
+    Reads a file received in chunks once, doing what AttachmentUploadHandler does while a single upload streams in:
+    hashing it and streaming it to clamd, then sniffing its type from the file. Returns the corresponding keyword
+    arguments for _create_upload. With asynchronous processing, all of this is left to the processing workers.
+    """
+    if processing.is_async():
+        return {}
+    hasher = get_hasher()
+    scan = None
+    if getattr(settings, 'ATTACHMENTS_CLAMD', False):
+        from .scanning import StreamScan
+        scan = StreamScan()
+    try:
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(256 * 1024), b''):
+                hasher.update(block)
+                if scan is not None:
+                    scan.update(block)
+    except Exception:
+        if scan is not None:
+            scan.abort()
+        raise
+    virus = scan.result(path) if scan is not None else None
+    mime_type, file_type = detect_file_type(path)
+    return {
+        'scanned': scan is not None,
+        'virus': virus,
+        'mime_type': mime_type,
+        'file_type': file_type,
+        'digest': hasher.hexdigest(),
+    }
+
+
+def _upload_response(upload, content_type):
+    data = {'ok': True, 'file_name': upload.file_name, 'file_size': upload.file_size}
+    if upload.status == Upload.STATUS_PENDING:
+        # Tell the client where to check on the upload while it's processed.
+        data.update({
+            'upload_id': upload.pk,
+            'status': upload.status,
+            'status_url': reverse('upload-status', kwargs={'session_id': upload.session.uuid, 'upload_id': upload.pk}),
+        })
+    return JsonResponse(data, content_type=content_type)
+
+
+def _chunked_path(session, token):
+    return os.path.join(get_temp_dir(token), '%s%s-%s' % (CHUNKED_FILE_PREFIX, session.uuid, token))
+
+
+def _chunked_offset(session, token):
+    """
+    Returns the path of a chunked upload's file and how many bytes it has received, raising Http404 if there's no
+    such upload.
+    """
+    path = _chunked_path(session, token)
+    if not os.path.exists(path):
+        raise Http404()
+    return path, os.path.getsize(path)
+
+
+def _parse_chunk_range(request, offset):
+    """
+    Checks the Content-Range of a chunk PUT against the offset received so far, returning a (start, length, error)
+    tuple, where error is the response to send instead if the chunk can't be accepted.
+    """
+    match = CONTENT_RANGE_RE.match(request.META.get('HTTP_CONTENT_RANGE', ''))
+    if not match:
+        return None, None, JsonResponse({'ok': False, 'error': 'A valid Content-Range header is required.'}, status=400)
+    start, end = int(match.group(1)), int(match.group(2))
+    total = None if match.group(3) == '*' else int(match.group(3))
+    if end < start or (total is not None and end >= total):
+        return None, None, JsonResponse({'ok': False, 'error': 'Invalid Content-Range.', 'offset': offset}, status=416)
+    if end - start + 1 > getattr(settings, 'ATTACHMENT_MAX_CHUNK_SIZE', 10 * 1024 * 1024):
+        return None, None, JsonResponse({'ok': False, 'error': 'Chunk is too large.', 'offset': offset}, status=413)
+    if start > offset:
+        # Chunks must be contiguous; tell the client where to resume from.
+        return None, None, JsonResponse({
+            'ok': False,
+            'error': 'Chunk does not start at the current offset.',
+            'offset': offset,
+        }, status=409)
+    return start, end - start + 1, None
+
+
+def _write_chunk(request, path, start, expected):
+    """
+    Writes up to expected bytes of the request body at start, returning the number of bytes actually received.
+    """
+    with open(path, 'r+b') as fp:
+        # Retried chunks may overlap data already received, so always write at the requested offset.
+        fp.seek(start)
+        received = 0
+        while received < expected:
+            block = request.read(min(64 * 1024, expected - received))
+            if not block:
+                break
+            fp.write(block)
+            received += len(block)
+        fp.truncate(start + received)
+    return received
+
+
 @csrf_exempt
 def attach(request, session_id):
     session = get_object_or_404(Session, uuid=session_id)
     session._request = request
     if request.method == 'POST':
-        # Old versions of IE doing iframe uploads would present a Save dialog on JSON responses.
-        content_type = 'text/plain' if request.POST.get('X-Requested-With', '') == 'IFrame' else 'application/json'
+        # Stream the upload to its temp file (and to clamd) as it arrives. This has to happen before touching POST.
+        request.upload_handlers.insert(0, AttachmentUploadHandler(request))
+        # Parsing the body is also when the upload is scanned, so a scan failure is reported like any other error
+        # (as JSON, since the posted fields saying otherwise couldn't be read).
+        content_type = 'application/json'
         try:
+            content_type = _response_content_type(request)
             f = request.FILES['attachment']
             file_uploaded.send(sender=f, request=request, session=session)
-            # Copy the Django attachment (which may be a file or in memory) over to a temp file.
-            temp_dir = getattr(settings, 'ATTACHMENT_TEMP_DIR', None)
-            if temp_dir is not None and not os.path.exists(temp_dir):
-                os.makedirs(temp_dir)
-            fd, path = tempfile.mkstemp(dir=temp_dir)
-            with os.fdopen(fd, 'wb') as fp:
-                for chunk in f.chunks():
-                    fp.write(chunk)
-            # After attached file is placed in a temporary file and ATTACHMENTS_CLAMD is active scan it for viruses:
-            if getattr(settings, 'ATTACHMENTS_CLAMD', False):
-                import pyclamd
-                cd = pyclamd.ClamdUnixSocket()
-                virus = cd.scan_file(path)
-                if virus is not None:
-                    # if ATTACHMENTS_QUARANTINE_PATH is set, move the offending file to the quaranine, otherwise delete
-                    if getattr(settings, 'ATTACHMENTS_QUARANTINE_PATH', False):
-                        quarantine_path = os.path.join(getattr(settings, 'ATTACHMENTS_QUARANTINE_PATH'), os.path.basename(path))
-                        os.rename(path, quarantine_path)
-                    else:
-                        os.remove(path)
-                    raise VirusFoundException('**WARNING** virus %s found in the file %s, could not upload!' % (virus[path][1], f.name))
-            session.uploads.create(file_path=path, file_name=f.name, file_size=f.size)
-            for key, value in request.POST.items():
-                if session.data:
-                    session.data.update({key: value})
-                else:
-                    session.data = {key: value}
-            session.save()
-            return JsonResponse({'ok': True, 'file_name': f.name, 'file_size': f.size}, content_type=content_type)
+            if isinstance(f, ScannedUploadedFile):
+                path = f.temporary_file_path()
+                scanned, virus = f.scanned, f.virus
+                mime_type, file_type = f.mime_type, f.file_type
+                digest = f.digest
+            else:
+                # Copy the Django attachment (which may be a file or in memory) over to a temp file.
+                fd, path = make_temp_file()
+                hasher = get_hasher()
+                with os.fdopen(fd, 'wb') as fp:
+                    for chunk in f.chunks():
+                        fp.write(chunk)
+                        hasher.update(chunk)
+                scanned, virus = False, None
+                mime_type, file_type = None, None
+                digest = hasher.hexdigest()
+            upload = _create_upload(session, path, f.name, f.size, request.POST, scanned=scanned, virus=virus,
+                                    mime_type=mime_type, file_type=file_type, digest=digest)
+            return _upload_response(upload, content_type)
         except VirusFoundException as ex:
             logger.exception(str(ex))
-            return JsonResponse({'ok': False, 'error': force_text(ex)}, content_type=content_type)
+            return JsonResponse({'ok': False, 'error': force_str(ex)}, content_type=content_type)
         except Exception as ex:
             logger.exception('Error attaching file to session %s', session_id)
-            return JsonResponse({'ok': False, 'error': force_text(ex)}, content_type=content_type)
+            return JsonResponse({'ok': False, 'error': force_str(ex)}, content_type=content_type)
     else:
         return render(request, session.template, {
             'session': session,
         })
 
 
+@csrf_exempt
+@require_POST
+def start_chunked_upload(request, session_id):
+    """
+    Starts a resumable upload, returning the token used to address it. The file is then sent as a series of PUT
+    requests to the attach-chunk URL, each carrying a Content-Range header, and finalized with a POST.
+    """
+    session = get_object_or_404(Session, uuid=session_id)
+    for _i in range(5):
+        token = uuid.uuid4().hex
+        try:
+            fd = os.open(_chunked_path(session, token), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+            continue
+        os.close(fd)
+        return JsonResponse({
+            'ok': True,
+            'token': token,
+            'offset': 0,
+            'url': reverse('attach-chunk', kwargs={'session_id': session.uuid, 'token': token}),
+        })
+    raise Exception('Could not create a unique chunked upload')
+
+
+@csrf_exempt
+def chunked_upload(request, session_id, token):
+    """
+    GET returns the number of bytes received so far, so an interrupted upload knows where to resume. PUT writes the
+    request body at the offset given by its Content-Range header. POST finalizes the upload, creating the Upload for
+    the session, and DELETE abandons it.
+    """
+    session = get_object_or_404(Session, uuid=session_id)
+    session._request = request
+    path, offset = _chunked_offset(session, token)
+    if request.method == 'GET':
+        return JsonResponse({'ok': True, 'offset': offset})
+    elif request.method == 'PUT':
+        start, expected, error = _parse_chunk_range(request, offset)
+        if error is not None:
+            return error
+        received = _write_chunk(request, path, start, expected)
+        if received != expected:
+            return JsonResponse({'ok': False, 'error': 'Incomplete chunk.', 'offset': start + received}, status=400)
+        return JsonResponse({'ok': True, 'offset': start + received})
+    elif request.method == 'POST':
+        content_type = _response_content_type(request)
+        file_name = request.POST.get('file_name', '')
+        try:
+            if not file_name:
+                return JsonResponse({'ok': False, 'error': 'A file name is required.'}, content_type=content_type, status=400)
+            if 'file_size' in request.POST and int(request.POST['file_size']) != offset:
+                return JsonResponse({
+                    'ok': False,
+                    'error': 'Upload is incomplete.',
+                    'offset': offset,
+                }, content_type=content_type, status=409)
+            with open(path, 'rb') as fp:
+                file_uploaded.send(sender=File(fp, name=file_name), request=request, session=session)
+            # Move the finished file out from under its token, so it can no longer be written to.
+            fd, upload_path = make_temp_file()
+            os.close(fd)
+            os.rename(path, upload_path)
+            data = dict((key, value) for key, value in request.POST.items() if key not in ('file_name', 'file_size'))
+            upload = _create_upload(session, upload_path, file_name, offset, data, **_read_received(upload_path))
+            return _upload_response(upload, content_type)
+        except VirusFoundException as ex:
+            logger.exception(str(ex))
+            return JsonResponse({'ok': False, 'error': force_str(ex)}, content_type=content_type)
+        except Exception as ex:
+            logger.exception('Error attaching file to session %s', session_id)
+            return JsonResponse({'ok': False, 'error': force_str(ex)}, content_type=content_type)
+    elif request.method == 'DELETE':
+        os.remove(path)
+        return JsonResponse({'ok': True})
+    return HttpResponseNotAllowed(['GET', 'PUT', 'POST', 'DELETE'])
+
+
+def upload_status(request, session_id, upload_id):
+    """
+    Reports where an upload is in post-upload processing, for clients waiting on it to be clean (or rejected).
+    """
+    session = get_object_or_404(Session, uuid=session_id)
+    upload = get_object_or_404(session.uploads, pk=upload_id)
+    return JsonResponse({
+        'ok': upload.status != Upload.STATUS_REJECTED,
+        'status': upload.status,
+        'error': upload.status_message,
+        'file_name': upload.file_name,
+    })
+
+
 @csrf_exempt
 def delete_upload(request, session_id, upload_id):
     session = get_object_or_404(Session, uuid=session_id)
@@ -83,26 +314,84 @@ def delete_upload(request, session_id, upload_id):
         return JsonResponse({'ok': True})
     except Exception as ex:
         logger.exception('Error deleting upload (pk=%s, file_name=%s) from session %s', upload_id, file_name, session_id)
-        return JsonResponse({'ok': False, 'error': force_text(ex)})
+        return JsonResponse({'ok': False, 'error': force_str(ex)})
 
 
-def download(request, attach_id, filename=None):
+def _get_download(request, attach_id):
+    """
+    Returns the attachment being downloaded, raising Http404 if the user can't see it.
+    """
     attachment = get_object_or_404(Attachment, pk=attach_id)
     if not user_has_access(request, attachment):
         raise Http404()
     # Fire the download signal, in case receivers want to raise an Http404, or log downloads.
     file_download.send(sender=attachment, request=request)
-    storage = get_storage()
-    content_type = mimetypes.guess_type(attachment.file_name, strict=False)[0]
-    response = StreamingHttpResponse(FileWrapper(storage.open(attachment.file_path)), content_type=content_type)
+    return attachment
+
+
+def download(request, attach_id, filename=None):
+    attachment = _get_download(request, attach_id)
+    return get_download_backend().serve(request, attachment, attachment.get_storage(), attachment.get_content_type(),
+                                        filename)
+
+
+def thumbnail(request, attach_id, size):
+    """
+    Serves a rendition (thumbnail or preview, see attachments.renditions) of an attachment, generating it if needed.
+    """
+    if size not in renditions.get_sizes():
+        raise Http404()
+    # Previews show the file's contents, so file_download receivers get to veto (or log) them too.
+    attachment = _get_download(request, attach_id)
+    rendition = renditions.get_rendition(attachment, size)
+    if rendition is None:
+        raise Http404()
+    return renditions.serve_rendition(request, rendition)
+
+
+def download_zip(request, content_type_id, object_id):
+    """
+    Streams a ZIP archive of the attachments on an object, optionally limited to a context (?context=) or to specific
+    attachments (?id=1&id=2). Access is checked once for the object.
+    """
     try:
-        # Not all storage backends support getting filesize.
-        response['Content-Length'] = storage.size(attachment.file_path)
-    except NotImplementedError:
-        pass
-    if getattr(settings, 'ATTACHMENT_ALWAYS_DOWNLOAD', False) or not filename:
-        filename = url_filename(filename or attachment.file_name)
-        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        content_type = ContentType.objects.get_for_id(content_type_id)
+    except ContentType.DoesNotExist:
+        raise Http404()
+    attachments = Attachment.objects.filter(content_type=content_type, object_id=object_id).order_by('pk')
+    if 'context' in request.GET:
+        attachments = attachments.filter(context=request.GET['context'])
+    if request.GET.getlist('id'):
+        try:
+            attachments = attachments.filter(pk__in=[int(pk) for pk in request.GET.getlist('id')])
+        except ValueError:
+            raise Http404()
+    attachments = list(attachments)
+    if not attachments:
+        raise Http404()
+    # Every attachment belongs to the same object, so only resolve it (and check access to it) once.
+    obj = attachments[0].content_object
+    for attachment in attachments:
+        attachment.content_object = obj
+    auth = user_has_access(request, attachments[0])
+    if isinstance(auth, HttpResponse):
+        return auth
+    if not auth:
+        raise Http404()
+    included = []
+    for attachment in attachments:
+        try:
+            file_download.send(sender=attachment, request=request)
+            included.append(attachment)
+        except Http404:
+            # Receivers can veto individual files.
+            pass
+    if not included:
+        raise Http404()
+    block_size = getattr(settings, 'ATTACHMENT_DOWNLOAD_BLOCK_SIZE', 256 * 1024)
+    response = StreamingHttpResponse(iter_zip(included, block_size=block_size), content_type='application/zip')
+    filename = url_filename('%s.zip' % (force_str(obj) if obj is not None else 'attachments'))
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
     return response
 
 
@@ -110,7 +399,8 @@ def update_attachment(request, attach_id):
     attachment = get_object_or_404(Attachment, pk=attach_id)
     if not user_has_access(request, attachment):
         raise Http404()
-    if request.is_ajax() and request.method == 'POST':
+    # HttpRequest.is_ajax() was removed in Django 4.0.
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest' and request.method == 'POST':
         try:
             property_form = PropertyForm(request.POST, instance=attachment)
             if property_form.is_valid():
@@ -124,7 +414,7 @@ def update_attachment(request, attach_id):
                 })
         except Exception as ex:
             logger.exception('Error updating attachment (pk=%s, file_name=%s)', attach_id, attachment.file_name)
-            return JsonResponse({'ok': False, 'error': force_text(ex)})
+            return JsonResponse({'ok': False, 'error': force_str(ex)})
     raise Http404()
 
 
@@ -142,6 +432,7 @@ def view_attachment_properties(request, attach_id):
     attachment = get_object_or_404(Attachment, pk=attach_id)
     if not user_has_access(request, attachment):
         raise Http404()
+    prefetch_property_values([attachment])
     return render(request, 'attachments/view_properties.html', {
         'att': attachment,
     })
@@ -0,0 +1,25 @@
+"""
+Setup for the worker processes used by attachments.processing and attachments.renditions.
+
+This module mustn't import any models, since spawned workers (the default start method on macOS, and an option
+everywhere) import it before Django is set up. Spawned workers find their settings through DJANGO_SETTINGS_MODULE, so
+projects calling settings.configure() themselves need the fork start method.
+"""
+
+from django.apps import apps
+from django.db import connections
+
+import django
+
+
+def init_process():
+    """
+    Initializer for worker process pools.
+    """
+    if not apps.ready:
+        # A spawned worker starts from a fresh interpreter.
+        django.setup()
+        return
+    # Forked workers must not share the parent's database connections; drop them without closing the sockets.
+    for conn in connections.all():
+        conn.connection = None
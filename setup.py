@@ -14,11 +14,13 @@ setup(
     packages=find_packages(exclude=('testapp',)),
     include_package_data=True,
     install_requires=[
-        'pyclamd',
         'six',
         'python-magic',
         'python-magic-bin;platform_system=="Windows"',
     ],
+    extras_require={
+        'async': ['aiofiles'],
+    },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
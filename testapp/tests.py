@@ -1,15 +1,165 @@
 # -*- coding: utf-8 -*-
 
-from django.test import RequestFactory, TestCase
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, IntegrityError, connection, connections, models, transaction
+from django.db.models.signals import post_delete
+from django.http import Http404
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from unittest import mock
 
-from attachments.utils import session, url_filename
+from attachments import processing, renditions, scanning, workers
+from attachments.cache import (
+    PROPERTY_VERSION_KEY, get_properties, get_property_version, invalidate_access, invalidate_properties)
+from attachments.deletion import delete_orphaned_attachments
+from attachments.models import Attachment, Blob, Property, Rendition, Session, Upload, prefetch_property_values
+from attachments.signals import file_download
+from attachments.templatetags.attachments import attachments_zip_url
+from attachments.utils import (
+    UploadPolicy, detect_file_type, get_storage, get_storage_name, reset_storages, session, url_filename)
 
 from .models import Document
 
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import django
+import hashlib
 import io
+import json
+import multiprocessing
+import os
+import shutil
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+
+# Upload IDs handed to the processing queue (see test_async_processing).
+queued_uploads = []
+
+
+def queue_upload(upload_id):
+    queued_uploads.append(upload_id)
+
+
+def worker_state():
+    from django.apps import apps
+    return apps.ready, settings.SETTINGS_MODULE
+
+
+class FakeClamdHandler (socketserver.StreamRequestHandler):
+    """
+    Speaks just enough of the clamd protocol (IDSESSION, INSTREAM, SCAN and END) for the tests. Anything containing
+    "EICAR" is reported as infected.
+    """
+
+    def read_command(self):
+        cmd = b''
+        while True:
+            c = self.rfile.read(1)
+            if not c or c == b'\0':
+                return cmd or None
+            cmd += c
+
+    def verdict(self, data):
+        return b'Eicar-Test-Signature FOUND' if b'EICAR' in data else b'OK'
+
+    def handle(self):
+        self.server.connections += 1
+        in_session = False
+        number = 0
+        while True:
+            cmd = self.read_command()
+            if cmd is None or cmd == b'zEND':
+                return
+            self.server.commands.append(cmd.split()[0])
+            if cmd == b'zIDSESSION':
+                in_session = True
+                continue
+            number += 1
+            if cmd == b'zINSTREAM':
+                data = b''
+                while True:
+                    size = struct.unpack('!L', self.rfile.read(4))[0]
+                    if not size:
+                        break
+                    data += self.rfile.read(size)
+                reply = b'stream: ' + self.verdict(data)
+            else:
+                path = cmd.split(b' ', 1)[1]
+                with open(path, 'rb') as fp:
+                    reply = path + b': ' + self.verdict(fp.read())
+            if in_session:
+                reply = str(number).encode() + b': ' + reply
+            self.wfile.write(reply + b'\0')
+            if not in_session:
+                return
+
+
+class FakeClamd (socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        socketserver.UnixStreamServer.__init__(self, path, FakeClamdHandler)
+        self.connections = 0
+        self.commands = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
 
 
 class AttachmentTests (TestCase):
+    databases = {'default', 'other'}
+
+    def setUp(self):
+        # Properties published by other tests (through run_commit_hooks) were rolled back without sending any signals.
+        invalidate_properties()
+        self.run_commit_hooks()
+
+    def temp_storage(self):
+        """
+        Returns settings overrides that put temp uploads and stored attachments in a fresh directory.
+        """
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        return override_settings(
+            ATTACHMENT_TEMP_DIR=os.path.join(root, 'temp'),
+            ATTACHMENT_STORAGE=('django.core.files.storage.FileSystemStorage', {'location': os.path.join(root, 'storage')}),
+        )
+
+    def attach_file(self, name='testfile', data=b'some data', obj=None):
+        sess = session(RequestFactory().get('/test/page/'))
+        self.upload_file(sess, name=name, data=data)
+        attachment = sess.attach(obj or Document.objects.create(data={}))[0]
+        sess.delete()
+        return attachment
+
+    def run_commit_hooks(self, using=DEFAULT_DB_ALIAS):
+        """
+        Runs the transaction.on_commit callbacks queued so far, which TestCase would otherwise never run.
+        """
+        conn = connections[using]
+        while conn.run_on_commit:
+            callbacks, conn.run_on_commit = conn.run_on_commit, []
+            for callback in callbacks:
+                # (savepoint IDs, func), plus a robust flag since Django 4.2.
+                callback[1]()
+
+    def upload_file(self, sess, name='testfile', data=b'some data'):
+        att = io.BytesIO(data)
+        att.name = name
+        return self.client.post('/attachments/%s/' % sess.uuid, {'attachment': att})
 
     def test_url_filename_character_escaping(self):
         self.assertEqual(url_filename(u'Résumé.pdf'), 'R%C3%A9sum%C3%A9.pdf')
@@ -41,3 +191,847 @@ class AttachmentTests (TestCase):
         upload = sess.uploads.get()
         self.assertEqual(upload.file_name, att.name)
         self.assertEqual(upload.file_size, len(att_data))
+
+    def test_chunked_upload(self):
+        att_data = b'some chunked data'
+        request = RequestFactory().get('/test/page/')
+        sess = session(request)
+        response = self.client.post('/attachments/%s/chunked/' % sess.uuid)
+        url = response.json()['url']
+        response = self.client.put(url, att_data[:5], content_type='application/octet-stream',
+                                   HTTP_CONTENT_RANGE='bytes 0-4/%d' % len(att_data))
+        self.assertEqual(response.json(), {'ok': True, 'offset': 5})
+        # A chunk that would leave a gap is refused, and the client is told where to resume.
+        response = self.client.put(url, att_data[10:], content_type='application/octet-stream',
+                                   HTTP_CONTENT_RANGE='bytes 10-%d/%d' % (len(att_data) - 1, len(att_data)))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.get(url).json()['offset'], 5)
+        # Retrying an overlapping chunk is fine.
+        response = self.client.put(url, att_data[3:], content_type='application/octet-stream',
+                                   HTTP_CONTENT_RANGE='bytes 3-%d/%d' % (len(att_data) - 1, len(att_data)))
+        self.assertEqual(response.json()['offset'], len(att_data))
+        # The finished file is hashed in the same pass that scans it, and sniffed by libmagic from disk.
+        with mock.patch('attachments.views.file_digest') as file_digest, \
+                mock.patch('attachments.views.detect_file_type', wraps=detect_file_type) as detect:
+            response = self.client.post(url, {'file_name': 'testfile', 'file_size': len(att_data)})
+        self.assertFalse(file_digest.called)
+        self.assertEqual(len(detect.call_args_list), 1)
+        self.assertNotIn('buffer', detect.call_args[1])
+        self.assertEqual(response.json(), {
+            'ok': True,
+            'file_name': 'testfile',
+            'file_size': len(att_data),
+        })
+        upload = sess.uploads.get()
+        self.assertEqual(upload.file_name, 'testfile')
+        self.assertEqual(upload.digest, hashlib.sha256(att_data).hexdigest())
+        with open(upload.file_path, 'rb') as fp:
+            self.assertEqual(fp.read(), att_data)
+        # The token is spent once the upload has been finalized.
+        self.assertEqual(self.client.get(url).status_code, 404)
+        upload.delete()
+
+    def test_session_update_data(self):
+        request = RequestFactory().get('/test/page/')
+        sess = session(request)
+        # Two requests working from the same stale copy of the session must not drop each other's keys.
+        other = Session.objects.get(pk=sess.pk)
+        sess.update_data({'upload-1-name': 'one'})
+        other.update_data({'upload-2-name': 'two'})
+        self.assertEqual(Session.objects.get(pk=sess.pk).data, {
+            'upload-1-name': 'one',
+            'upload-2-name': 'two',
+        })
+
+    def test_attach_links_local_files(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        storage = ('django.core.files.storage.FileSystemStorage', {'location': os.path.join(root, 'storage')})
+        with override_settings(ATTACHMENT_TEMP_DIR=os.path.join(root, 'temp'), ATTACHMENT_STORAGE=storage):
+            request = RequestFactory().get('/test/page/')
+            sess = session(request)
+            att = io.BytesIO(b'some data')
+            att.name = 'testfile'
+            self.client.post('/attachments/%s/' % sess.uuid, {'attachment': att})
+            upload = sess.uploads.get()
+            attachment = sess.attach(Document.objects.create(data={}))[0]
+            self.assertEqual(attachment.promotion, 'link')
+            stored = os.path.join(root, 'storage', attachment.file_path)
+            self.assertTrue(os.path.samefile(stored, upload.file_path))
+            # Removing the upload leaves the attached file intact.
+            sess.delete()
+            with open(stored, 'rb') as fp:
+                self.assertEqual(fp.read(), b'some data')
+            with override_settings(ATTACHMENT_ZERO_COPY=False):
+                sess = session(request)
+                att.seek(0)
+                self.client.post('/attachments/%s/' % sess.uuid, {'attachment': att})
+                attachment = sess.attach(Document.objects.create(data={}))[0]
+                self.assertEqual(attachment.promotion, 'copy')
+
+    def test_bulk_attach(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        storage = ('django.core.files.storage.FileSystemStorage', {'location': os.path.join(root, 'storage')})
+        request = RequestFactory().get('/test/page/')
+        with override_settings(ATTACHMENT_TEMP_DIR=os.path.join(root, 'temp'), ATTACHMENT_STORAGE=storage):
+            queries = []
+            for count in (1, 5):
+                sess = session(request)
+                for i in range(count):
+                    self.upload_file(sess, name='file%d.txt' % i)
+                doc = Document.objects.create(data={})
+                with CaptureQueriesContext(connection) as ctx:
+                    attached = sess.attach(doc, bulk=True)
+                queries.append(len(ctx))
+                self.assertEqual(len(attached), count)
+                self.assertEqual(set(a.pk for a in attached), set(Attachment.objects.filter(object_id=doc.pk).values_list('pk', flat=True)))
+            self.assertEqual(queries[0], queries[1])
+
+    def test_upload_scanned_while_receiving(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        clamd = FakeClamd(os.path.join(root, 'clamd.sock'))
+        self.addCleanup(clamd.server_close)
+        self.addCleanup(clamd.shutdown)
+        self.addCleanup(scanning.get_pool().clear)
+        temp_dir = os.path.join(root, 'temp')
+        with override_settings(ATTACHMENTS_CLAMD=True, ATTACHMENTS_CLAMD_SOCKET=clamd.server_address,
+                               ATTACHMENT_TEMP_DIR=temp_dir):
+            sess = session(RequestFactory().get('/test/page/'))
+            self.assertTrue(self.upload_file(sess, name='one.txt').json()['ok'])
+            self.assertTrue(self.upload_file(sess, name='two.txt').json()['ok'])
+            # Both files were streamed to clamd over the same pooled connection, without a second pass from disk.
+            self.assertEqual(clamd.connections, 1)
+            self.assertEqual(clamd.commands, [b'zIDSESSION', b'zINSTREAM', b'zINSTREAM'])
+            response = self.upload_file(sess, name='virus.txt', data=b'X5O!P%@AP EICAR')
+            self.assertFalse(response.json()['ok'])
+            self.assertIn('Eicar-Test-Signature', response.json()['error'])
+            self.assertEqual(sorted(sess.uploads.values_list('file_name', flat=True)), ['one.txt', 'two.txt'])
+            self.assertEqual(len(os.listdir(temp_dir)), 2)
+            # Chunked uploads are streamed to clamd in the same pass that hashes them once they're complete.
+            url = self.client.post('/attachments/%s/chunked/' % sess.uuid).json()['url']
+            self.client.put(url, b'EICAR', content_type='application/octet-stream', HTTP_CONTENT_RANGE='bytes 0-4/5')
+            self.assertFalse(self.client.post(url, {'file_name': 'virus.txt'}).json()['ok'])
+            self.assertEqual(clamd.commands[-1], b'zINSTREAM')
+            self.assertNotIn(b'zSCAN', clamd.commands)
+
+    def test_upload_scan_error(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.addCleanup(scanning.get_pool().clear)
+        temp_dir = os.path.join(root, 'temp')
+        with override_settings(ATTACHMENTS_CLAMD=True, ATTACHMENTS_CLAMD_SOCKET=os.path.join(root, 'missing.sock'),
+                               ATTACHMENT_TEMP_DIR=temp_dir):
+            sess = session(RequestFactory().get('/test/page/'))
+            response = self.upload_file(sess, name='one.txt')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            self.assertFalse(response.json()['ok'])
+            self.assertTrue(response.json()['error'])
+            self.assertFalse(sess.uploads.exists())
+            self.assertEqual(os.listdir(temp_dir), [])
+
+    def test_upload_file_type_detected_once(self):
+        sess = session(RequestFactory().get('/test/page/'), allowed_file_extensions='pdf')
+        self.upload_file(sess, name='doc.pdf', data=b'%PDF-1.4\n%%EOF\n')
+        upload = sess.uploads.get()
+        self.assertEqual(upload.mime_type, 'application/pdf')
+        self.assertTrue(upload.file_type.startswith('PDF document'))
+        # Validation only looks at what was recorded at upload time.
+        with mock.patch('attachments.models.detect_file_type', side_effect=AssertionError):
+            self.assertEqual(sess.validate_attachment(upload), '')
+        upload.delete()
+        # Container formats are identified from the whole file, just as libmagic identifies them on disk.
+        docx = io.BytesIO()
+        with zipfile.ZipFile(docx, 'w') as z:
+            z.writestr('[Content_Types].xml', '<Types/>')
+            z.writestr('docProps/app.xml', os.urandom(100 * 1024))
+            z.writestr('word/document.xml', '<w:document/>')
+        self.upload_file(sess, name='doc.docx', data=docx.getvalue())
+        upload = sess.uploads.get()
+        self.assertEqual((upload.mime_type, upload.file_type), detect_file_type(upload.file_path))
+        upload.delete()
+
+    def test_upload_policy(self):
+        policy = UploadPolicy.get('pdf .txt', 'ASCII text')
+        self.assertIs(policy, UploadPolicy.get('pdf .txt', 'ASCII text'))
+        self.assertEqual(policy.extensions, ('.pdf', '.txt'))
+        self.assertTrue(policy.allows_extension('doc.pdf'))
+        self.assertFalse(policy.allows_extension('doc.exe'))
+        self.assertTrue(policy.allows_mime_type('application/pdf'))
+        self.assertFalse(policy.allows_mime_type('image/png'))
+        self.assertTrue(policy.allows_file_type('ASCII text'))
+        self.assertFalse(UploadPolicy.get('', ''))
+        sess = session(RequestFactory().get('/test/page/'), allowed_file_extensions='txt')
+        self.upload_file(sess, name='image.png', data=b'\x89PNG\r\n\x1a\n')
+        self.upload_file(sess, name='fake.txt', data=b'\x89PNG\r\n\x1a\n')
+        errors = dict((u.file_name, sess.validate_attachment(u)) for u in sess.uploads.all())
+        self.assertIn('Unsupported file format', errors['image.png'])
+        self.assertIn('the content is not', errors['fake.txt'])
+        sess.delete()
+
+    def test_upload_forms_queries(self):
+        ct = ContentType.objects.get_for_model(Document)
+        for slug, data_type in (('title', 'string'), ('document', 'model'), ('reviewed', 'boolean')):
+            prop = Property.objects.create(label=slug, slug=slug, data_type=data_type, model='testapp.models.Document')
+            prop.content_type.add(ct)
+        Document.objects.create(data={})
+        queries = []
+        for count in (1, 5):
+            sess = session(RequestFactory().get('/test/page/'), content_type=Document)
+            for i in range(count):
+                self.upload_file(sess, name='file%d.txt' % i)
+            sess = Session.objects.get(pk=sess.pk)
+            sess.update_data({'upload-%d-title' % upload.pk: ['Title'] for upload in sess.uploads.all()})
+            invalidate_properties()
+            self.run_commit_hooks()
+            with CaptureQueriesContext(connection) as ctx:
+                for error, upload, form in sess.upload_forms:
+                    self.assertIsNone(error)
+                    self.assertEqual(len(form.fields), 3)
+                    self.assertIn('Title', str(form))
+            queries.append(len(ctx))
+            sess.delete()
+        self.assertEqual(queries[0], queries[1])
+
+    def test_property_cache(self):
+        ct = ContentType.objects.get_for_model(Document)
+        prop = Property.objects.create(label='Title', slug='title', data_type='string')
+        prop.content_type.add(ct)
+        self.assertEqual(get_properties(ct), [prop])
+        # Nothing is cached until the change commits, in case it's rolled back.
+        with self.assertNumQueries(1):
+            self.assertEqual(get_properties(ct), [prop])
+        self.run_commit_hooks()
+        self.assertEqual(get_properties(ct), [prop])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_properties(ct), [prop])
+            self.assertEqual(get_properties(ct, editable_only=True), [prop])
+        prop.is_editable = False
+        prop.save()
+        self.assertEqual(get_properties(ct, editable_only=True), [])
+        prop.content_type.remove(ct)
+        self.assertEqual(get_properties(ct), [])
+        self.run_commit_hooks()
+        # A rolled back change leaves nothing behind in the cache.
+        try:
+            with transaction.atomic():
+                prop.content_type.add(ct)
+                self.assertEqual(get_properties(ct), [prop])
+                raise DatabaseError()
+        except DatabaseError:
+            pass
+        self.assertEqual(get_properties(ct), [])
+        with override_settings(ATTACHMENT_PROPERTY_CACHE='default'):
+            version = get_property_version()
+            self.assertEqual(get_properties(ct), [])
+            prop.content_type.add(ct)
+            self.assertEqual(get_property_version(), version)
+            self.run_commit_hooks()
+            self.assertNotEqual(get_property_version(), version)
+            self.assertEqual(get_properties(ct), [prop])
+            # Another process changing a property bumps the shared version, which this process picks up.
+            Property.objects.filter(pk=prop.pk).update(label='Name')
+            caches['default'].incr(PROPERTY_VERSION_KEY)
+            self.assertEqual(get_properties(ct)[0].label, 'Name')
+        # Without a shared version, locally cached properties expire, so other processes' changes show up eventually.
+        with override_settings(ATTACHMENT_PROPERTY_CACHE=None, ATTACHMENT_PROPERTY_CACHE_TIMEOUT=60):
+            self.assertEqual(get_properties(ct)[0].label, 'Name')
+            Property.objects.filter(pk=prop.pk).update(label='Heading')
+            self.assertEqual(get_properties(ct)[0].label, 'Name')
+            with mock.patch('attachments.cache.time.time', return_value=time.time() + 61):
+                self.assertEqual(get_properties(ct)[0].label, 'Heading')
+
+    def test_prefetch_property_values(self):
+        ct = ContentType.objects.get_for_model(Document)
+        prop = Property.objects.create(label='Related', slug='related', data_type='model', model='testapp.models.Document')
+        prop.content_type.add(ct)
+        title = Property.objects.create(label='Title', slug='title', data_type='string')
+        title.content_type.add(ct)
+        docs = [Document.objects.create(data={}) for _i in range(3)]
+        attachments = [Attachment.objects.create(file_path='doc%d' % i, file_name='doc%d' % i, file_size=0,
+                                                 content_object=doc, data={'related': [str(docs[-1 - i].pk)], 'title': ['T']})
+                       for i, doc in enumerate(docs)]
+        attachments = list(Attachment.objects.filter(pk__in=[a.pk for a in attachments]).order_by('pk'))
+        self.run_commit_hooks()
+        get_properties(ct)
+        with self.assertNumQueries(1):
+            prefetch_property_values(attachments)
+        with self.assertNumQueries(0):
+            for i, attachment in enumerate(attachments):
+                self.assertEqual(attachment.get_field(prop), ('Related', docs[-1 - i]))
+                self.assertEqual(attachment.get_field(title), ('Title', ['T']))
+
+    def test_download_ranges(self):
+        self.client.force_login(User.objects.create_user('user'))
+        with self.temp_storage():
+            attachment = self.attach_file(name='data.bin', data=b'0123456789')
+            url = attachment.get_absolute_url()
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+            etag = response['ETag']
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+            response = self.client.get(url, HTTP_RANGE='bytes=2-5')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+            self.assertEqual(b''.join(response.streaming_content), b'2345')
+            response = self.client.get(url, HTTP_RANGE='bytes=-3')
+            self.assertEqual(b''.join(response.streaming_content), b'789')
+            response = self.client.get(url, HTTP_RANGE='bytes=0-1,8-')
+            self.assertTrue(response['Content-Type'].startswith('multipart/byteranges; boundary='))
+            body = b''.join(response.streaming_content)
+            self.assertEqual(len(body), int(response['Content-Length']))
+            self.assertIn(b'Content-Range: bytes 0-1/10\r\n\r\n01\r\n', body)
+            self.assertIn(b'Content-Range: bytes 8-9/10\r\n\r\n89\r\n', body)
+            response = self.client.get(url, HTTP_RANGE='bytes=20-')
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response['Content-Range'], 'bytes */10')
+            # A stale If-Range means the client gets the whole (changed) file.
+            self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"stale"').status_code, 200)
+            self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=etag).status_code, 206)
+
+    def test_update_attachment(self):
+        self.client.force_login(User.objects.create_user('user'))
+        with self.temp_storage():
+            attachment = self.attach_file()
+            url = reverse('update-attachment', kwargs={'attach_id': attachment.pk})
+            self.assertEqual(self.client.post(url).status_code, 404)
+            response = self.client.post(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEqual(response.json(), {'ok': True})
+
+    def test_download_content_type(self):
+        self.client.force_login(User.objects.create_user('user'))
+        with self.temp_storage():
+            attachment = self.attach_file(name='notes.txt', data=b'<html><script>alert(1)</script></html>')
+            self.assertEqual(attachment.mime_type, 'text/html')
+            # Files are served as the type their name implies, never what the contents look like.
+            response = self.client.get(attachment.get_absolute_url())
+            self.assertEqual(response['Content-Type'], 'text/plain')
+            self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+            b''.join(response.streaming_content)
+
+    def test_download_backends(self):
+        self.client.force_login(User.objects.create_user('user'))
+        with self.temp_storage():
+            attachment = self.attach_file(name='data.bin')
+            url = attachment.get_absolute_url()
+            with override_settings(ATTACHMENT_DOWNLOAD_BACKEND=('attachments.downloads.XAccelRedirectBackend', {'prefix': '/protected'})):
+                response = self.client.get(url)
+                self.assertEqual(response['X-Accel-Redirect'], '/protected/' + attachment.file_path)
+                self.assertEqual(response.content, b'')
+            with override_settings(ATTACHMENT_DOWNLOAD_BACKEND=('attachments.downloads.XSendfileBackend', {})):
+                response = self.client.get(url)
+                self.assertEqual(response['X-Sendfile'], get_storage().path(attachment.file_path))
+            with override_settings(ATTACHMENT_DOWNLOAD_BACKEND=('attachments.downloads.RedirectBackend', {})):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 302)
+                self.assertEqual(response['Location'], get_storage().url(attachment.file_path))
+            # Access is still checked before handing off.
+            self.client.logout()
+            with override_settings(ATTACHMENT_DOWNLOAD_BACKEND=('attachments.downloads.XSendfileBackend', {})):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_download_local_file(self):
+        self.client.force_login(User.objects.create_user('user'))
+        data = b'0123456789' * 1000
+        with self.temp_storage():
+            attachment = self.attach_file(name='data.bin', data=data)
+            url = attachment.get_absolute_url()
+            response = self.client.get(url)
+            # The real file is available for wsgi.file_wrapper, and closing it closes the response.
+            stored = get_storage().path(attachment.file_path)
+            self.assertEqual(os.fstat(response.file_to_stream.fileno()).st_ino, os.stat(stored).st_ino)
+            response.file_to_stream.close()
+            self.assertTrue(response.file_to_stream._fp.closed)
+            with override_settings(ATTACHMENT_DOWNLOAD_MMAP=True, ATTACHMENT_DOWNLOAD_BLOCK_SIZE=4096):
+                response = self.client.get(url)
+                chunks = list(response.streaming_content)
+                self.assertEqual(b''.join(chunks), data)
+                self.assertEqual(len(chunks), 3)
+                self.assertEqual(response['Content-Length'], str(len(data)))
+
+    def test_download_zip(self):
+        self.client.force_login(User.objects.create_user('user'))
+        doc = Document.objects.create(data={})
+        downloads = []
+        file_download.connect(lambda sender, **kwargs: downloads.append(sender.pk), weak=False, dispatch_uid='zip-test')
+        self.addCleanup(file_download.disconnect, dispatch_uid='zip-test')
+        with self.temp_storage():
+            first = self.attach_file(name='notes.txt', data=b'some notes ' * 100, obj=doc)
+            second = self.attach_file(name='notes.txt', data=b'other notes', obj=doc)
+            third = self.attach_file(name='photo.jpg', data=b'\xff\xd8\xff' * 100, obj=doc)
+            url = attachments_zip_url(doc)
+            response = self.client.get(url)
+            self.assertEqual(response['Content-Type'], 'application/zip')
+            archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+            self.assertEqual(archive.namelist(), ['notes.txt', 'notes (2).txt', 'photo.jpg'])
+            self.assertEqual(archive.read('notes (2).txt'), b'other notes')
+            self.assertEqual(archive.getinfo('notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(archive.getinfo('photo.jpg').compress_type, zipfile.ZIP_STORED)
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(downloads, [first.pk, second.pk, third.pk])
+            response = self.client.get(url, {'id': [second.pk, third.pk]})
+            archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+            self.assertEqual(archive.namelist(), ['notes.txt', 'photo.jpg'])
+            self.client.logout()
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    @override_settings(ATTACHMENT_ACCESS_CACHE_TIMEOUT=60)
+    def test_access_cache(self):
+        caches['default'].clear()
+        user = User.objects.create_user('user')
+        self.client.force_login(user)
+        doc = Document.objects.create(data={})
+        with self.temp_storage():
+            attachment = self.attach_file(name='notes.txt', data=b'notes', obj=doc)
+            url = attachment.get_absolute_url()
+            with mock.patch.object(Document, 'can_download', create=True, return_value=True) as can_download:
+                self.assertEqual(self.client.get(url).status_code, 200)
+                # Once the answer is cached, the content object isn't loaded at all.
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(self.client.get(url).status_code, 200)
+                self.assertFalse(any('testapp_document' in q['sql'] for q in queries.captured_queries))
+                self.assertEqual(can_download.call_count, 1)
+                can_download.return_value = False
+                invalidate_access(obj=doc)
+                self.assertEqual(self.client.get(url).status_code, 404)
+                self.assertEqual(self.client.get(url).status_code, 404)
+                self.assertEqual(can_download.call_count, 2)
+                can_download.return_value = True
+                invalidate_access(user=user)
+                self.assertEqual(self.client.get(url).status_code, 200)
+                invalidate_access()
+                self.assertEqual(self.client.get(url).status_code, 200)
+                self.assertEqual(can_download.call_count, 4)
+            with override_settings(ATTACHMENT_ACCESS_CACHE_TIMEOUT=0):
+                with CaptureQueriesContext(connection) as queries:
+                    self.client.get(url)
+                self.assertTrue(any('testapp_document' in q['sql'] for q in queries.captured_queries))
+
+    @override_settings(ATTACHMENT_DEDUPLICATE=True)
+    def test_deduplicated_storage(self):
+        data = b'the same contents'
+        with self.temp_storage():
+            storage = get_storage()
+            first = self.attach_file(name='one.txt', data=data)
+            second = self.attach_file(name='two.txt', data=data)
+            other = self.attach_file(name='three.txt', data=b'different contents')
+            blob = Blob.objects.get(digest=hashlib.sha256(data).hexdigest())
+            self.assertEqual(blob.ref_count, 2)
+            self.assertEqual(first.blob_id, blob.pk)
+            self.assertEqual(second.promotion, 'dedup')
+            self.assertEqual(first.file_path, second.file_path)
+            self.assertNotEqual(first.file_path, other.file_path)
+            with storage.open(second.file_path) as fp:
+                self.assertEqual(fp.read(), data)
+            # The same file uploaded twice to one session, attached in bulk.
+            sess = session(RequestFactory().get('/test/page/'))
+            self.upload_file(sess, name='a.txt', data=data)
+            self.upload_file(sess, name='b.txt', data=data)
+            attached = sess.attach(Document.objects.create(data={}), bulk=True)
+            self.assertEqual(len(set(a.pk for a in attached)), 2)
+            self.assertEqual(Blob.objects.get(pk=blob.pk).ref_count, 4)
+            for attachment in [first, second] + attached[:1]:
+                attachment.delete()
+            self.assertTrue(storage.exists(blob.file_path))
+            attached[1].delete()
+            self.run_commit_hooks()
+            self.assertFalse(Blob.objects.filter(pk=blob.pk).exists())
+            self.assertFalse(storage.exists(blob.file_path))
+            # Failing to save an attachment doesn't leak a reference to its blob.
+            sess = session(RequestFactory().get('/test/page/'))
+            self.upload_file(sess, name='c.txt', data=b'different contents')
+            refs = Blob.objects.get(pk=other.blob_id).ref_count
+            with self.assertRaises(ValueError), mock.patch.object(Attachment, 'save', side_effect=ValueError):
+                sess.attach(Document.objects.create(data={}))
+            self.assertEqual(Blob.objects.get(pk=other.blob_id).ref_count, refs)
+            # Files attached directly are deduplicated too.
+            raw = Attachment.objects.attach_raw(ContentFile(b'different contents', name='raw.txt'),
+                                                Document.objects.create(data={}), storage=storage)
+            self.assertEqual(raw.blob_id, other.blob_id)
+
+    def test_delete_using(self):
+        doc = Document.objects.using('other').create(data={})
+        content_type = ContentType.objects.db_manager('other').get_for_model(Document)
+        with self.temp_storage():
+            storage = get_storage()
+            path = storage.save('shared.txt', ContentFile(b'shared'))
+            blob = Blob.objects.using('other').create(digest='shared', file_path=path, file_size=6, ref_count=3)
+            attachments = [
+                Attachment.objects.using('other').create(file_path=path, file_name='shared.txt', file_size=6, blob=blob,
+                                                         content_type=content_type, object_id=doc.pk)
+                for i in range(3)
+            ]
+            attachments[0].delete()
+            self.assertEqual(Blob.objects.using('other').get(pk=blob.pk).ref_count, 2)
+            Attachment.objects.using('other').filter(pk__in=[a.pk for a in attachments]).delete()
+            self.assertFalse(Blob.objects.using('other').filter(pk=blob.pk).exists())
+            # The file goes once the transaction on the other database commits.
+            self.assertTrue(storage.exists(path))
+            self.run_commit_hooks(using='other')
+            self.assertFalse(storage.exists(path))
+
+    def test_unique_file_path(self):
+        with self.temp_storage():
+            attachment = self.attach_file()
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                Attachment.objects.create(file_path=attachment.file_path, file_name='copy', file_size=0,
+                                          content_object=attachment.content_object)
+
+    def test_attachment_digest(self):
+        self.client.force_login(User.objects.create_user('user'))
+        data = b'%PDF-1.4\n' + b'x' * 1000
+        with self.temp_storage():
+            attachment = self.attach_file(name='report', data=data)
+            self.assertEqual(attachment.digest, hashlib.sha256(data).hexdigest())
+            self.assertEqual(attachment.mime_type, 'application/pdf')
+            response = self.client.get(attachment.get_absolute_url())
+            # The detected type is only recorded; the response type comes from the name, which has no extension.
+            self.assertEqual(response['Content-Type'], 'application/octet-stream')
+            self.assertEqual(response['ETag'], '"%s"' % attachment.digest)
+            # Attachments from before digests were recorded can be backfilled.
+            Attachment.objects.filter(pk=attachment.pk).update(digest='', mime_type='')
+            out = io.StringIO()
+            call_command('backfill_attachment_digests', workers=2, stdout=out)
+            self.assertIn('Updated 1 attachments (0 failed)', out.getvalue())
+            attachment.refresh_from_db()
+            self.assertEqual(attachment.digest, hashlib.sha256(data).hexdigest())
+            self.assertEqual(attachment.mime_type, 'application/pdf')
+
+    def test_cleanup_attachment_sessions(self):
+        with self.temp_storage():
+            old = session(RequestFactory().get('/test/page/'))
+            self.upload_file(old, name='one.txt')
+            self.upload_file(old, name='two.txt')
+            new = session(RequestFactory().get('/test/page/'))
+            self.upload_file(new, name='three.txt')
+            Session.objects.filter(pk=old.pk).update(date_created=timezone.now() - datetime.timedelta(days=2))
+            old_paths = list(old.uploads.values_list('file_path', flat=True))
+            # An abandoned temp file with no upload, one that may still be in progress, and a file that isn't ours.
+            temp_dir = os.path.dirname(old_paths[0])
+            abandoned = os.path.join(temp_dir, 'attachment-abandoned')
+            in_progress = os.path.join(temp_dir, 'chunked-in-progress')
+            unrelated = os.path.join(temp_dir, 'unrelated.db')
+            for path in (abandoned, in_progress, unrelated):
+                with open(path, 'wb') as fp:
+                    fp.write(b'data')
+            past = time.time() - 3 * 86400
+            for path in [abandoned, unrelated] + old_paths + list(new.uploads.values_list('file_path', flat=True)):
+                os.utime(path, (past, past))
+            out = io.StringIO()
+            call_command('cleanup_attachment_sessions', hours=24, batch_size=1, stdout=out)
+            self.assertIn('Deleted 1 sessions and 2 uploads, removed 3 temp files (1 orphaned, 0 errors)', out.getvalue())
+            self.assertFalse(Session.objects.filter(pk=old.pk).exists())
+            self.assertFalse(any(os.path.exists(path) for path in old_paths + [abandoned]))
+            self.assertTrue(os.path.exists(in_progress))
+            self.assertTrue(os.path.exists(unrelated))
+            # Without ATTACHMENT_TEMP_DIR, files are in the system temp dir, which is never swept.
+            with override_settings(ATTACHMENT_TEMP_DIR=None), \
+                    mock.patch('tempfile.gettempdir', return_value=temp_dir):
+                out, err = io.StringIO(), io.StringIO()
+                call_command('cleanup_attachment_sessions', hours=24, stdout=out, stderr=err)
+            self.assertIn('ATTACHMENT_TEMP_DIR is not set', err.getvalue())
+            self.assertIn('removed 0 temp files', out.getvalue())
+            self.assertTrue(os.path.exists(new.uploads.get().file_path))
+            # Deleting a session removes its uploads and their files.
+            path = new.uploads.get().file_path
+            new.delete()
+            self.run_commit_hooks()
+            self.assertFalse(Upload.objects.exists())
+            self.assertFalse(os.path.exists(path))
+
+    @override_settings(ATTACHMENT_DELETE_RETRY_DELAY=0)
+    def test_bulk_delete(self):
+        doc = Document.objects.create(data={})
+        with self.temp_storage():
+            storage = get_storage()
+            attachments = [self.attach_file(name='file%d.txt' % i, obj=doc) for i in range(3)]
+            self.run_commit_hooks()
+            paths = [storage.path(a.file_path) for a in attachments]
+            with CaptureQueriesContext(connection) as queries:
+                Attachment.objects.filter(object_id=doc.pk).delete()
+            self.assertEqual(len([q for q in queries.captured_queries if q['sql'].startswith('DELETE')]), 1)
+            # Files are only removed once the transaction commits.
+            self.assertTrue(all(os.path.exists(path) for path in paths))
+            real_delete = storage.delete
+            failures = []
+
+            def flaky_delete(name):
+                if name not in failures:
+                    failures.append(name)
+                    raise IOError('Temporary failure')
+                real_delete(name)
+
+            with mock.patch.object(storage, 'delete', side_effect=flaky_delete), \
+                    mock.patch('attachments.deletion.get_storage', return_value=storage):
+                self.run_commit_hooks()
+            self.assertEqual(len(failures), 3)
+            self.assertFalse(any(os.path.exists(path) for path in paths))
+            # Attachments can be deleted along with their object.
+            post_delete.connect(delete_orphaned_attachments, sender=Document, dispatch_uid='delete-test')
+            self.addCleanup(post_delete.disconnect, sender=Document, dispatch_uid='delete-test')
+            attachment = self.attach_file(obj=doc)
+            doc.delete()
+            self.run_commit_hooks()
+            self.assertFalse(Attachment.objects.exists())
+            self.assertFalse(storage.exists(attachment.file_path))
+
+    def test_async_processing(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        clamd = FakeClamd(os.path.join(root, 'clamd.sock'))
+        self.addCleanup(clamd.server_close)
+        self.addCleanup(clamd.shutdown)
+        self.addCleanup(scanning.get_pool().clear)
+        del queued_uploads[:]
+        with self.temp_storage(), override_settings(ATTACHMENTS_CLAMD=True, ATTACHMENTS_CLAMD_SOCKET=clamd.server_address,
+                                                    ATTACHMENT_PROCESSING='testapp.tests.queue_upload'):
+            sess = session(RequestFactory().get('/test/page/'))
+            clean = self.upload_file(sess, name='clean.txt').json()
+            virus = self.upload_file(sess, name='virus.txt', data=b'X5O!P%@AP EICAR').json()
+            # Nothing was scanned while the files were uploaded.
+            self.assertEqual(clamd.commands, [])
+            self.assertEqual((clean['ok'], clean['status'], virus['ok'], virus['status']), (True, 'pending', True, 'pending'))
+            self.assertEqual(queued_uploads, [])
+            self.run_commit_hooks()
+            self.assertEqual(queued_uploads, [clean['upload_id'], virus['upload_id']])
+            self.assertEqual(self.client.get(clean['status_url']).json()['status'], 'pending')
+            processing.process_upload(clean['upload_id'])
+            self.assertEqual(self.client.get(clean['status_url']).json(), {
+                'ok': True, 'status': 'clean', 'error': '', 'file_name': 'clean.txt'})
+            # Attaching doesn't wait for the queue to get to the other upload, and leaves out the infected file.
+            attached = sess.attach(Document.objects.create(data={}))
+            self.assertEqual([a.file_name for a in attached], ['clean.txt'])
+            status = self.client.get(virus['status_url']).json()
+            self.assertEqual((status['ok'], status['status']), (False, 'rejected'))
+            self.assertIn('Eicar-Test-Signature', status['error'])
+            # Once claimed, uploads aren't processed again.
+            self.assertIsNone(processing.process_upload(virus['upload_id']))
+            # Unless the worker that claimed them died.
+            stuck = self.upload_file(sess, name='stuck.txt').json()
+            Upload.objects.filter(pk=stuck['upload_id']).update(status='scanning', date_claimed=timezone.now())
+            self.assertIsNone(processing.process_upload(stuck['upload_id']))
+            Upload.objects.filter(pk=stuck['upload_id']).update(
+                date_claimed=timezone.now() - datetime.timedelta(minutes=10))
+            attached = sess.attach(Document.objects.create(data={}))
+            self.assertIn('stuck.txt', [a.file_name for a in attached])
+
+    def test_spawned_workers(self):
+        # Spawned workers start without Django set up, unlike forked ones.
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=workers.init_process) as executor:
+            self.assertEqual(executor.submit(worker_state).result(), (True, settings.SETTINGS_MODULE))
+
+    def test_storage_registry(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        storages = {
+            'archive': ('django.core.files.storage.FileSystemStorage', {'location': os.path.join(root, 'archive')}),
+        }
+        with self.temp_storage(), override_settings(ATTACHMENT_STORAGES=storages):
+            storage = get_storage()
+            # Instances are built once and shared between threads.
+            others = []
+            threads = [threading.Thread(target=lambda: others.append(get_storage())) for _i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertTrue(all(other is storage for other in others))
+            self.assertEqual(get_storage('archive').location, os.path.join(root, 'archive'))
+            self.assertIsNot(get_storage('archive'), storage)
+            with self.assertRaises(KeyError):
+                get_storage('missing')
+            # Storages map back to their names, so attachments can record where their files are.
+            self.assertEqual(get_storage_name(get_storage('archive')), 'archive')
+            with self.assertRaises(ImproperlyConfigured):
+                get_storage_name(FileSystemStorage(location=root))
+            with self.assertRaises(ImproperlyConfigured):
+                Attachment.objects.attach_raw(ContentFile(b'data', name='data.txt'), Document.objects.create(data={}),
+                                              storage=FileSystemStorage(location=root))
+            reset_storages()
+            self.assertIsNot(get_storage(), storage)
+            # Changing the settings builds new instances.
+            storage = get_storage()
+            with self.temp_storage():
+                self.assertNotEqual(get_storage().location, storage.location)
+            self.assertEqual(get_storage().location, storage.location)
+
+    def test_storage_routing(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        storages = {
+            'small': ('django.core.files.storage.FileSystemStorage', {'location': os.path.join(root, 'small')}),
+            'images': ('django.core.files.storage.FileSystemStorage', {'location': os.path.join(root, 'images')}),
+        }
+        routes = [
+            {'mime_type': 'image/*', 'storage': 'images'},
+            {'max_size': 100, 'context': 'note*', 'storage': 'small'},
+        ]
+        self.client.force_login(User.objects.create_user('user'))
+        doc = Document.objects.create(data={})
+        with self.temp_storage(), override_settings(ATTACHMENT_STORAGES=storages, ATTACHMENT_STORAGE_ROUTES=routes):
+            sess = session(RequestFactory().get('/test/page/'), context='notes')
+            self.upload_file(sess, name='small.txt', data=b'small')
+            self.upload_file(sess, name='large.txt', data=b'large' * 100)
+            self.upload_file(sess, name='image.gif', data=b'GIF89a' + b'\0' * 100)
+            small, large, image = sess.attach(doc)
+            self.assertEqual([a.storage for a in (small, large, image)], ['small', 'default', 'images'])
+            self.assertTrue(get_storage('small').exists(small.file_path))
+            self.assertFalse(get_storage().exists(small.file_path))
+            # Web server locations are mapped per storage.
+            backend = ('attachments.downloads.XAccelRedirectBackend', {'prefix': {'default': '/protected', 'small': '/small'}})
+            with override_settings(ATTACHMENT_DOWNLOAD_BACKEND=backend):
+                self.assertEqual(self.client.get(small.get_absolute_url())['X-Accel-Redirect'], '/small/' + small.file_path)
+                self.assertEqual(self.client.get(large.get_absolute_url())['X-Accel-Redirect'], '/protected/' + large.file_path)
+                with self.assertRaises(ImproperlyConfigured):
+                    self.client.get(image.get_absolute_url())
+            # Downloads read from the storage the attachment is in, whatever the rules say now.
+            with override_settings(ATTACHMENT_STORAGE_ROUTES=[]):
+                response = self.client.get(small.get_absolute_url())
+                self.assertEqual(b''.join(response.streaming_content), b'small')
+                # Move everything to where the router now says (the default storage).
+                out = io.StringIO()
+                call_command('migrate_attachment_storage', route=True, stdout=out)
+                self.assertIn('Moved 2 attachments (0 failed)', out.getvalue())
+            old_path = small.file_path
+            small.refresh_from_db()
+            self.assertEqual(small.storage, 'default')
+            self.assertTrue(get_storage().exists(small.file_path))
+            self.assertFalse(get_storage('small').exists(old_path))
+            call_command('migrate_attachment_storage', target='images', source='default', context='notes', stdout=out)
+            self.assertEqual(set(Attachment.objects.values_list('storage', flat=True)), {'images'})
+            Attachment.objects.all().delete()
+            self.run_commit_hooks()
+            self.assertEqual(os.listdir(os.path.join(root, 'images', 'testapp', 'document', str(doc.pk), 'notes')), [])
+
+    def test_sharded_paths(self):
+        doc = Document.objects.create(data={})
+        with self.temp_storage():
+            storage = get_storage()
+            flat = self.attach_file(name='flat.txt', data=b'flat', obj=doc)
+            self.assertEqual(flat.file_path, 'testapp/document/%s//flat.txt' % doc.pk)
+            other = self.attach_file(name='other.txt', obj=Document.objects.create(data={}))
+            with override_settings(ATTACHMENT_TEMP_SHARDS=2, ATTACHMENT_PATH_SHARDS=2):
+                sess = session(RequestFactory().get('/test/page/'))
+                self.upload_file(sess, name='sharded.txt', data=b'sharded')
+                # Temp files are spread over two levels of subdirectories.
+                temp_path = sess.uploads.get().file_path
+                relative = os.path.relpath(temp_path, settings.ATTACHMENT_TEMP_DIR).split(os.sep)
+                self.assertEqual([len(part) for part in relative[:2]], [2, 2])
+                self.assertEqual(len(relative), 3)
+                sharded = sess.attach(doc)[0]
+                self.assertRegex(sharded.file_path, r'^testapp/document/[0-9a-f]{2}/[0-9a-f]{2}/%s//sharded.txt$' % doc.pk)
+                # Files attached before sharding can be moved into the sharded layout.
+                out = io.StringIO()
+                with override_settings(FILE_UPLOAD_PERMISSIONS=0o640, FILE_UPLOAD_DIRECTORY_PERMISSIONS=0o750):
+                    call_command('shard_attachment_paths', stdout=out)
+                self.assertIn('Moved 2 attachments (1 skipped, 0 failed)', out.getvalue())
+            old_path = flat.file_path
+            flat.refresh_from_db()
+            self.assertEqual(flat.file_path.rpartition('/')[0], sharded.file_path.rpartition('/')[0])
+            with storage.open(flat.file_path) as fp:
+                self.assertEqual(fp.read(), b'flat')
+            self.assertFalse(storage.exists(old_path))
+            # Moved files and the directories made for them get the storage's permissions, as if saved through it.
+            other.refresh_from_db()
+            path = storage.path(other.file_path)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+            self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 0o777, 0o750)
+
+    @unittest.skipIf(django.VERSION < (3, 1), 'async views require Django 3.1')
+    def test_async_views(self):
+        from asgiref.sync import async_to_sync
+        from attachments import async_views
+        from django.test import AsyncRequestFactory
+        factory = AsyncRequestFactory()
+        user = User.objects.create_user('user')
+        data = b'0123456789' * 1000
+        with self.temp_storage():
+            sess = session(RequestFactory().get('/test/page/'))
+            url = self.client.post('/attachments/%s/chunked/' % sess.uuid).json()['url']
+            token = url.rstrip('/').rsplit('/', 1)[1]
+            request = factory.put(url, data, content_type='application/octet-stream',
+                                  **{'content-range': 'bytes 0-%d/%d' % (len(data) - 1, len(data))})
+            response = async_to_sync(async_views.chunked_upload)(request, sess.uuid, token)
+            self.assertEqual(json.loads(response.content), {'ok': True, 'offset': len(data)})
+            with self.assertRaises(Http404):
+                async_to_sync(async_views.chunked_upload)(request, sess.uuid, 'missing')
+            self.client.post(url, {'file_name': 'data.bin', 'file_size': len(data)})
+            attachment = sess.attach(Document.objects.create(data={}))[0]
+            request = factory.get(attachment.get_absolute_url())
+            request.user = user
+            with override_settings(ATTACHMENT_DOWNLOAD_BLOCK_SIZE=4096):
+                response = async_to_sync(async_views.download)(request, attachment.pk)
+
+                async def read(content):
+                    return [chunk async for chunk in content]
+                if async_views.ASYNC_STREAMING:
+                    chunks = async_to_sync(read)(response.streaming_content)
+                else:
+                    chunks = list(response.streaming_content)
+            self.assertEqual(b''.join(chunks), data)
+            self.assertEqual(len(chunks), 3)
+            response.close()
+
+    @unittest.skipIf(renditions.Image is None, 'renditions require Pillow')
+    def test_renditions(self):
+        self.client.force_login(User.objects.create_user('user'))
+        photo = io.BytesIO()
+        renditions.Image.new('RGB', (800, 600), (200, 0, 0)).save(photo, 'JPEG')
+        sizes = {'thumbnail': (100, 100), 'preview': (400, 400)}
+        with self.temp_storage(), override_settings(ATTACHMENT_RENDITION_SIZES=sizes):
+            storage = get_storage()
+            attachment = self.attach_file(name='photo.jpg', data=photo.getvalue())
+            url = attachment.get_thumbnail_url()
+            response = self.client.get(url)
+            self.assertEqual(response['Content-Type'], 'image/jpeg')
+            self.assertEqual(renditions.Image.open(io.BytesIO(response.content)).size, (100, 75))
+            self.assertIn('private', response['Cache-Control'])
+            # The rendition is stored next to the original, and served from there from then on.
+            rendition = attachment.renditions.get()
+            self.assertEqual(rendition.file_path, 'testapp/document/%s/renditions/thumbnail/%s.jpg' % (
+                attachment.object_id, attachment.pk))
+            self.assertTrue(storage.exists(rendition.file_path))
+            with mock.patch('attachments.renditions.generate_renditions') as generate:
+                self.assertEqual(self.client.get(url).content, response.content)
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+                self.assertFalse(generate.called)
+            self.assertEqual(self.client.get(attachment.get_thumbnail_url('huge')).status_code, 404)
+            # Receivers vetoing downloads apply to previews as well.
+
+            def veto(sender, **kwargs):
+                raise Http404()
+            file_download.connect(veto)
+            self.addCleanup(file_download.disconnect, veto)
+            self.assertEqual(self.client.get(url).status_code, 404)
+            file_download.disconnect(veto)
+            self.assertIsNone(self.attach_file(name='notes.txt').get_thumbnail_url())
+            # Sizes in ATTACHMENT_RENDITION_PRECOMPUTE are generated once attachments are attached.
+            with override_settings(ATTACHMENT_RENDITION_PRECOMPUTE=['preview']), \
+                    mock.patch.object(renditions, 'get_background_executor') as executor, \
+                    mock.patch.object(renditions, 'close_old_connections'):
+                executor.return_value.submit.side_effect = lambda func, *args: func(*args)
+                other = self.attach_file(name='other.jpg', data=photo.getvalue())
+                self.run_commit_hooks()
+            self.assertEqual((other.renditions.get().width, other.renditions.get().height), (400, 300))
+            # Renditions are deleted along with their attachments.
+            other_path = other.renditions.get().file_path
+            attachment.delete()
+            Attachment.objects.filter(pk=other.pk).delete()
+            self.run_commit_hooks()
+            self.assertFalse(Rendition.objects.exists())
+            self.assertFalse(storage.exists(rendition.file_path))
+            self.assertFalse(storage.exists(other_path))
+            # Even when the attachments are deleted some other way, such as by cascading.
+            third = self.attach_file(name='third.jpg', data=photo.getvalue())
+            third_rendition = renditions.get_rendition(third, 'thumbnail')
+            self.assertTrue(storage.exists(third_rendition.file_path))
+            models.QuerySet(Attachment).filter(pk=third.pk).delete()
+            self.run_commit_hooks()
+            self.assertFalse(Rendition.objects.filter(pk=third_rendition.pk).exists())
+            self.assertFalse(storage.exists(third_rendition.file_path))